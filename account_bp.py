@@ -1,10 +1,14 @@
 """This is the driving module for account and image actions in the Facebook imitation app 'Y'."""
 from datetime import (timedelta)
-from flask import request, jsonify, Blueprint, Response
-from flask_jwt_extended import (get_jwt_identity, jwt_required,
+from flask import request, jsonify, Blueprint, Response, current_app, send_file
+from flask_jwt_extended import (current_user, jwt_required,
                                  create_access_token, set_access_cookies)
 from werkzeug.utils import secure_filename
-from models import (db, Account, Img)
+from sqlalchemy.exc import IntegrityError
+from models import (db, Account, Img, ImgVariant)
+from image_store import get_store
+from image_derivatives import VARIANTS, queue_variants
+from current_account import invalidate_account
 
 account_bp = Blueprint('account', __name__)
 
@@ -34,11 +38,12 @@ def image_handler(req, f_access, img_target, account):
         if len(image) < 60000:
 
             mimetype = profile_pic.mimetype
-            img = Img(img=image, mimetype=mimetype, name=filename)
+            img = Img.create(image, filename, mimetype)
 
             # Store the image object
             db.session.add(img)
             db.session.commit()
+            queue_variants(img)
 
             # Get the image id
             img_id = img.id
@@ -59,11 +64,22 @@ def image_handler(req, f_access, img_target, account):
 def get_img(img_id):
     '''
     Returns image to be rendered by the webpage.
+    Img rows never change once written so responses carry a strong ETag and long lived
+        private cache headers, and a matching If-None-Match gets a 304 without reading the image.
     P:
         img_id (int): PK for image object
+        size (request arg, optional): One of image_derivatives.VARIANTS. The original is
+            served (and only briefly cached) until that derivative has been made.
     R:
         Repsonse containing the image data.
     '''
+    variant = request.args.get('size')
+    if variant is not None and variant not in VARIANTS:
+        err = jsonify({'message': 'Unknown image size.'})
+        err.status_code = 400
+        return err
+
+    #Img.img is deferred, so this only reads the metadata columns.
     img = Img.query.filter_by(id=img_id).first()
 
     if not img:
@@ -71,7 +87,63 @@ def get_img(img_id):
         err.status_code = 400
         return err
 
-    return Response(img.img, mimetype=img.mimetype)
+    content_hash = img.content_hash
+    mimetype = img.mimetype
+    fallback = False
+    #Rows not yet moved out of the table have no derivatives until 'flask images migrate'.
+    if variant is not None and content_hash is None:
+        fallback = True
+    elif variant is not None:
+        derived = ImgVariant.query.filter_by(source_hash=content_hash, variant=variant).first()
+        if derived is None:
+            fallback = True
+        else:
+            content_hash = derived.content_hash
+            mimetype = derived.mimetype
+
+    etag = content_hash or f"img-{img.id}"
+    if request.if_none_match.contains(etag):
+        return cache_image_response(Response(status=304), etag, fallback)
+
+    #Rows not yet moved out of the table still carry their bytes.
+    if content_hash is None:
+        response = Response(img.img, mimetype=mimetype)
+        response.set_etag(etag)
+        return cache_image_response(response.make_conditional(request), etag, fallback)
+
+    path = get_store().path(content_hash)
+    if path is None:
+        response = Response(get_store().read(content_hash), mimetype=mimetype)
+        response.set_etag(etag)
+        return cache_image_response(response.make_conditional(request), etag, fallback)
+    #send_file hands the open file to the server's file wrapper (sendfile where available)
+    #and sets Last-Modified from the file. Without max_age it would also send no-cache.
+    max_age = None if fallback else current_app.config['IMAGE_CACHE_MAX_AGE']
+    return cache_image_response(send_file(path, mimetype=mimetype, etag=etag, max_age=max_age),
+                                etag, fallback)
+
+def cache_image_response(response, etag, fallback=False):
+    '''
+    Sets the validator and cache headers of an image response.
+    P:
+        response(Response): The image (or 304) response
+        etag(string): Strong ETag of the image
+        fallback(bool): True if the original is standing in for a derivative not made yet,
+            in which case the browser has to revalidate so it picks up the derivative later.
+    R:
+        The response.
+    '''
+    response.set_etag(etag)
+    response.cache_control.private = True
+    if fallback:
+        response.cache_control.no_cache = True
+    else:
+        #send_file may have set no-cache or public, either would override the lines below.
+        response.cache_control.no_cache = None
+        response.cache_control.public = None
+        response.cache_control.max_age = current_app.config['IMAGE_CACHE_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
 
 #Account creation at default request
 @account_bp.route('/api/account', methods=['POST'])
@@ -104,8 +176,14 @@ def make_account():
         err.status_code = 400
         return err
 
-    db.session.add(acnt)
-    db.session.commit()
+    try:
+        Account.insert_all([acnt])
+    except IntegrityError:
+        #Someone else took the user name between the check above and the insert.
+        db.session.rollback()
+        err = jsonify({'message': 'An account already exists with that user name.'})
+        err.status_code = 400
+        return err
     account_token = create_access_token(identity=acnt.id, expires_delta=timedelta(minutes=10))
     response = jsonify({"msg": "login is valid for accountID " + str(acnt.id)})
     set_access_cookies(response, account_token)
@@ -119,11 +197,10 @@ def update_account_bio():
     Updates the logged in account's bio.
     Request is expected to have a form fields 'new-bio'.
     '''
-    acnt = Account.query.filter_by(id=get_jwt_identity(), deleted_at=None).first()
-    if acnt is None:
+    if current_user.deleted_at is not None:
         return "Your account does not exist.", 404
 
-    acnt.bio = request.form.get('new-bio')
+    current_user.bio = request.form.get('new-bio')
 
     db.session.commit()
     return "Okay", 200
@@ -135,17 +212,17 @@ def update_account_images():
     Updates associated cover_image_id and profile_image_id of caller's account.
     Aborts with 404 if account has since been deleted and aborts with 400 if file is too large.
     '''
-    acnt = Account.query.filter_by(id=get_jwt_identity(), deleted_at=None).first()
-    if acnt is None:
+    if current_user.deleted_at is not None:
         return "Your account does not exist.", 404
 
-    if not (image_handler(request, 'profile-image', 1, acnt)
-            and image_handler(request, 'cover-image', 0, acnt)):
+    if not (image_handler(request, 'profile-image', 1, current_user)
+            and image_handler(request, 'cover-image', 0, current_user)):
         err = jsonify({'message': FILE_SIZE_ERR_MSG})
         err.status_code = 400
         return err
 
     db.session.commit()
+    invalidate_account(current_user.id)
     return "Okay", 200
 
 @account_bp.route('/api/account/updatePassword', methods=['POST'])
@@ -156,9 +233,7 @@ def update_account_password():
     Expects a form with fields current-password and new-password.
     Aborts with 400 if a field is missing or if the current-password is not the current password.
     '''
-    acnt = Account.query.filter_by(id=get_jwt_identity(), deleted_at=None).first()
-
-    if acnt is None:
+    if current_user.deleted_at is not None:
         return "Your account does not exist.", 404
 
     cur_pw = request.form.get('current-password')
@@ -169,7 +244,7 @@ def update_account_password():
         err.status_code = 400
         return err
 
-    if not acnt.change_pw(cur_pw, new_pw):
+    if not current_user.change_pw(cur_pw, new_pw):
         err = jsonify({'message': "The password you entered is incorrect."})
         err.status_code = 400
         return err
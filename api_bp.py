@@ -0,0 +1,285 @@
+"""This is the driving module for the JSON read APIs in the Facebook imitation app 'Y'.
+They return the same data profile.html is rendered from, so the front end can update
+parts of a page instead of reloading it."""
+from datetime import datetime, timedelta
+from flask import current_app, request, Blueprint
+from flask_jwt_extended import (current_user, get_jwt_identity, jwt_required)
+from models import db, Post, Reply, Account
+from pages_bp import (get_timeline_page, get_friends_and_postable, process_timeline,
+                      get_connection_pages, CONNECTION_CATEGORIES)
+from pst_rep_rea_bp import can_make_content
+from serialization import api_response
+from social_graph import get_graph
+from suggestions import get_suggestions
+
+api_bp = Blueprint('api', __name__)
+
+def api_post(processed):
+    '''
+    Converts a processed post to plain values.
+    P:
+        processed(dict): A post in the form of Post.to_processed_dict
+    R:
+        The dictionary with replies as Reply.to_dict (deleted ones left out) and no reactions.
+    '''
+    post = dict(processed)
+    del post['reactions']
+    post['replies'] = [reply.to_dict() for reply in processed['replies']
+                       if reply.deleted_at is None]
+    return post
+
+def edited_post(processed):
+    """Converts a processed post like api_post, leaving replies out (they come in newReplies)."""
+    post = dict(processed)
+    del post['reactions']
+    del post['replies']
+    return post
+
+def timeline_payload(target_acc, caller_acc_id, caller_friends, before):
+    '''
+    Builds the API form of a page of a timeline.
+    P:
+        target_acc(Account): The timeline owner
+        caller_acc_id(int): Account.id of the caller
+        caller_friends(set): Account.ids the caller has been friends with (None on their own page)
+        before(int): Cursor from the previous page (None for the first page)
+    R:
+        Dictionary with account, friends, postable, posts, likedPosts, userReactions,
+            numLikes and nextCursor, plus postCount and the watermark for polling
+            /api/timeline/<acc_id>/changes on the first page.
+            Dictionaries keyed by ids use string keys as they would in JSON.
+    '''
+    friends, postable = get_friends_and_postable(target_acc)
+    raw_timeline, next_cursor = get_timeline_page(target_acc.id, before)
+    processed = process_timeline(raw_timeline, caller_acc_id, caller_friends)
+
+    payload = {'account': target_acc.to_dict(), 'friends': friends,
+               'postable': {str(key): value for key, value in postable.items()},
+               'posts': [api_post(post) for post in processed['timeline']],
+               'likedPosts': processed['likedPosts'],
+               'userReactions': {str(key): value
+                                 for key, value in processed['userReactions'].items()},
+               'numLikes': {str(key): value for key, value in processed['numLikes'].items()},
+               'nextCursor': next_cursor}
+    if before is None:
+        payload['postCount'] = target_acc.post_count
+        last_change = (db.session.query(db.func.max(Post.updated_at))
+                       .filter(Post.posted_on_id == target_acc.id).scalar())
+        payload['watermark'] = make_watermark(raw_timeline[0].id if raw_timeline else 0,
+                                              last_change)
+    return payload
+
+def make_watermark(since_id, since):
+    '''
+    Builds the watermark a client sends back to /api/timeline/<acc_id>/changes.
+    Post.updated_at is stamped by the web process when the row is flushed, not when it is
+        committed, so a row stamped before the newest one seen can still become visible later.
+        since is held back to TIMELINE_WATERMARK_LAG seconds before now, which makes the next
+        poll read those rows again, as long as transactions commit (and the web processes'
+        clocks agree) within that window.
+    P:
+        since_id(int): Newest Post.id the client has
+        since(datetime): Newest Post.updated_at the client has seen (None for new posts only)
+    R:
+        Dictionary of sinceId and since (ISO 8601 or None).
+    '''
+    if since is not None:
+        since = min(since, datetime.now()
+                    - timedelta(seconds=current_app.config['TIMELINE_WATERMARK_LAG']))
+    return {'sinceId': since_id, 'since': since.isoformat() if since else None}
+
+def get_timeline_changes(acc_id, since_id, since):
+    '''
+    Gets what changed on a timeline after a watermark. Only rows changed since the watermark
+        are read (ix_post_changes), so the cost follows the amount of change, not timeline size.
+    P:
+        acc_id(int): Account.id of the timeline owner
+        since_id(int): Newest Post.id the client has
+        since(datetime): Newest Post.updated_at the client has seen (None for new posts only)
+    R:
+        Tuple of (new Posts newest first, up to TIMELINE_PAGE_SIZE,
+            True if there were more new posts than that,
+            older Posts changed at or after since (deleted ones included),
+            Replies on those posts made or deleted at or after since).
+    '''
+    page_size = current_app.config['TIMELINE_PAGE_SIZE']
+    new_posts = (Post.query.options(*Post.loading(replies='selectin'))
+                 .filter(Post.posted_on_id == acc_id, Post.deleted_at == None, Post.id > since_id)
+                 .order_by(Post.id.desc()).limit(page_size + 1).all())
+    truncated = len(new_posts) > page_size
+    new_posts = new_posts[:page_size]
+
+    if since is None:
+        return new_posts, truncated, [], []
+
+    #>= because MySQL DATETIME drops fractions of a second; resending a row is harmless
+    #(make_watermark lags since, so rows of the last few seconds are always sent again).
+    changed_posts = (Post.query.options(*Post.loading())
+                     .filter(Post.posted_on_id == acc_id, Post.updated_at >= since,
+                             Post.id <= since_id).all())
+    live_ids = [post.id for post in changed_posts if post.deleted_at is None]
+    replies = []
+    if live_ids:
+        replies = Reply.query.filter(Reply.responding_to.in_(live_ids),
+                                     db.or_(Reply.created_at >= since,
+                                            Reply.deleted_at >= since)).all()
+    return new_posts, truncated, changed_posts, replies
+
+def check_timeline_access(acc_id, caller_id):
+    '''
+    Checks that the caller may read another user's timeline.
+    R:
+        None if they can, otherwise the 401 response to return.
+    '''
+    permission = can_make_content(acc_id, caller_id)
+    if permission == 2:
+        return api_response({'message': "Profile is private."}, 401)
+    if permission == 3:
+        return api_response({'message': "You are not friends."}, 401)
+    return None
+
+@api_bp.route('/api/profile')
+@jwt_required()
+def get_profile():
+    '''
+    Returns a page of the current user's own timeline.
+    Request args may have before(int): the cursor handed out with the previous page.
+    R:
+        JSON (or MessagePack if preferred by the Accept header) in the form of timeline_payload.
+    '''
+    return api_response(timeline_payload(current_user, current_user.id, None,
+                                         request.args.get('before', type=int)))
+
+@api_bp.route('/api/timeline/<int:acc_id>')
+@jwt_required()
+def get_timeline(acc_id):
+    '''
+    Returns a page of another user's timeline.
+    Request args may have before(int): the cursor handed out with the previous page.
+    R:
+        JSON (or MessagePack if preferred by the Accept header) in the form of timeline_payload.
+        401 if the profile is private or the caller is not friends with its owner.
+    '''
+    caller_id = get_jwt_identity()
+    if acc_id == caller_id:
+        return get_profile()
+
+    denied = check_timeline_access(acc_id, caller_id)
+    if denied is not None:
+        return denied
+
+    target_acc = db.session.get(Account, acc_id)
+    return api_response(timeline_payload(target_acc, caller_id,
+                                         get_graph().get(caller_id).ever_friends,
+                                         request.args.get('before', type=int)))
+
+@api_bp.route('/api/timeline/<int:acc_id>/changes')
+@jwt_required()
+def get_changes(acc_id):
+    '''
+    Returns what changed on a timeline (the caller's own included) since a watermark.
+    Request args are expected to have:
+        sinceId(int): watermark.sinceId from the last response
+        since(string): watermark.since from the last response (ISO 8601, may be left out)
+    R:
+        JSON (or MessagePack) with posts (new posts newest first), truncated (true if there
+            were more new posts than one page, reload instead), editedPosts (without replies),
+            deletedIds, counts (Post.id to likeCount and replyCount of changed posts),
+            newReplies, deletedReplyIds and the watermark for the next poll.
+            Rows can be sent again on the next poll; applying them twice is harmless.
+    '''
+    caller_id = get_jwt_identity()
+    since_id = request.args.get('sinceId', type=int)
+    since = request.args.get('since')
+    if since_id is None:
+        return api_response({'message': "A sinceId is required."}, 400)
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            return api_response({'message': "since must be an ISO 8601 date and time."}, 400)
+    else:
+        since = None
+
+    caller_friends = None
+    if acc_id != caller_id:
+        denied = check_timeline_access(acc_id, caller_id)
+        if denied is not None:
+            return denied
+        caller_friends = get_graph().get(caller_id).ever_friends
+
+    new_posts, truncated, changed_posts, replies = get_timeline_changes(acc_id, since_id, since)
+    live_posts = [post for post in changed_posts if post.deleted_at is None]
+    #Processing every changed post also refreshes the caller's likes on them.
+    processed = process_timeline(new_posts + live_posts, caller_id, caller_friends)
+    edited_ids = {post.id for post in live_posts
+                  if post.edited_at is not None and post.edited_at >= since}
+
+    last_change = max([post.updated_at for post in new_posts + changed_posts
+                       if post.updated_at is not None] + ([since] if since else []),
+                      default=None)
+    payload = {'posts': [api_post(post) for post in processed['timeline'][:len(new_posts)]],
+               'truncated': truncated,
+               'editedPosts': [edited_post(post) for post in processed['timeline'][len(new_posts):]
+                               if post['id'] in edited_ids],
+               'deletedIds': [post.id for post in changed_posts if post.deleted_at is not None],
+               'counts': {str(post.id): {'likeCount': post.like_count,
+                                         'replyCount': post.reply_count}
+                          for post in new_posts + live_posts},
+               'likedPosts': processed['likedPosts'],
+               'userReactions': {str(key): value
+                                 for key, value in processed['userReactions'].items()},
+               'newReplies': [reply.to_dict() for reply in replies if reply.deleted_at is None],
+               'deletedReplyIds': [reply.id for reply in replies
+                                   if reply.deleted_at is not None],
+               'watermark': make_watermark(max([since_id] + [post.id for post in new_posts]),
+                                           last_change)}
+    return api_response(payload)
+
+@api_bp.route('/api/friends')
+@jwt_required()
+def get_connection_counts():
+    '''
+    Returns how many accounts are in each of the current user's connection lists.
+    R:
+        JSON (or MessagePack) of {'friends', 'pending', 'sent', 'blocked'} counts.
+    '''
+    return api_response(get_graph().get(current_user.id).counts())
+
+@api_bp.route('/api/friends/<category>')
+@jwt_required()
+def get_connections(category):
+    '''
+    Returns a page of one of the current user's connection lists: friends, pending (requests
+        received), sent (requests sent) or blocked.
+    Request args may have after(int): the cursor handed out with the previous page.
+    R:
+        JSON (or MessagePack) with accounts (Account.to_dict, ordered by id), nextCursor and count.
+        404 for an unknown list.
+    '''
+    if category not in CONNECTION_CATEGORIES:
+        return api_response({'message': "Unknown list."}, 404)
+    edges = get_graph().get(current_user.id)
+    accounts, next_cursor = get_connection_pages(
+        edges, {category: request.args.get('after', type=int)})[category]
+    return api_response({'accounts': accounts, 'nextCursor': next_cursor,
+                         'count': edges.counts()[category]})
+
+@api_bp.route('/api/suggestions')
+@jwt_required()
+def get_people_you_may_know():
+    '''
+    Returns the accounts the current user may know: friends of friends, most mutual friends
+        first, leaving out blocked accounts and pending requests.
+    R:
+        JSON (or MessagePack) with accounts (Account.to_dict plus mutualFriends).
+    '''
+    edges = get_graph().get(current_user.id)
+    accounts = []
+    #The friend code is included so a request can be sent; friends' timelines list it already.
+    for acc, mutual_count in get_suggestions(current_user.id, edges,
+                                             current_app.config['SUGGESTIONS_LIMIT']):
+        account = acc.to_dict()
+        account['mutualFriends'] = mutual_count
+        accounts.append(account)
+    return api_response({'accounts': accounts})
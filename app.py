@@ -3,18 +3,22 @@ from datetime import (datetime, timedelta, timezone)
 import jwt
 from flask import Flask, jsonify, redirect, url_for, render_template
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import PendingRollbackError, OperationalError
+from sqlalchemy.exc import PendingRollbackError, DBAPIError
 from flask_jwt_extended import (JWTManager, get_jwt, get_jwt_identity,
                                 create_access_token, set_access_cookies)
-from flask_bcrypt import Bcrypt
+from password_hashing import HashingBusyError
+from serialization import FastJSONProvider
+from instrumentation import instrument
+from db_retry import install_retries, is_transient
 
 # Initializing
 app = Flask(__name__)
 app.config.from_pyfile("settings.py")
+app.json = FastJSONProvider(app)
 db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 app.app_context().push()
+instrument(app, db)
 
 #registering Blueprints
 from account_bp import account_bp
@@ -32,6 +36,34 @@ app.register_blueprint(pst_rep_rea_bp)
 from login_logout_bp import login_logout_bp
 app.register_blueprint(login_logout_bp)
 
+from feed_bp import feed_bp
+app.register_blueprint(feed_bp)
+
+from api_bp import api_bp
+app.register_blueprint(api_bp)
+
+from events_bp import events_bp
+app.register_blueprint(events_bp)
+
+from batch_bp import batch_bp
+app.register_blueprint(batch_bp)
+
+from search_bp import search_bp
+app.register_blueprint(search_bp)
+
+from metrics_bp import metrics_bp
+app.register_blueprint(metrics_bp)
+
+#Must follow the blueprints, it wraps every registered view.
+install_retries(app, db)
+
+#registering the caller lookup, current_user is the caller's Account after jwt_required
+from current_account import load_current_account
+jwt.user_lookup_loader(load_current_account)
+
+#registering CLI commands
+import commands
+
 #ERROR HANDLING
 @jwt.unauthorized_loader
 def handle_missing_token(error):
@@ -76,33 +108,45 @@ def handle_expired_token(error, second):
     print(error, second)
     return redirect(url_for('pages.login_page', redirect_reason = "tknExp"))  #Token expired
 
+@jwt.user_lookup_error_loader
+def handle_missing_account(jwt_header, jwt_data):
+    '''
+    Handles a valid access_token whose account no longer exists (removed by hand or purged).
+    R:
+        Returns 404, as the account routes did before current_user.
+    '''
+    return "Your account does not exist.", 404
+
+@app.errorhandler(HashingBusyError)
+def handle_hashing_busy(error):
+    '''
+    Password hashing is queued up (usually a login storm).
+    R:
+        Returns 503 and asks the caller to retry.
+    '''
+    return jsonify({'message': 'The server is busy. Retry request.', 'retry':True}), 503
+
 @app.errorhandler(404)
 def page_not_found(error):
     """Renders the 404 page if a 404 is called."""
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
-def handle500(error):
+@app.errorhandler(DBAPIError)
+@app.errorhandler(PendingRollbackError)
+def handle_database_error(error):
     '''
-    Sometimes the session will close when it is in use. 
-        This is usually an error due to losing connection to the DB.
+    A database error the view could not recover from, after db_retry has retried what was safe.
     P:
         error: error object
     R:
-        Returns 500 error and forces caller to retry.
+        Returns 503 with Retry-After for dropped connections and conflicts, re-raises the rest.
     '''
-    #most likely we lost DB connection
-    if isinstance(error, (OperationalError, PendingRollbackError)):
-        try:
-            db.session.rollback()
-            db.session.close()
-            db.session.begin()
-        except Exception as rollback_error:
-            print("Error during rollback: %s", str(rollback_error))
-            raise rollback_error #More info on the error please
-
-        return jsonify({'error': 'Lost connection to DB. Retry request.', 'retry':True}), 500
-
+    db.session.rollback()
+    if isinstance(error, PendingRollbackError) or is_transient(error):
+        response = jsonify({'message': 'The database is unavailable. Retry request.',
+                            'retry':True})
+        response.headers['Retry-After'] = '1'
+        return response, 503
     raise error
 
 @app.after_request
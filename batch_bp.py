@@ -0,0 +1,310 @@
+"""This is the driving module for bulk Post, Reply and Reaction actions in the
+Facebook imitation app 'Y'. A batch applies the same rules as the single action endpoints
+in pst_rep_rea_bp, but looks every row and permission up once and commits once."""
+from datetime import datetime
+from flask import current_app, request, jsonify, Blueprint
+from flask_jwt_extended import (get_jwt_identity, jwt_required)
+from models import (db, Post, Reaction, Reply, Account)
+from pst_rep_rea_bp import make_error, can_make_content, can_remove_content
+from feed import fan_out_post
+from event_hub import publish
+
+batch_bp = Blueprint('batch', __name__)
+
+def result(status, message=None, **fields):
+    """Builds the result of one operation."""
+    res = {'status': status}
+    if message is not None:
+        res['message'] = message
+    res.update(fields)
+    return res
+
+def get_int(operation, key):
+    """Returns an operation's field as an int, or None if it is missing or not a number."""
+    value = operation.get(key)
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+class Batch:
+    """The rows, permissions and pending counter changes shared by the operations of one batch."""
+
+    def __init__(self, acc_id, operations):
+        '''
+        Constructor for Batch. Loads every row the operations refer to with one query per table.
+        P:
+            acc_id(int): Account.id of the caller
+            operations(list): The operation dictionaries
+        '''
+        self.acc_id = acc_id
+        self.now = datetime.now()
+        self.permissions = {}
+        self.counters = {}      #Post.id -> [like change, reply change]
+        self.post_counts = {}   #Account.id -> change to its post_count
+        self.new_posts = []
+        self.new_replies = []
+        self.deleted_post_ids = set()
+        self.events = []        #(account ids, event type, payload) published after the commit
+
+        def ids(op_name, key):
+            return {get_int(operation, key) for operation in operations
+                    if operation.get('op') == op_name} - {None}
+
+        self.replies = {}
+        if ids('deleteReply', 'replyId'):
+            self.replies = {reply.id: reply for reply in
+                            Reply.query.filter(Reply.id.in_(ids('deleteReply', 'replyId')))}
+        self.reactions = {}
+        if ids('deleteReaction', 'reactionId'):
+            self.reactions = {reaction.id: reaction for reaction in Reaction.query.filter(
+                Reaction.id.in_(ids('deleteReaction', 'reactionId')))}
+
+        post_ids = (ids('reply', 'respTo') | ids('reaction', 'respTo') | ids('editPost', 'postId')
+                    | ids('deletePost', 'postId')
+                    | {reply.responding_to for reply in self.replies.values()}
+                    | {reaction.responding_to for reaction in self.reactions.values()})
+        self.posts = {}
+        if post_ids:
+            self.posts = {post.id: post for post in
+                          Post.query.options(*Post.loading()).filter(Post.id.in_(post_ids))}
+
+        acc_ids = (ids('post', 'postedOnID')
+                   | {self.posts[post_id].posted_on_id for post_id in ids('reply', 'respTo')
+                      if post_id in self.posts})
+        self.accounts = set()
+        if acc_ids:
+            self.accounts = {row.id for row in db.session.query(Account.id).filter(
+                Account.id.in_(acc_ids), Account.deleted_at == None)}
+
+        #The caller's own past reactions on the posts they like in this batch.
+        self.own_reactions = {}
+        liked_ids = ids('reaction', 'respTo')
+        if liked_ids:
+            for reaction in Reaction.query.filter(Reaction.responding_to.in_(liked_ids),
+                                                  Reaction.poster_id == acc_id):
+                self.own_reactions.setdefault(reaction.responding_to, []).append(reaction)
+
+    def permission(self, target_acc_id):
+        """can_make_content for the caller, computed once per timeline."""
+        if target_acc_id not in self.permissions:
+            self.permissions[target_acc_id] = can_make_content(target_acc_id, self.acc_id)
+        return self.permissions[target_acc_id]
+
+    def live_post(self, post_id):
+        """Returns the post if it exists and is not deleted (including by this batch)."""
+        post = self.posts.get(post_id)
+        if post is None or post.deleted_at is not None:
+            return None
+        return post
+
+    def count(self, post, likes=0, replies=0):
+        """Queues a change to a post's counters, written once per post by finish."""
+        change = self.counters.setdefault(post.id, [0, 0])
+        change[0] += likes
+        change[1] += replies
+        post.updated_at = self.now
+
+    def post(self, operation):
+        """Same rules as make_post, without image uploads."""
+        posted_on_id = get_int(operation, 'postedOnID')
+        if ((operation.get('textContent') is None and operation.get('sharedPostId') is None)
+            or posted_on_id is None):
+            return result(400, "Invalid request recieved.")
+        if posted_on_id not in self.accounts:
+            return result(400, "Can't find that person to post on.")
+
+        permission = self.permission(posted_on_id)
+        if permission == 2:
+            return result(400, "You do not have permission to post right now.")
+        if permission == 3:
+            return result(400, "You are not friends. You cannot post")
+
+        new_post = Post(self.acc_id, operation.get('textContent'), posted_on_id,
+                        operation.get('sharedPostId'))
+        db.session.add(new_post)
+        res = result(200)
+        self.new_posts.append((new_post, res))
+        return res
+
+    def edit_post(self, operation):
+        """Same rules as edit_post."""
+        if operation.get('textContent') is None:
+            return result(400, "Invalid request recieved.")
+        post = self.live_post(get_int(operation, 'postId'))
+        if post is None or post.poster_id != self.acc_id:
+            return result(404, "Unable to find that post")
+
+        post.text_content = operation.get('textContent')
+        post.edited_at = self.now
+        post.updated_at = self.now
+        return result(200, id=post.id)
+
+    def delete_post(self, operation):
+        """Same rules as delete_post."""
+        post = self.posts.get(get_int(operation, 'postId'))
+        if post is None:
+            return result(400, "Unable to find the post to delete.")
+        if not can_remove_content(post, post.poster_id, self.acc_id):
+            return result(401, "You lack the permission to perform this action.")
+
+        if post.deleted_at is None:
+            self.post_counts[post.posted_on_id] = self.post_counts.get(post.posted_on_id, 0) - 1
+        post.like_count = 0
+        post.reply_count = 0
+        post.deleted_at = self.now
+        post.updated_at = self.now
+        self.deleted_post_ids.add(post.id)
+        return result(200, id=post.id)
+
+    def reply(self, operation):
+        """Same rules as make_reply."""
+        if operation.get('textContent') is None or get_int(operation, 'respTo') is None:
+            return result(400, "Invalid request recieved.")
+        post = self.live_post(get_int(operation, 'respTo'))
+        if post is None or post.posted_on_id not in self.accounts:
+            return result(400, "The post you are trying to respond to has been deleted.")
+
+        permission = self.permission(post.posted_on_id)
+        if permission == 2:
+            return result(400, "You do not have permission to reply right now.")
+        if permission == 3:
+            return result(400, "You are not friends. You cannot reply.")
+
+        new_reply = Reply(post.id, self.acc_id, operation.get('textContent'))
+        db.session.add(new_reply)
+        self.count(post, replies=1)
+        res = result(200)
+        self.new_replies.append((new_reply, post, res))
+        return res
+
+    def delete_reply(self, operation):
+        """Same rules as delete_reply."""
+        reply = self.replies.get(get_int(operation, 'replyId'))
+        if reply is None or reply.deleted_at is not None:
+            return result(400, "Unable to find reply to delete.")
+        if not can_remove_content(self.posts[reply.responding_to], reply.poster_id, self.acc_id):
+            return result(401, "You lack the permission to perform this action.")
+
+        reply.deleted_at = self.now
+        self.count(self.posts[reply.responding_to], replies=-1)
+        return result(200, id=reply.id)
+
+    def reaction(self, operation):
+        """Same rules as make_reaction (always written right away, even with write-behind on)."""
+        if operation.get('reactionType') is None or get_int(operation, 'respTo') is None:
+            return result(400, "Invalid request recieved.")
+        post = self.live_post(get_int(operation, 'respTo'))
+        if post is None:
+            return result(400, "The post you are trying to react to has been deleted.")
+
+        past_reactions = self.own_reactions.setdefault(post.id, [])
+        if any(reaction.deleted_at is None for reaction in past_reactions):
+            return result(200)
+
+        if past_reactions:
+            past_reactions[0].deleted_at = None
+        else:
+            new_reaction = Reaction(res_to=post.id, poster_id=self.acc_id)
+            db.session.add(new_reaction)
+            past_reactions.append(new_reaction)
+        self.count(post, likes=1)
+        self.events.append(([post.poster_id], 'like', {'postId': post.id}))
+        return result(200)
+
+    def delete_reaction(self, operation):
+        """Same rules as delete_reaction."""
+        reaction = self.reactions.get(get_int(operation, 'reactionId'))
+        if reaction is None:
+            return result(400, "Unspecified Error Occured.")
+        post = self.posts[reaction.responding_to]
+        if not can_remove_content(post, reaction.poster_id, self.acc_id):
+            return result(401, "Unspecified Error Occured.")
+
+        if reaction.deleted_at is None:
+            reaction.deleted_at = self.now
+            self.count(post, likes=-1)
+        return result(200, id=reaction.id)
+
+    def finish(self):
+        '''
+        Writes the batch: new rows, cascades of deleted posts and counter changes,
+            then commits once and publishes the events.
+        '''
+        db.session.flush()
+        for new_post, res in self.new_posts:
+            res['id'] = new_post.id
+            self.post_counts[new_post.posted_on_id] = \
+                self.post_counts.get(new_post.posted_on_id, 0) + 1
+            fan_out_post(new_post)
+            self.events.append(([new_post.posted_on_id], 'timelinePost', {'postId': new_post.id}))
+        for new_reply, post, res in self.new_replies:
+            res['id'] = new_reply.id
+            if post.deleted_at is None:
+                self.events.append(([post.poster_id, post.posted_on_id], 'reply',
+                                    {'postId': post.id, 'replyId': new_reply.id}))
+
+        Post.cascade_delete(self.deleted_post_ids, self.now)
+        Account.change_post_counts(self.post_counts)
+
+        #One UPDATE per distinct change instead of one per post; deleted posts stay at 0.
+        by_change = {}
+        for post_id, change in self.counters.items():
+            if any(change) and post_id not in self.deleted_post_ids:
+                by_change.setdefault(tuple(change), []).append(post_id)
+        for (likes, replies), post_ids in by_change.items():
+            db.session.execute(db.update(Post).where(Post.id.in_(post_ids))
+                               .values(like_count=Post.like_count + likes,
+                                       reply_count=Post.reply_count + replies)
+                               .execution_options(synchronize_session=False))
+        db.session.commit()
+
+        for account_ids, event_type, data in self.events:
+            publish(account_ids, event_type, self.acc_id, **data)
+
+#Operation name -> Batch method.
+OPERATIONS = {
+    'post': Batch.post,
+    'editPost': Batch.edit_post,
+    'deletePost': Batch.delete_post,
+    'reply': Batch.reply,
+    'deleteReply': Batch.delete_reply,
+    'reaction': Batch.reaction,
+    'deleteReaction': Batch.delete_reaction
+}
+
+@batch_bp.route('/api/batch', methods=['POST'])
+@jwt_required()
+def run_batch():
+    '''
+    Runs a list of post, reply and reaction actions as the caller in a single transaction.
+    Request json is expected to have operations(list), each a dictionary with op (one of
+        post, editPost, deletePost, reply, deleteReply, reaction, deleteReaction) and the
+        fields the matching single endpoint takes (postId, replyId and reactionId stand in for
+        the ids in their URLs). Operations run in order and see the effects of earlier ones.
+    R:
+        JSON with results: one dictionary per operation, in order, with the status the single
+            endpoint would have returned, a message on failure and the id of the row it
+            made or changed. Failed operations do not stop the others.
+    '''
+    operations = (request.json or {}).get('operations')
+    if (not isinstance(operations, list)
+        or not all(isinstance(operation, dict) for operation in operations)):
+        return make_error(400, "Expected a list of operations.")
+    if len(operations) > current_app.config['BATCH_MAX_OPERATIONS']:
+        return make_error(400, "Too many operations, the limit is "
+                          f"{current_app.config['BATCH_MAX_OPERATIONS']}.")
+
+    batch = Batch(get_jwt_identity(), operations)
+    results = []
+    for operation in operations:
+        handler = OPERATIONS.get(operation.get('op'))
+        if handler is None:
+            results.append(result(400, "Unknown operation."))
+        else:
+            results.append(handler(batch, operation))
+    batch.finish()
+
+    return jsonify({'results': results})
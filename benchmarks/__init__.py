@@ -0,0 +1,26 @@
+"""Benchmarks for the Facebook imitation app 'Y'. They run against their own SQLite database
+and image store, never the one in .env:
+$python -m benchmarks.generate --accounts 1000   (builds the synthetic data set)
+$python -m benchmarks.run --json results.json    (times the key routes)
+$python -m benchmarks.run --compare results.json (same, with the change against an earlier run)"""
+import os
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'instance', 'bench')
+
+def configure(data_dir):
+    '''
+    Points the app at the benchmark database and image store. Must run before app is imported,
+        settings.py reads the environment once.
+    P:
+        data_dir(string): Directory for the SQLite file and images
+    R:
+        Path of the SQLite file.
+    '''
+    os.makedirs(data_dir, exist_ok=True)
+    db_path = os.path.join(data_dir, 'bench.sqlite3')
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    os.environ.setdefault('SQLALCHEMY_SESSION_TIMEOUT', '30')
+    os.environ['IMAGE_STORE_PATH'] = os.path.join(data_dir, 'images')
+    os.environ['EVENT_HUB_BACKEND'] = 'memory'
+    return db_path
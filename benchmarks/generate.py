@@ -0,0 +1,201 @@
+"""Seeded synthetic data set for the benchmarks. The same arguments always build the same data.
+Friendships follow a power law (preferential attachment), so a few accounts have many friends
+like on a real network. Rows are written with bulk inserts so large sets build quickly."""
+import argparse
+import io
+import os
+import random
+import string
+import time
+from datetime import datetime, timedelta
+from benchmarks import DEFAULT_DATA_DIR, configure
+
+PASSWORD = 'benchpass'
+CHUNK = 5000
+
+def preferential_attachment(rng, count, links):
+    '''
+    Builds a friendship graph where new accounts befriend popular ones more often
+        (Barabasi-Albert), which gives the power-law degree distribution of social networks.
+    P:
+        rng(Random): Seeded generator
+        count(int): Number of accounts
+        links(int): Friends each new account makes
+    R:
+        Set of (lower index, higher index) friend pairs.
+    '''
+    edges = set()
+    #Every account appears once per friendship, so picking from it favours popular accounts.
+    endpoints = []
+    for node in range(links, count):
+        chosen = set()
+        while len(chosen) < links:
+            chosen.add(rng.choice(endpoints) if endpoints else rng.randrange(node))
+        for other in chosen:
+            edges.add((other, node))
+            endpoints.extend((other, node))
+    return edges
+
+def heavy_tail(rng, mean):
+    """Returns a count with the given mean and a long tail (exponentially distributed)."""
+    return int(rng.expovariate(1 / mean)) if mean > 0 else 0
+
+def make_image(rng, size=96):
+    """Returns the bytes of a small PNG in a random colour."""
+    from PIL import Image as PImage
+    image = PImage.new('RGB', (size, size), tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def insert(db, model, rows):
+    """Bulk inserts rows in chunks."""
+    for start in range(0, len(rows), CHUNK):
+        db.session.execute(db.insert(model), rows[start:start + CHUNK])
+
+def generate(args):
+    '''
+    Builds the data set in a fresh benchmark database.
+    P:
+        args(Namespace): Parsed command line arguments
+    R:
+        Dictionary of row counts per table.
+    '''
+    db_path = configure(args.data_dir)
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    from app import app, db
+    from migrations import upgrade
+    from models import Account, Post, Reply, Reaction, Relationship, Img, FeedEntry
+    from password_hashing import get_hasher
+    from suggestions import rebuild
+
+    rng = random.Random(args.seed)
+    upgrade(echo=lambda line: None)
+    start = datetime(2024, 1, 1)
+
+    images = []
+    for index in range(args.images):
+        img = Img.create(make_image(rng), f'bench{index}.png', 'image/png')
+        db.session.add(img)
+        images.append(img)
+    db.session.commit()
+    image_ids = [img.id for img in images]
+
+    #One bcrypt hash shared by every account, at the configured cost so logins are realistic.
+    password_hash = get_hasher().hash(PASSWORD)
+    codes = set()
+    while len(codes) < args.accounts:
+        codes.add(''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(8)))
+    codes = sorted(codes)
+    rng.shuffle(codes)
+    accounts = [{'id': index + 1, 'username': f'user{index}', 'password_hash': password_hash,
+                 'first_name': f'First{index}', 'last_name': f'Last{index}',
+                 'bio': 'Synthetic benchmark account', 'is_public': rng.random() < 0.8,
+                 'friend_code': codes[index],
+                 'profile_image_id': rng.choice(image_ids) if image_ids and rng.random() < 0.5
+                                     else None}
+                for index in range(args.accounts)]
+    insert(db, Account, accounts)
+
+    friends = {account['id']: set() for account in accounts}
+    relationships = []
+    for low, high in sorted(preferential_attachment(rng, args.accounts, args.friends)):
+        first, second = low + 1, high + 1
+        friends[first].add(second)
+        friends[second].add(first)
+        relationships.append({'first_acc_id': first, 'second_acc_id': second,
+                              'confirmed_relation': True, 'is_friend_relation': True})
+        relationships.append({'first_acc_id': second, 'second_acc_id': first,
+                              'confirmed_relation': True, 'is_friend_relation': True})
+    insert(db, Relationship, relationships)
+
+    #Post times are drawn first and ids handed out in time order, like a real timeline.
+    specs = []
+    for account in accounts:
+        for _ in range(heavy_tail(rng, args.posts)):
+            timeline = account['id']
+            if friends[account['id']] and rng.random() < 0.3:
+                timeline = rng.choice(sorted(friends[account['id']]))
+            specs.append((start + timedelta(seconds=rng.randrange(90 * 24 * 3600)),
+                          account['id'], timeline))
+    specs.sort()
+
+    posts, replies, reactions, entries = [], [], [], []
+    fanout_limit = app.config['FEED_FANOUT_LIMIT']
+    for post_id, (created_at, poster_id, timeline) in enumerate(specs, start=1):
+        shared = None
+        if posts and rng.random() < args.share_ratio:
+            shared = rng.randrange(1, post_id)
+        audience = sorted(friends[timeline] | {timeline})
+
+        reply_count = heavy_tail(rng, args.replies)
+        for _ in range(reply_count):
+            replies.append({'id': len(replies) + 1, 'responding_to': post_id,
+                            'poster_id': rng.choice(audience), 'text_content': 'Synthetic reply',
+                            'created_at': created_at + timedelta(minutes=rng.randrange(1, 600))})
+        likers = rng.sample(audience, min(len(audience), heavy_tail(rng, args.likes)))
+        for liker in likers:
+            reactions.append({'id': len(reactions) + 1, 'responding_to': post_id,
+                              'poster_id': liker, 'reaction_type': 1})
+
+        posts.append({'id': post_id, 'poster_id': poster_id, 'posted_on_id': timeline,
+                      'text_content': f'Synthetic post {post_id}', 'shared_post_id': shared,
+                      'associated_image_id': rng.choice(image_ids)
+                                             if image_ids and rng.random() < args.image_ratio
+                                             else None,
+                      'like_count': len(likers), 'reply_count': reply_count,
+                      'created_at': created_at, 'updated_at': created_at})
+
+        owners = [poster_id]
+        if len(friends[poster_id]) > fanout_limit:
+            owners.append(None)
+        else:
+            owners.extend(sorted(friends[poster_id]))
+        entries.extend({'owner_id': owner, 'post_id': post_id, 'poster_id': poster_id}
+                       for owner in owners)
+
+    insert(db, Post, posts)
+    insert(db, Reply, replies)
+    insert(db, Reaction, reactions)
+    insert(db, FeedEntry, entries)
+    db.session.commit()
+    Account.recount_posts()
+    #The friendships were bulk inserted around relationship_bp, so the counts start from scratch.
+    suggestion_count = rebuild(echo=lambda line: None)
+
+    return {'images': len(image_ids), 'accounts': len(accounts),
+            'relationships': len(relationships), 'posts': len(posts), 'replies': len(replies),
+            'reactions': len(reactions), 'feed entries': len(entries),
+            'suggestions': suggestion_count}
+
+def parser():
+    """Returns the command line parser."""
+    args = argparse.ArgumentParser(description=__doc__)
+    args.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                      help="Where the SQLite file and images go (replaced on every run)")
+    args.add_argument('--seed', type=int, default=42)
+    args.add_argument('--accounts', type=int, default=1000)
+    args.add_argument('--friends', type=int, default=3,
+                      help="Friends each new account makes; popular accounts end up with many more")
+    args.add_argument('--posts', type=float, default=10, help="Mean posts per account")
+    args.add_argument('--replies', type=float, default=2, help="Mean replies per post")
+    args.add_argument('--likes', type=float, default=3, help="Mean likes per post")
+    args.add_argument('--share-ratio', type=float, default=0.1, help="Share of posts that share")
+    args.add_argument('--images', type=int, default=20, help="Distinct images to upload")
+    args.add_argument('--image-ratio', type=float, default=0.2,
+                      help="Share of posts with an image")
+    return args
+
+def main():
+    """Entry point of python -m benchmarks.generate."""
+    args = parser().parse_args()
+    began = time.perf_counter()
+    counts = generate(args)
+    print(', '.join(f'{count} {table}' for table, count in counts.items()))
+    print(f"Built in {time.perf_counter() - began:.1f}s at {args.data_dir} "
+          f"(every account's password is '{PASSWORD}').")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""Times the key routes of 'Y' through the Flask test client against the benchmark data set
+and reports latency percentiles and SQL queries per request. Save a run with --json and pass
+it to --compare on a later commit to see what changed. /api/post writes to the benchmark
+database, rebuild it with benchmarks.generate for runs that must be comparable."""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from benchmarks import DEFAULT_DATA_DIR, configure
+
+class QueryCounter:
+    """Counts the SQL statements run on an engine."""
+
+    def __init__(self):
+        """Constructor for QueryCounter."""
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+def percentile(samples, fraction):
+    """Returns the nearest-rank percentile of sorted samples."""
+    index = max(0, min(len(samples) - 1, round(fraction * len(samples) + 0.5) - 1))
+    return samples[index]
+
+def summarize(timings, queries, errors):
+    '''
+    Sums up the measurements of one route.
+    P:
+        timings(list): Seconds per request
+        queries(list): SQL statements per request
+        errors(int): Requests that did not return 2xx or 304
+    R:
+        Dictionary of the statistics (times in milliseconds).
+    '''
+    timings = sorted(timing * 1000 for timing in timings)
+    return {'requests': len(timings), 'errors': errors,
+            'p50': percentile(timings, 0.5), 'p90': percentile(timings, 0.9),
+            'p99': percentile(timings, 0.99), 'mean': sum(timings) / len(timings),
+            'max': timings[-1], 'queriesMean': sum(queries) / len(queries),
+            'queriesMax': max(queries)}
+
+def git_commit():
+    """Returns the current commit of the repository, or None outside git."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def make_routes(rng, usernames, friends, image_ids):
+    '''
+    Builds the requests to time. Each takes a logged in client and the account it is
+        logged in as, and returns the response.
+    P:
+        rng(Random): Seeded generator picking targets
+        usernames(dict): Account id of each client -> its username
+        friends(dict): Account id of each client -> list of its public friends' ids
+        image_ids(list): Img ids to fetch
+    R:
+        Dictionary of route name to request function.
+    '''
+    from benchmarks.generate import PASSWORD
+
+    def friend_of(acc_id):
+        return rng.choice(friends[acc_id]) if friends[acc_id] else acc_id
+
+    routes = {
+        '/profile': lambda client, acc_id: client.get('/profile'),
+        '/timeline/<id>': lambda client, acc_id: client.get(f'/timeline/{friend_of(acc_id)}'),
+        '/friends': lambda client, acc_id: client.get('/friends'),
+        '/api/suggestions': lambda client, acc_id: client.get('/api/suggestions'),
+        '/api/login': lambda client, acc_id: client.post(
+            '/api/login', json={'username': usernames[acc_id], 'password': PASSWORD}),
+        '/api/post': lambda client, acc_id: client.post(
+            '/api/post', data={'textContent': 'Benchmark post', 'postedOnID': acc_id}),
+        '/api/images/<id>': lambda client, acc_id: client.get(
+            f'/api/images/{rng.choice(image_ids)}')
+    }
+    if not image_ids:
+        routes.pop('/api/images/<id>')
+    return routes
+
+def run(args):
+    '''
+    Times every selected route.
+    P:
+        args(Namespace): Parsed command line arguments
+    R:
+        Dictionary with meta (how the run was made) and routes (statistics per route).
+    '''
+    db_path = configure(args.data_dir)
+    if not os.path.exists(db_path):
+        sys.exit(f"No data set at {args.data_dir}, build one with python -m benchmarks.generate")
+
+    from flask import g
+    from flask.testing import FlaskClient
+    from sqlalchemy import event, func
+    from app import app, db
+    from models import Account, Img, Relationship
+    from benchmarks.generate import PASSWORD
+
+    class BenchClient(FlaskClient):
+        """Test client that starts every request with an empty g.
+        app.py pushes an app context for good, so g would otherwise carry over between requests."""
+
+        def open(self, *args, **kwargs):
+            for name in list(vars(g)):
+                delattr(g, name)
+            return super().open(*args, **kwargs)
+
+    app.test_client_class = BenchClient
+    rng = random.Random(args.seed)
+
+    #The most connected accounts plus random ones, so popular and ordinary pages are both timed.
+    by_degree = (db.session.query(Relationship.first_acc_id)
+                 .filter(Relationship.confirmed_relation == True, Relationship.deleted_at == None)
+                 .group_by(Relationship.first_acc_id)
+                 .order_by(func.count().desc(), Relationship.first_acc_id).limit(args.users // 2))
+    users = [row.first_acc_id for row in by_degree]
+    usernames = {row.id: row.username for row in db.session.query(Account.id, Account.username)
+                 .filter(Account.deleted_at == None)}
+    others = sorted(set(usernames) - set(users))
+    users += rng.sample(others, min(len(others), args.users - len(users)))
+    image_ids = [row.id for row in db.session.query(Img.id).filter(Img.deleted_at == None)]
+    #Private timelines are closed to friends too, they would only time the 401.
+    friends = {acc_id: [row.second_acc_id for row in db.session.query(Relationship.second_acc_id)
+                        .join(Account, Account.id == Relationship.second_acc_id)
+                        .filter(Relationship.first_acc_id == acc_id,
+                                Relationship.confirmed_relation == True,
+                                Relationship.deleted_at == None, Account.is_public == True)]
+               for acc_id in users}
+    db.session.remove()
+
+    routes = make_routes(rng, usernames, friends, image_ids)
+    if args.routes:
+        routes = {name: request for name, request in routes.items() if name in args.routes}
+
+    clients = {}
+    for acc_id in users:
+        client = app.test_client()
+        response = client.post('/api/login', json={'username': usernames[acc_id],
+                                                   'password': PASSWORD})
+        if response.status_code != 200:
+            sys.exit(f"Could not log in as {usernames[acc_id]}: {response.status_code}")
+        clients[acc_id] = client
+    db.session.remove()
+
+    counter = QueryCounter()
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    results = {}
+    try:
+        for name, send in routes.items():
+            timings, queries, errors = [], [], 0
+            for index in range(args.warmup + args.iterations):
+                acc_id = users[index % len(users)]
+                counter.count = 0
+                began = time.perf_counter()
+                response = send(clients[acc_id], acc_id)
+                response.get_data()
+                elapsed = time.perf_counter() - began
+                db.session.remove()
+                if index < args.warmup:
+                    continue
+                timings.append(elapsed)
+                queries.append(counter.count)
+                if not (200 <= response.status_code < 300 or response.status_code == 304):
+                    errors += 1
+            results[name] = summarize(timings, queries, errors)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+
+    return {'meta': {'commit': git_commit(), 'database': app.config['SQLALCHEMY_DATABASE_URI'],
+                     'accounts': len(usernames), 'users': len(users),
+                     'iterations': args.iterations, 'seed': args.seed},
+            'routes': results}
+
+def change(new, old):
+    """Formats the change from old to new as a percentage."""
+    if not old:
+        return '   n/a'
+    return f'{(new - old) / old * 100:+5.0f}%'
+
+def report(results, baseline=None):
+    '''
+    Prints the statistics as a table.
+    P:
+        results(dict): Output of run
+        baseline(dict): Output of an earlier run to compare with (optional)
+    '''
+    meta = results['meta']
+    print(f"commit {meta['commit']}, {meta['accounts']} accounts, {meta['users']} users, "
+          f"{meta['iterations']} requests per route")
+    header = f"{'route':<18}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'mean ms':>9}{'max ms':>9}" \
+             f"{'queries':>9}{'max q':>7}{'errors':>8}"
+    if baseline is not None:
+        print(f"compared with commit {baseline['meta'].get('commit')}")
+        header += f"{'p50 chg':>9}{'queries chg':>13}"
+    print(header)
+    for name, stats in results['routes'].items():
+        line = f"{name:<18}{stats['p50']:>9.2f}{stats['p90']:>9.2f}{stats['p99']:>9.2f}" \
+               f"{stats['mean']:>9.2f}{stats['max']:>9.2f}{stats['queriesMean']:>9.1f}" \
+               f"{stats['queriesMax']:>7}{stats['errors']:>8}"
+        old = (baseline or {}).get('routes', {}).get(name)
+        if old is not None:
+            line += f"{change(stats['p50'], old['p50']):>9}" \
+                    f"{change(stats['queriesMean'], old['queriesMean']):>13}"
+        print(line)
+
+def parser():
+    """Returns the command line parser."""
+    args = argparse.ArgumentParser(description=__doc__)
+    args.add_argument('--data-dir', default=DEFAULT_DATA_DIR,
+                      help="Directory of the data set built by benchmarks.generate")
+    args.add_argument('--seed', type=int, default=7)
+    args.add_argument('--iterations', type=int, default=50, help="Timed requests per route")
+    args.add_argument('--warmup', type=int, default=5, help="Untimed requests per route first")
+    args.add_argument('--users', type=int, default=20, help="Accounts the requests are made as")
+    args.add_argument('--routes', nargs='*', help="Only time these routes")
+    args.add_argument('--json', help="Write the results to this file")
+    args.add_argument('--compare', help="Results file of an earlier run to compare with")
+    return args
+
+def main():
+    """Entry point of python -m benchmarks.run."""
+    args = parser().parse_args()
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            baseline = json.load(file)
+    results = run(args)
+    report(results, baseline)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""This is the module for maintenance commands run through the Flask CLI for the Facebook imitation app 'Y'."""
+import click
+from app import app, db
+from sqlalchemy.orm import undefer
+from models import Account, Post, Img
+from image_derivatives import generate_variants
+import migrations
+import purge
+import suggestions
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    '''
+    Recomputes the like and reply counters of every Post from the Reaction and Reply tables,
+        and the post counter of every Account from the Post table.
+    Usage: flask repair-counters
+    '''
+    updated = Post.recount_all()
+    click.echo(f"Recounted likes and replies for {updated} posts.")
+    updated = Account.recount_posts()
+    click.echo(f"Recounted posts for {updated} accounts.")
+
+@app.cli.command('purge')
+@click.option('--retention-days', type=float, default=None,
+              help="Days deleted rows are kept (default PURGE_RETENTION_DAYS).")
+@click.option('--batch-size', type=int, default=None,
+              help="Rows removed per transaction (default PURGE_BATCH_SIZE).")
+@click.option('--pause', type=float, default=None,
+              help="Seconds between transactions (default PURGE_PAUSE).")
+def purge_deleted(retention_days, batch_size, pause):
+    '''
+    Removes rows soft deleted before the retention window and images nothing uses, in batches.
+    Safe to stop and re-run, every committed batch is done.
+    Usage: flask purge [--retention-days N] [--batch-size N] [--pause S]
+    '''
+    removed = purge.purge(retention_days, batch_size, pause, echo=click.echo)
+    click.echo(f"Done, {sum(removed.values())} rows removed.")
+
+@app.cli.group('suggestions')
+def suggestions_group():
+    """Friend suggestion commands."""
+
+@suggestions_group.command('rebuild')
+@click.option('--batch-size', type=int, default=500, help="Accounts recomputed per transaction.")
+def suggestions_rebuild(batch_size):
+    '''
+    Recomputes every account's friend suggestions and mutual friend counts from the friendships.
+    Safe to stop and re-run, every committed batch is done.
+    Usage: flask suggestions rebuild [--batch-size N]
+    '''
+    written = suggestions.rebuild(batch_size, echo=click.echo)
+    click.echo(f"Done, {written} suggestions.")
+
+@app.cli.group('db')
+def db_group():
+    """Schema migration commands."""
+
+@db_group.command('upgrade')
+@click.option('--to', 'target', type=int, default=None, help="Version to upgrade to (default latest).")
+def db_upgrade(target):
+    '''
+    Upgrades the database schema.
+    Usage: flask db upgrade [--to VERSION]
+    '''
+    version = migrations.upgrade(target, echo=click.echo)
+    click.echo(f"Database is at version {version}.")
+
+@db_group.command('downgrade')
+@click.option('--to', 'target', type=int, required=True, help="Version to downgrade to.")
+def db_downgrade(target):
+    '''
+    Downgrades the database schema.
+    Usage: flask db downgrade --to VERSION
+    '''
+    version = migrations.downgrade(target, echo=click.echo)
+    click.echo(f"Database is at version {version}.")
+
+@db_group.command('current')
+def db_current():
+    '''
+    Shows the schema version of the database.
+    Usage: flask db current
+    '''
+    with db.engine.connect() as conn:
+        version = migrations.current_version(conn)
+    if version is None:
+        click.echo("Database is empty.")
+    else:
+        click.echo(f"Database is at version {version} (latest is {migrations.HEAD}).")
+
+@app.cli.group('images')
+def images_group():
+    """Image store commands."""
+
+@images_group.command('migrate')
+@click.option('--batch-size', type=int, default=100, help="Images moved per transaction.")
+def images_migrate(batch_size):
+    '''
+    Moves image bytes still kept in the Img table into the image store, one batch at a time.
+    Safe to stop and re-run, every committed batch is done.
+    Usage: flask images migrate [--batch-size N]
+    '''
+    moved = 0
+    last_id = 0
+    while True:
+        batch = (Img.query.options(undefer(Img.img))
+                 .filter(Img.content_hash == None, Img.id > last_id)
+                 .order_by(Img.id).limit(batch_size).all())
+        if not batch:
+            break
+
+        for img in batch:
+            img.content_hash = Img.create(img.img, img.name, img.mimetype).content_hash
+            img.size = len(img.img)
+            img.img = None
+        last_id = batch[-1].id
+        db.session.commit()
+        #Drop the batch's bytes from the session before loading the next one.
+        db.session.expunge_all()
+
+        moved += len(batch)
+        click.echo(f"Moved {moved} images...")
+
+    click.echo(f"Done, {moved} images moved to the image store.")
+
+@images_group.command('derivatives')
+def images_derivatives():
+    '''
+    Makes any missing resized derivatives for every image in the image store.
+    Usage: flask images derivatives
+    '''
+    hashes = [row.content_hash for row in
+              db.session.query(Img.content_hash).filter(Img.content_hash != None).distinct()]
+    created = 0
+    for content_hash in hashes:
+        try:
+            created += generate_variants(content_hash)
+        except Exception as error:
+            db.session.rollback()
+            click.echo(f"Skipped {content_hash}: {error}")
+    click.echo(f"Done, {created} derivatives made for {len(hashes)} images.")
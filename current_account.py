@@ -0,0 +1,162 @@
+"""This is the module for account lookups of the Facebook imitation app 'Y'.
+Flask-JWT-Extended's user lookup (load_current_account) loads the caller's Account once per
+request (one SELECT by primary key), and every blueprint reads it through
+flask_jwt_extended.current_user. A token whose account no longer exists gets the response of
+handle_missing_account in app.py instead of reaching the view.
+Permission checks and post headers only need a few columns of other accounts; those come from
+AccountSummaryCache, which keeps them for ACCOUNT_CACHE_TTL seconds across requests.
+Changes made in this process invalidate their account right away, so the TTL only bounds how
+long another worker process can see an account's old privacy setting or picture."""
+import time
+from collections import OrderedDict, namedtuple
+from threading import Lock
+from flask import current_app
+from models import db, Account
+
+class AccountSummary(namedtuple('AccountSummary', ['id', 'first_name', 'last_name',
+                                                   'profile_image_id', 'is_public', 'deleted'])):
+    """The columns of an Account that permission checks and post headers use."""
+    __slots__ = ()
+
+    def to_post_data(self):
+        """Same as Account.to_post_data."""
+        return {self.id: self.first_name + " " + self.last_name,
+                str(self.id) + "-p": self.profile_image_id}
+
+    @staticmethod
+    def load(acc_ids):
+        '''
+        Loads the summaries of accounts with one query.
+        P:
+            acc_ids(iterable): Account.ids
+        R:
+            Dictionary of Account.id to AccountSummary (missing accounts are left out).
+        '''
+        rows = db.session.query(Account.id, Account.first_name, Account.last_name,
+                                Account.profile_image_id, Account.is_public, Account.deleted_at
+                                ).filter(Account.id.in_(acc_ids)).all()
+        return {row.id: AccountSummary(row.id, row.first_name, row.last_name,
+                                       row.profile_image_id, bool(row.is_public),
+                                       row.deleted_at is not None)
+                for row in rows}
+
+class AccountSummaryCache:
+    """LRU cache of AccountSummary entries that expire after ttl seconds."""
+
+    def __init__(self, max_entries, ttl):
+        """Constructor for AccountSummaryCache."""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()   #Account.id -> (AccountSummary, loaded at)
+        #Bumped by every invalidation so a load that raced one is not cached.
+        self._generation = 0
+        self._lock = Lock()
+
+    def get_many(self, acc_ids):
+        '''
+        Gets the summaries of accounts, loading the ones not cached with one query.
+        P:
+            acc_ids(iterable): Account.ids
+        R:
+            Dictionary of Account.id to AccountSummary (missing accounts are left out).
+        '''
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for acc_id in {int(acc_id) for acc_id in acc_ids}:
+                entry = self._entries.get(acc_id)
+                if entry is not None and now - entry[1] < self.ttl:
+                    self._entries.move_to_end(acc_id)
+                    found[acc_id] = entry[0]
+                else:
+                    missing.append(acc_id)
+            generation = self._generation
+        if not missing:
+            return found
+
+        loaded = AccountSummary.load(missing)
+        found.update(loaded)
+        with self._lock:
+            if generation == self._generation:
+                for acc_id, summary in loaded.items():
+                    self._entries[acc_id] = (summary, now)
+                    self._entries.move_to_end(acc_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return found
+
+    def invalidate(self, *acc_ids):
+        """Drops the cached summaries of the accounts so their next lookup reloads them."""
+        with self._lock:
+            self._generation += 1
+            for acc_id in acc_ids:
+                self._entries.pop(int(acc_id), None)
+
+    def clear(self):
+        """Drops every cached summary."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+def get_account_cache():
+    """Returns the app's account summary cache, or None when ACCOUNT_CACHE_TTL is 0."""
+    if current_app.config['ACCOUNT_CACHE_TTL'] <= 0:
+        return None
+    cache = current_app.extensions.get('account_cache')
+    if cache is None:
+        cache = AccountSummaryCache(current_app.config['ACCOUNT_CACHE_SIZE'],
+                                    current_app.config['ACCOUNT_CACHE_TTL'])
+        current_app.extensions['account_cache'] = cache
+    return cache
+
+def get_summaries(acc_ids):
+    '''
+    Gets account summaries, through the cache when it is on.
+    P:
+        acc_ids(iterable): Account.ids
+    R:
+        Dictionary of Account.id to AccountSummary (missing accounts are left out).
+    '''
+    acc_ids = list(acc_ids)
+    if not acc_ids:
+        return {}
+    cache = get_account_cache()
+    if cache is None:
+        return AccountSummary.load(acc_ids)
+    return cache.get_many(acc_ids)
+
+def get_summary(acc_id):
+    '''
+    Gets the summary of a live account.
+    P:
+        acc_id(int or string): Account.id (strings from forms are converted)
+    R:
+        AccountSummary, or None if the id is not a number or the account is missing or deleted.
+    '''
+    try:
+        acc_id = int(acc_id)
+    except (TypeError, ValueError):
+        return None
+    summary = get_summaries([acc_id]).get(acc_id)
+    if summary is None or summary.deleted:
+        return None
+    return summary
+
+def invalidate_account(acc_id):
+    """Drops an account's cached summary after a change to it is committed."""
+    cache = current_app.extensions.get('account_cache')
+    if cache is not None:
+        cache.invalidate(acc_id)
+
+def load_current_account(jwt_header, jwt_data):
+    '''
+    Flask-JWT-Extended user lookup, run once per request that verifies a token.
+    P:
+        jwt_header(dict): Header of the token
+        jwt_data(dict): Claims of the token
+    R:
+        The caller's Account (soft deleted ones included, the views check deleted_at),
+            or None if the row does not exist.
+    '''
+    return db.session.get(Account, jwt_data[current_app.config['JWT_IDENTITY_CLAIM']])
@@ -0,0 +1,112 @@
+"""This is the module for retrying database work in the Facebook imitation app 'Y' when the
+connection drops or the database asks for a retry (MySQL 'server has gone away', lost
+connection, deadlock, lock wait timeout; SQLite 'database is locked').
+Every view is wrapped by install_retries. A failed view is rolled back and run again after a
+short, growing, randomized pause, up to DB_RETRY_ATTEMPTS times, when that is safe:
+    GET and HEAD requests are always safe, they only read.
+    Other requests are safe while nothing was committed and the error came from a statement
+        (not from COMMIT, whose outcome is unknown), because the database rolled the
+        transaction back. Requests with file uploads are not retried, the files were read.
+Background jobs get the same rules from run_transaction."""
+import random
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+#MySQL lock wait timeout, deadlock, server has gone away and the two lost connection errors.
+TRANSIENT_CODES = {1205, 1213, 2006, 2013, 2055}
+MAX_DELAY = 1.0
+
+def is_transient(error):
+    """Returns True if the error is a dropped connection or a conflict worth retrying."""
+    if not isinstance(error, DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    args = getattr(error.orig, 'args', ())
+    if args and args[0] in TRANSIENT_CODES:
+        return True
+    return isinstance(error, OperationalError) and 'database is locked' in str(error.orig)
+
+def backoff(attempt):
+    """Sleeps before retry number attempt (1 based): exponential with full jitter, capped."""
+    delay = min(MAX_DELAY, current_app.config['DB_RETRY_BACKOFF'] * 2 ** (attempt - 1))
+    time.sleep(random.uniform(0, delay))
+
+def mark_committed(session):
+    """Notes that the current request or job committed, so it must not be run twice."""
+    if has_app_context() and 'db_committed' in g:
+        g.db_committed = True
+
+def can_retry(error, safe):
+    '''
+    Decides whether failed database work may run again.
+    P:
+        error(Exception): What it raised
+        safe(bool): True if running it twice cannot do harm (reads)
+    '''
+    if not is_transient(error):
+        return False
+    return safe or (not g.get('db_committed') and error.statement is not None)
+
+def retrying(func, safe, *args, **kwargs):
+    '''
+    Runs func, rolling back and running it again while its failures are retryable.
+    P:
+        func(function): The work, which does its own commits
+        safe(bool): True if it may be rerun whatever happened
+    R:
+        What func returns.
+    '''
+    session = current_app.extensions['sqlalchemy'].session
+    attempts = current_app.config['DB_RETRY_ATTEMPTS']
+    for attempt in range(1, attempts + 1):
+        g.db_committed = False
+        try:
+            return func(*args, **kwargs)
+        except DBAPIError as error:
+            session.rollback()
+            if attempt == attempts or not can_retry(error, safe):
+                raise
+            current_app.logger.warning("Retrying %s after a database error (attempt %d): %s",
+                                       getattr(func, '__name__', 'job'), attempt + 1,
+                                       error.orig)
+        backoff(attempt)
+
+def run_transaction(func, *args, **kwargs):
+    '''
+    Runs database work outside a request (needs an app context) with the retry rules of
+        a non-GET request.
+    P:
+        func(function): The work, which commits once at its end
+    R:
+        What func returns.
+    '''
+    try:
+        return retrying(func, False, *args, **kwargs)
+    finally:
+        g.pop('db_committed', None)
+
+def with_retries(view):
+    """Wraps a view function so transient database errors are retried when safe."""
+    @wraps(view)
+    def retried_view(*args, **kwargs):
+        if request.files:
+            return view(*args, **kwargs)
+        return retrying(view, request.method in SAFE_METHODS, *args, **kwargs)
+    return retried_view
+
+def install_retries(app, db):
+    '''
+    Wraps every view of the app. Call after all blueprints are registered.
+    P:
+        app(Flask): The app
+        db(SQLAlchemy): The app's database
+    '''
+    event.listen(db.session, 'after_commit', mark_committed)
+    for endpoint, view in app.view_functions.items():
+        if endpoint != 'static':
+            app.view_functions[endpoint] = with_retries(view)
@@ -0,0 +1,333 @@
+"""This is the module for the notification pub/sub hub of the Facebook imitation app 'Y'.
+Blueprints publish small events to the accounts they concern after committing, and
+events_bp streams them to the browser with Server-Sent Events. Each subscriber has a bounded
+buffer, and the last EVENT_HISTORY_SIZE events of every account are kept so a reconnecting
+stream can resume from its Last-Event-ID.
+Event ids are '<epoch>-<seq>': seq numbers each account's events 1, 2, 3... without gaps, so a
+resuming stream can tell exactly whether events it never got were dropped from the history.
+The epoch names the numbering (a process lifetime, or an event file) and a stream resuming
+from another epoch is told to resync, since its seq says nothing about the current numbering.
+The 'memory' backend only reaches subscribers in its own process. The 'sqlite' backend
+publishes through a SQLite file, so every worker process on the host sees every event."""
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread
+from flask import current_app
+
+#data is the JSON encoded payload so it is only encoded once however many subscribers get it.
+class Event(namedtuple('Event', ['epoch', 'seq', 'account_id', 'type', 'data'])):
+    """One event of an account, seq is its place in the account's numbering of that epoch."""
+    __slots__ = ()
+
+    @property
+    def id(self):
+        """The SSE id the browser sends back as Last-Event-ID."""
+        return f'{self.epoch}-{self.seq}'
+
+EVENT_ID = re.compile(r'([0-9a-f.]+)-([0-9]+)')
+
+def parse_event_id(text):
+    '''
+    Splits a Last-Event-ID.
+    P:
+        text(string): The id the browser sent
+    R:
+        Tuple of (epoch, seq), or None if it is not an id this hub hands out.
+    '''
+    match = EVENT_ID.fullmatch(text.strip())
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+class Subscription:
+    """The bounded buffer of one open event stream."""
+
+    def __init__(self, account_id, buffer_size):
+        """Constructor for Subscription."""
+        self.account_id = account_id
+        self.overflowed = False
+        self._events = deque(maxlen=buffer_size)
+        self._ready = Condition()
+
+    def put(self, event):
+        """Buffers an event, dropping the oldest one if the stream is not keeping up."""
+        with self._ready:
+            if len(self._events) == self._events.maxlen:
+                self.overflowed = True
+            self._events.append(event)
+            self._ready.notify()
+
+    def get(self, timeout):
+        '''
+        Waits for events.
+        P:
+            timeout(float): Seconds to wait
+        R:
+            List of buffered Events (empty if the timeout passed first).
+        '''
+        with self._ready:
+            if not self._events:
+                self._ready.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+class EventHub:
+    '''
+    In-process hub (the 'memory' backend) and the base of the other backends.
+    History is kept for the history_accounts accounts that got events most recently. Each
+        history starts a new epoch (a random boot id and a counter), so streams resuming from
+        before a restart or from a history that was dropped are told to resync.
+    '''
+    history_accounts = 10000
+
+    def __init__(self, buffer_size, history_size):
+        '''
+        Constructor for EventHub.
+        P:
+            buffer_size(int): Events a subscriber can fall behind before it must resync
+            history_size(int): Events kept per account for resuming streams
+        '''
+        self.buffer_size = buffer_size
+        self.history_size = history_size
+        self._lock = Lock()
+        self._subscribers = {}
+        self._history = OrderedDict()   #Account.id -> (epoch, deque of Events)
+        self.boot_id = os.urandom(4).hex()
+        self._epochs = 0
+
+    def publish(self, account_ids, event_type, data):
+        '''
+        Sends an event to every open stream of the accounts.
+        P:
+            account_ids(iterable): Account.ids the event is for
+            event_type(string): Name of the event (the SSE event field)
+            data(string): JSON encoded payload
+        '''
+        with self._lock:
+            for account_id in set(account_ids):
+                self._deliver(account_id, event_type, data)
+
+    def _deliver(self, account_id, event_type, data):
+        """Numbers an event after its account's last one, records it in the account's history
+        and hands it to the account's streams."""
+        entry = self._history.get(account_id)
+        if entry is None:
+            self._epochs += 1
+            entry = self._history[account_id] = (f'{self.boot_id}.{self._epochs}',
+                                                 deque(maxlen=self.history_size))
+            if len(self._history) > self.history_accounts:
+                self._history.popitem(last=False)
+        else:
+            self._history.move_to_end(account_id)
+        epoch, history = entry
+        event = Event(epoch, history[-1].seq + 1 if history else 1, account_id, event_type, data)
+        history.append(event)
+        for subscription in self._subscribers.get(account_id, ()):
+            subscription.put(event)
+
+    def subscribe(self, account_id, last_event_id=None):
+        '''
+        Opens a subscription for an account.
+        P:
+            account_id(int): Account.id of the listener
+            last_event_id(string): Id of the last event the stream received
+                (None for a new stream)
+        R:
+            Tuple of (Subscription, list of missed Events to send first,
+                True if events were lost and the client has to reload instead).
+        '''
+        subscription = Subscription(account_id, self.buffer_size)
+        with self._lock:
+            self._subscribers.setdefault(account_id, []).append(subscription)
+            if last_event_id is None:
+                return subscription, [], False
+            epoch, history = self._history.get(account_id, (None, ()))
+            history = list(history)
+        return (subscription, *self._resume(epoch, history, last_event_id))
+
+    @staticmethod
+    def _resume(epoch, history, last_event_id):
+        '''
+        Works out what a resuming stream missed.
+        P:
+            epoch(string): Epoch of the account's history (None if it has none)
+            history(list): The account's kept Events, oldest first
+            last_event_id(string): Id of the last event the stream received
+        R:
+            Tuple of (missed Events, True if the client has to reload instead).
+        '''
+        last = parse_event_id(last_event_id)
+        if last is None or not history or last[0] != epoch or last[1] > history[-1].seq:
+            return [], True
+        #seq has no gaps, so a history starting past the next one means events were dropped.
+        return ([event for event in history if event.seq > last[1]],
+                history[0].seq > last[1] + 1)
+
+    def unsubscribe(self, subscription):
+        """Closes a subscription."""
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.account_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscribers.pop(subscription.account_id, None)
+
+    def subscriber_count(self):
+        """Returns the number of open subscriptions in this process."""
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscribers.values())
+
+class SQLiteEventHub(EventHub):
+    '''
+    Hub shared by the worker processes of one host through a SQLite file (the 'sqlite' backend).
+    Publishing inserts the events, numbering each after its account's last row; a thread in
+        each process tails the table every poll_interval seconds and delivers new rows to the
+        process's own subscribers. The epoch is made with the file, so its ids survive restarts.
+        Rows past an account's history are only trimmed once they are min_age seconds old,
+        so a busy account cannot trim events before the other processes have read them.
+    '''
+    poll_interval = 0.5
+    min_age = 60
+
+    def __init__(self, path, buffer_size, history_size):
+        '''
+        Constructor for SQLiteEventHub.
+        P:
+            path(string): The SQLite file (created if missing)
+            buffer_size(int): Events a subscriber can fall behind before it must resync
+            history_size(int): Events kept per account for resuming streams
+        '''
+        super().__init__(buffer_size, history_size)
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(event)')]
+            if columns and 'seq' not in columns:
+                #Files from before per-account numbering; events are short lived, start over.
+                conn.execute('DROP TABLE event')
+                conn.execute('DROP TABLE IF EXISTS epoch')
+            conn.execute('CREATE TABLE IF NOT EXISTS event (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                         ' account_id INTEGER NOT NULL, seq INTEGER NOT NULL, type TEXT NOT NULL,'
+                         ' data TEXT NOT NULL, created REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_event_account ON event (account_id, id)')
+            conn.execute('CREATE TABLE IF NOT EXISTS epoch (epoch TEXT NOT NULL)')
+            #The first process to open the file picks the epoch, the others read it.
+            conn.execute('INSERT INTO epoch SELECT ? WHERE NOT EXISTS (SELECT 1 FROM epoch)',
+                         (os.urandom(4).hex(),))
+            self.epoch = conn.execute('SELECT epoch FROM epoch').fetchone()[0]
+            self._last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM event').fetchone()[0]
+        self._tailer = None
+
+    @contextmanager
+    def _connect(self):
+        """Opens a connection to the event file for one transaction (connections are cheap)."""
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def publish(self, account_ids, event_type, data):
+        account_ids = set(account_ids)
+        now = time.time()
+        with self._connect() as conn:
+            #One statement per row, so the seq it reads and the row it writes are one step.
+            conn.executemany('INSERT INTO event (account_id, seq, type, data, created)'
+                             ' SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? FROM event'
+                             ' WHERE account_id = ?',
+                             [(account_id, event_type, data, now, account_id)
+                              for account_id in account_ids])
+            #Trim each account back to its history, the index makes this a short range scan.
+            conn.executemany('DELETE FROM event WHERE account_id = ? AND created < ? AND id <='
+                             ' (SELECT id FROM event WHERE account_id = ?'
+                             ' ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                             [(account_id, now - self.min_age, account_id, self.history_size)
+                              for account_id in account_ids])
+
+    def subscribe(self, account_id, last_event_id=None):
+        self._start_tailer()
+        subscription = Subscription(account_id, self.buffer_size)
+        with self._lock:
+            self._subscribers.setdefault(account_id, []).append(subscription)
+        if last_event_id is None:
+            return subscription, [], False
+
+        with self._connect() as conn:
+            rows = conn.execute('SELECT seq, account_id, type, data FROM event'
+                                ' WHERE account_id = ? ORDER BY id DESC LIMIT ?',
+                                (account_id, self.history_size)).fetchall()
+        history = [Event(self.epoch, *row) for row in reversed(rows)]
+        #Live events already in the backlog are skipped by the stream, it tracks the last one sent.
+        return (subscription, *self._resume(self.epoch, history, last_event_id))
+
+    def _start_tailer(self):
+        """Starts the thread that delivers events from the file, once per process."""
+        with self._lock:
+            if self._tailer is None or not self._tailer.is_alive():
+                self._tailer = Thread(target=self._tail, name='event-hub-tail', daemon=True)
+                self._tailer.start()
+
+    def _tail(self):
+        """Delivers new rows of the event table to this process's subscribers, forever."""
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with self._connect() as conn:
+                    rows = conn.execute('SELECT id, seq, account_id, type, data FROM event'
+                                        ' WHERE id > ? ORDER BY id', (self._last_id,)).fetchall()
+            except sqlite3.Error:
+                continue
+            with self._lock:
+                for row in rows:
+                    self._last_id = row[0]
+                    event = Event(self.epoch, *row[1:])
+                    for subscription in self._subscribers.get(event.account_id, ()):
+                        subscription.put(event)
+
+#EVENT_HUB_BACKEND name -> factory taking the app config.
+BACKENDS = {
+    'memory': lambda config: EventHub(config['EVENT_BUFFER_SIZE'], config['EVENT_HISTORY_SIZE']),
+    'sqlite': lambda config: SQLiteEventHub(config['EVENT_HUB_PATH']
+                                            or os.path.join(current_app.instance_path,
+                                                            'events.sqlite3'),
+                                            config['EVENT_BUFFER_SIZE'],
+                                            config['EVENT_HISTORY_SIZE'])
+}
+
+def get_hub():
+    """Returns the event hub configured for the current app, creating it on first use."""
+    hub = current_app.extensions.get('event_hub')
+    if hub is None:
+        backend = current_app.config['EVENT_HUB_BACKEND']
+        if backend not in BACKENDS:
+            raise RuntimeError(f"Unknown EVENT_HUB_BACKEND '{backend}'.")
+        hub = BACKENDS[backend](current_app.config)
+        current_app.extensions['event_hub'] = hub
+    return hub
+
+def publish(account_ids, event_type, actor_id=None, **data):
+    '''
+    Publishes an event to accounts, leaving out the one who caused it.
+    Call after the change is committed. A failing hub is logged instead of failing the request.
+    P:
+        account_ids(iterable): Account.ids the event is for
+        event_type(string): Name of the event
+        actor_id(int): Account.id that caused the event (sent as 'from', never notified)
+        data: Other payload fields, keep them to ids
+    '''
+    account_ids = [account_id for account_id in account_ids if account_id != actor_id]
+    if not account_ids:
+        return
+    if actor_id is not None:
+        data['from'] = actor_id
+    try:
+        get_hub().publish(account_ids, event_type, current_app.json.dumps(data))
+    except sqlite3.Error as error:
+        current_app.logger.warning("Could not publish %s event: %s", event_type, error)
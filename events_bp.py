@@ -0,0 +1,75 @@
+"""This is the driving module for the notification stream in the Facebook imitation app 'Y'.
+A stream holds its worker thread for as long as it is open, so run the app with a threaded
+or async server when many users are online."""
+from flask import current_app, request, Response, Blueprint
+from flask_jwt_extended import (get_jwt_identity, jwt_required)
+from event_hub import get_hub
+
+events_bp = Blueprint('events', __name__)
+
+def format_event(event_id, event_type, data):
+    """Returns one Server-Sent Event in wire format."""
+    lines = [] if event_id is None else [f'id: {event_id}']
+    lines.append(f'event: {event_type}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
+
+def event_stream(hub, subscription, backlog, resync, heartbeat):
+    '''
+    Generates the body of an event stream until the client goes away.
+    P:
+        hub(EventHub): The hub the subscription belongs to (unsubscribed when the stream ends)
+        subscription(Subscription): The stream's buffer
+        backlog(list): Missed Events to send first
+        resync(bool): True to first tell the client events were lost
+        heartbeat(int): Seconds between keep-alive comments when nothing happens
+    '''
+    try:
+        yield 'retry: 3000\n\n'
+        if resync:
+            yield format_event(None, 'resync', '{}')
+        last_sent = None
+        for event in backlog:
+            yield format_event(event.id, event.type, event.data)
+            last_sent = event
+
+        while True:
+            events = subscription.get(heartbeat)
+            if subscription.overflowed:
+                subscription.overflowed = False
+                yield format_event(None, 'resync', '{}')
+            if not events:
+                #Writing is also how a closed connection is noticed.
+                yield ': keep-alive\n\n'
+            for event in events:
+                #The backlog and the live buffer can overlap right after subscribing.
+                #A new epoch (the account's history was dropped) numbers from 1 again.
+                if (last_sent is None or event.epoch != last_sent.epoch
+                        or event.seq > last_sent.seq):
+                    yield format_event(event.id, event.type, event.data)
+                    last_sent = event
+    finally:
+        hub.unsubscribe(subscription)
+
+@events_bp.route('/api/events')
+@jwt_required()
+def get_events():
+    '''
+    Streams the current user's notifications as Server-Sent Events.
+    Events are friendRequest, friendAccepted, timelinePost, reply and like with compact JSON
+        payloads of ids. A reconnecting EventSource sends the Last-Event-ID header (or
+        lastEventId in the query string) to get the events it missed. A resync event means
+        events were lost and the page should be reloaded.
+    '''
+    #An id the hub cannot place (another process lifetime, a malformed one) means resync.
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+
+    hub = get_hub()
+    subscription, backlog, resync = hub.subscribe(get_jwt_identity(), last_event_id)
+    response = Response(event_stream(hub, subscription, backlog, resync,
+                                     current_app.config['EVENT_HEARTBEAT']),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    #Keeps nginx from buffering the stream.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
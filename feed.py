@@ -0,0 +1,71 @@
+"""This is the module for the materialized news feed of the Facebook imitation app 'Y'.
+make_post fans a new post out to the poster's confirmed friends (fan-out-on-write). Posters
+with more than FEED_FANOUT_LIMIT friends get a single ownerless entry that their friends pull
+in when reading (fan-in-on-read)."""
+from flask import current_app
+from models import db, Post, FeedEntry
+from social_graph import get_graph
+
+def fan_out_post(post):
+    '''
+    Adds a new post to the feeds of its poster and the poster's friends.
+    Runs in the caller's transaction, the caller commits.
+    P:
+        post(Post): The post (flushed so it has an id)
+    '''
+    friends = get_graph().get(post.poster_id).friends
+    owners = [post.poster_id]
+    if len(friends) > current_app.config['FEED_FANOUT_LIMIT']:
+        owners.append(None)
+    else:
+        owners.extend(friends)
+
+    db.session.execute(db.insert(FeedEntry), [
+        {'owner_id': owner, 'post_id': post.id, 'poster_id': post.poster_id} for owner in owners
+    ])
+
+def feed_query(before):
+    """Starts a query for live feed posts older than the cursor, newest first."""
+    reply_limit = current_app.config['TIMELINE_REPLY_LIMIT']
+    query = (Post.query.options(*Post.loading(replies='selectin' if reply_limit == 0 else 'none'))
+             .join(FeedEntry, FeedEntry.post_id == Post.id).filter(Post.deleted_at == None))
+    if before is not None:
+        query = query.filter(FeedEntry.post_id < before)
+    return query.order_by(FeedEntry.post_id.desc())
+
+def get_feed_page(acc_id, before=None):
+    '''
+    Gets a single page of an account's news feed using keyset pagination on Post.id.
+    The account's own entries are one range scan of ux_feed_entry_owner_post.
+    P:
+        acc_id(int): Account.id of the reader
+        before(int): Cursor from the previous page (None for the first page)
+    R:
+        Tuple of (list of Posts newest first by the reader or current friends,
+            cursor for the next page or None if this is the last).
+    '''
+    page_size = current_app.config['TIMELINE_PAGE_SIZE']
+    friends = get_graph().get(acc_id).friends
+
+    page = feed_query(before).filter(FeedEntry.owner_id == acc_id).limit(page_size + 1).all()
+    if friends:
+        #Posts from friends that were too popular to fan out.
+        pulled = (feed_query(before).filter(FeedEntry.owner_id == None,
+                                            FeedEntry.poster_id.in_(friends))
+                  .limit(page_size + 1).all())
+        if pulled:
+            merged = {post.id: post for post in page + pulled}
+            page = sorted(merged.values(), key=lambda post: post.id, reverse=True)[:page_size + 1]
+
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = page[-1].id
+
+    #Entries stay behind after an unfriend, feed_bp rechecks the timelines they are on.
+    page = [post for post in page if post.poster_id == acc_id or post.poster_id in friends]
+
+    reply_limit = current_app.config['TIMELINE_REPLY_LIMIT']
+    if reply_limit > 0:
+        Post.load_latest_replies(page, reply_limit)
+    return page, next_cursor
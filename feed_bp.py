@@ -0,0 +1,82 @@
+"""This is the driving module for the news feed pages in the Facebook imitation app 'Y'."""
+from flask import request, jsonify, render_template, make_response, url_for, Blueprint
+from flask_jwt_extended import (current_user, get_jwt_identity, jwt_required)
+from feed import get_feed_page
+from pages_bp import get_friends_and_postable, process_timeline
+from pst_rep_rea_bp import content_permissions
+from social_graph import get_graph
+
+feed_bp = Blueprint('feed', __name__)
+
+def get_visible_feed_page(acc_id, before):
+    '''
+    Gets a page of the feed without posts on timelines the reader may no longer open.
+    can_make_content is checked once per distinct timeline on the page, with one account query.
+    P:
+        acc_id(int): Account.id of the reader
+        before(int): Cursor from the previous page (None for the first page)
+    R:
+        Same as feed.get_feed_page.
+    '''
+    page, next_cursor = get_feed_page(acc_id, before)
+    permissions = content_permissions({post.posted_on_id for post in page}, acc_id)
+    return [post for post in page if permissions[post.posted_on_id] == 1], next_cursor
+
+def feed_context(acc, before):
+    '''
+    Builds the template fields for a page of an account's feed.
+    P:
+        acc(Account): The reader
+        before(int): Cursor from the previous page (None for the first page)
+    R:
+        Dictionary of template fields, including nextCursor.
+    '''
+    raw_feed, next_cursor = get_visible_feed_page(acc.id, before)
+    friends, postable = get_friends_and_postable(acc)
+    context = {'account': acc.to_dict(), 'friends': friends, 'postable': postable,
+               'pageOwner': acc.id, 'user': acc, 'nextCursor': next_cursor, 'feed': True,
+               'morePath': url_for('feed.feed_more')}
+    context.update(process_timeline(raw_feed, acc.id, get_graph().get(acc.id).ever_friends))
+    return context
+
+@feed_bp.route('/feed')
+@jwt_required()
+def feed_page():
+    """Renders the news feed of the current user."""
+    return render_template('profile.html',
+                           **feed_context(current_user, request.args.get('before', type=int)))
+
+@feed_bp.route('/feed/more')
+@jwt_required()
+def feed_more():
+    '''
+    Renders the next page of the current user's news feed.
+    Request args are expected to have before(int): the cursor handed out with the previous page.
+    R:
+        The rendered posts with the cursor for the following page in the X-Next-Cursor header
+            (empty if there are no more posts).
+    '''
+    before = request.args.get('before', type=int)
+    if before is None:
+        err = jsonify({'message': "A cursor is required."})
+        err.status_code = 400
+        return err
+
+    context = feed_context(current_user, before)
+    response = make_response(render_template('timeline_posts.html', **context))
+    next_cursor = context['nextCursor']
+    response.headers['X-Next-Cursor'] = '' if next_cursor is None else str(next_cursor)
+    return response
+
+@feed_bp.route('/api/feed')
+@jwt_required()
+def get_feed():
+    '''
+    Returns a page of the current user's news feed.
+    Request args may have before(int): the cursor handed out with the previous page.
+    R:
+        JSON with posts (list of Post.to_dict) and nextCursor (null on the last page).
+    '''
+    posts, next_cursor = get_visible_feed_page(get_jwt_identity(),
+                                               request.args.get('before', type=int))
+    return jsonify({'posts': [post.to_dict() for post in posts], 'nextCursor': next_cursor})
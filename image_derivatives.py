@@ -0,0 +1,118 @@
+"""This is the module for generating resized image derivatives in the Facebook imitation app 'Y'.
+Uploads are queued to a worker pool after they are committed. get_img serves the original
+until a derivative exists."""
+import io
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from flask import current_app
+from PIL import Image, ImageOps
+from sqlalchemy.exc import IntegrityError
+from models import db, ImgVariant
+from image_store import get_store
+
+#variant name -> (width, height, crop to fill). Non-cropped variants keep their aspect ratio.
+VARIANTS = {
+    'avatar': (64, 64, True),
+    'thumb': (160, 160, True),
+    'feed': (600, 600, False)
+}
+VARIANT_FORMAT = 'WEBP'
+VARIANT_MIMETYPE = 'image/webp'
+
+#Content hashes that already have a job queued, so repeat uploads are not processed twice.
+_queued = set()
+_queued_lock = Lock()
+
+def render_variant(data, variant):
+    '''
+    Resizes and re-encodes an image.
+    P:
+        data(bytes): The original image
+        variant(string): Key of VARIANTS
+    R:
+        The encoded derivative bytes.
+    '''
+    width, height, crop = VARIANTS[variant]
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        if crop:
+            image = ImageOps.fit(image, (width, height), Image.Resampling.LANCZOS)
+        else:
+            image.thumbnail((width, height), Image.Resampling.LANCZOS)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        out = io.BytesIO()
+        image.save(out, VARIANT_FORMAT, quality=current_app.config['IMAGE_VARIANT_QUALITY'])
+        return out.getvalue()
+
+def generate_variants(source_hash):
+    '''
+    Makes every missing derivative of a stored image.
+    P:
+        source_hash(string): Content hash of the original image
+    R:
+        Number of derivatives created.
+    '''
+    existing = {row.variant for row in
+                db.session.query(ImgVariant.variant).filter_by(source_hash=source_hash).all()}
+    missing = [variant for variant in VARIANTS if variant not in existing]
+    if not missing:
+        return 0
+
+    store = get_store()
+    data = store.read(source_hash)
+    for variant in missing:
+        encoded = render_variant(data, variant)
+        db.session.add(ImgVariant(source_hash, variant, store.save(encoded),
+                                  VARIANT_MIMETYPE, len(encoded)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        #Another worker made them first.
+        db.session.rollback()
+        return 0
+    return len(missing)
+
+def get_pool():
+    """Returns the app's derivative worker pool, creating it on first use."""
+    pool = current_app.extensions.get('image_workers')
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=current_app.config['IMAGE_WORKERS'],
+                                  thread_name_prefix='image-derivatives')
+        current_app.extensions['image_workers'] = pool
+    return pool
+
+def queue_variants(img):
+    '''
+    Queues derivative generation for a committed Img. Returns right away, unless IMAGE_WORKERS
+        is 0, in which case the derivatives are made inline before returning.
+    P:
+        img(Img): The uploaded image
+    '''
+    if img.content_hash is None:
+        return
+    with _queued_lock:
+        if img.content_hash in _queued:
+            return
+        _queued.add(img.content_hash)
+    app = current_app._get_current_object()
+    if app.config['IMAGE_WORKERS'] < 1:
+        #_run_job's own app context keeps its session apart from the request's.
+        _run_job(app, img.content_hash)
+        return
+    get_pool().submit(_run_job, app, img.content_hash)
+
+def _run_job(app, source_hash):
+    """Worker side of queue_variants, runs in its own app context and DB session."""
+    try:
+        with app.app_context():
+            try:
+                generate_variants(source_hash)
+            except Exception as error:
+                #A broken upload should not take the worker down, the original is still served.
+                app.logger.warning("Could not make derivatives of %s: %s", source_hash, error)
+                db.session.rollback()
+    finally:
+        with _queued_lock:
+            _queued.discard(source_hash)
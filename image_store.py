@@ -0,0 +1,101 @@
+"""This is the module for image storage backends in the Facebook imitation app 'Y'.
+Img rows only keep metadata and the sha256 of the bytes, the bytes live in the configured store."""
+import hashlib
+import os
+import tempfile
+from flask import current_app
+
+class ImageStore:
+    """Interface every image storage backend implements. Images are addressed by content hash."""
+
+    def save(self, data):
+        '''
+        Stores image bytes.
+        P:
+            data(bytes): The image
+        R:
+            The content hash the image can be retrieved with.
+        '''
+        raise NotImplementedError
+
+    def read(self, content_hash):
+        """Returns the bytes stored under the content hash."""
+        raise NotImplementedError
+
+    def path(self, content_hash):
+        '''
+        Returns a local file path for the content hash so it can be streamed with send_file,
+            or None if the backend has no local files.
+        '''
+        return None
+
+    def exists(self, content_hash):
+        """Returns True if the content hash is in the store."""
+        raise NotImplementedError
+
+    def delete(self, content_hash):
+        """Removes the content hash from the store (callers check that no Img still uses it)."""
+        raise NotImplementedError
+
+    @staticmethod
+    def hash_of(data):
+        """Returns the content hash of the bytes."""
+        return hashlib.sha256(data).hexdigest()
+
+class LocalImageStore(ImageStore):
+    """Stores images as files under a root directory, fanned out by hash prefix."""
+
+    def __init__(self, root):
+        """Constructor for LocalImageStore."""
+        self.root = root
+
+    def path(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def save(self, data):
+        content_hash = self.hash_of(data)
+        target = self.path(content_hash)
+        #Same bytes means same file, nothing to write.
+        if os.path.exists(target):
+            return content_hash
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        #Write then rename so a reader never sees a half written file.
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target))
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return content_hash
+
+    def read(self, content_hash):
+        with open(self.path(content_hash), 'rb') as image_file:
+            return image_file.read()
+
+    def exists(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def delete(self, content_hash):
+        if self.exists(content_hash):
+            os.remove(self.path(content_hash))
+
+#IMAGE_STORE_BACKEND name -> factory taking the app config.
+BACKENDS = {
+    'local': lambda config: LocalImageStore(config['IMAGE_STORE_PATH']
+                                            or os.path.join(current_app.instance_path, 'images'))
+}
+
+def get_store():
+    """Returns the image store configured for the current app, creating it on first use."""
+    store = current_app.extensions.get('image_store')
+    if store is None:
+        backend = current_app.config['IMAGE_STORE_BACKEND']
+        if backend not in BACKENDS:
+            raise RuntimeError(f"Unknown IMAGE_STORE_BACKEND '{backend}'.")
+        store = BACKENDS[backend](current_app.config)
+        current_app.extensions['image_store'] = store
+    return store
@@ -0,0 +1,286 @@
+"""This is the module for request instrumentation of the Facebook imitation app 'Y'.
+SQLAlchemy cursor events count and time every statement a request runs. Per request this gives
+the query count, the time spent in the database, the slowest statements and how often each
+statement shape repeated; a shape repeating SQL_REPEAT_THRESHOLD times usually means a lookup
+inside a loop (N+1) and is logged. Statements slower than SQL_SLOW_QUERY_MS are logged too.
+In debug mode (or with SQL_DEBUG_HEADERS=1) the numbers are sent back as response headers, and
+metrics_bp serves per blueprint latency and query histograms in the Prometheus text format.
+The metrics are kept per worker process, Prometheus adds them up across scrape targets."""
+import heapq
+import re
+import time
+from bisect import bisect_left
+from threading import Lock
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+SLOWEST_KEPT = 3
+
+#Expanded IN lists and literal numbers, so statements that only differ in them match.
+IN_LIST = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)')
+NUMBER = re.compile(r'\b\d+\b')
+SPACES = re.compile(r'\s+')
+
+def fingerprint(statement):
+    """Returns the shape of a SQL statement with whitespace, IN lists and numbers collapsed."""
+    statement = SPACES.sub(' ', statement).strip()
+    return NUMBER.sub('?', IN_LIST.sub('(...)', statement))
+
+class RequestStats:
+    """The statements run while handling one request."""
+
+    def __init__(self):
+        """Constructor for RequestStats."""
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = {}    #fingerprint -> [times run, seconds]
+        self.slowest = []   #min-heap of (seconds, statement), the SLOWEST_KEPT slowest
+
+    def record(self, statement, seconds):
+        '''
+        Adds a statement that finished.
+        P:
+            statement(string): The SQL sent to the database
+            seconds(float): How long it took
+        '''
+        self.count += 1
+        self.seconds += seconds
+        shape = self.shapes.setdefault(fingerprint(statement), [0, 0.0])
+        shape[0] += 1
+        shape[1] += seconds
+        if len(self.slowest) < SLOWEST_KEPT:
+            heapq.heappush(self.slowest, (seconds, statement))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, statement))
+
+    def repeated(self, threshold):
+        '''
+        Gets the statement shapes run at least threshold times, the likely N+1 patterns.
+        R:
+            List of (fingerprint, times run, seconds), most repeated first.
+        '''
+        return sorted(((shape, runs, seconds) for shape, (runs, seconds) in self.shapes.items()
+                       if runs >= threshold), key=lambda item: -item[1])
+
+    def max_repeats(self):
+        """Returns how often the most repeated statement shape ran."""
+        return max((runs for runs, _ in self.shapes.values()), default=0)
+
+class Metric:
+    '''
+    A Prometheus counter, gauge or histogram with labels, safe to update from any thread.
+    Histograms take the upper bounds of their buckets; the others leave buckets out.
+    '''
+
+    def __init__(self, name, kind, help_text, label_names, buckets=None):
+        '''
+        Constructor for Metric.
+        P:
+            name(string): Metric name
+            kind(string): counter, gauge or histogram
+            help_text(string): Description shown by Prometheus
+            label_names(tuple): Names of the labels every value has
+            buckets(tuple): Upper bounds of the histogram buckets
+        '''
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._values = {}   #label values -> number, or [bucket counts, sum, count]
+        self._lock = Lock()
+
+    def inc(self, labels, amount=1):
+        """Adds to a counter."""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, labels, value):
+        """Sets a gauge."""
+        with self._lock:
+            self._values[labels] = value
+
+    def observe(self, labels, value):
+        """Adds a measurement to a histogram."""
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        """Returns the metric in the Prometheus text format."""
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            pairs = ','.join(f'{name}="{escape(label)}"'
+                             for name, label in zip(self.label_names, labels))
+            if self.kind != 'histogram':
+                lines.append(f'{self.name}{{{pairs}}} {value}' if pairs
+                             else f'{self.name} {value}')
+                continue
+            counts, total, count = value
+            prefix = pairs + ',' if pairs else ''
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            suffix = f'{{{pairs}}}' if pairs else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+        return '\n'.join(lines)
+
+def escape(label):
+    """Escapes a label value for the Prometheus text format."""
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metrics:
+    """The metrics of the app, filled in by the request and cursor hooks."""
+
+    def __init__(self):
+        """Constructor for Metrics."""
+        self.request_seconds = Metric('y_request_duration_seconds', 'histogram',
+                                      'Time to handle a request.', ('blueprint',),
+                                      LATENCY_BUCKETS)
+        self.request_queries = Metric('y_request_queries', 'histogram',
+                                      'SQL statements run by a request.', ('blueprint',),
+                                      QUERY_BUCKETS)
+        self.responses = Metric('y_responses_total', 'counter', 'Responses sent.',
+                                ('blueprint', 'status'))
+        self.db_seconds = Metric('y_db_seconds_total', 'counter',
+                                 'Time spent running SQL statements.', ('blueprint',))
+        self.slow_queries = Metric('y_db_slow_queries_total', 'counter',
+                                   'Statements slower than SQL_SLOW_QUERY_MS.', ('blueprint',))
+        self.repeated = Metric('y_db_repeated_statement_requests_total', 'counter',
+                               'Requests that repeated a statement SQL_REPEAT_THRESHOLD times.',
+                               ('blueprint', 'endpoint'))
+        self.hash_jobs = Metric('y_password_hash_jobs_total', 'counter',
+                                'Password hashes and checks, by outcome.', ('outcome',))
+        self.hash_seconds = Metric('y_password_hash_seconds_total', 'counter',
+                                   'Time callers waited on bcrypt.', ())
+        self.hash_in_flight = Metric('y_password_hash_in_flight', 'gauge',
+                                     'Password jobs running or queued.', ())
+        self.event_streams = Metric('y_event_streams', 'gauge', 'Open event streams.', ())
+
+    def all(self):
+        """Returns every metric."""
+        return (self.request_seconds, self.request_queries, self.responses, self.db_seconds,
+                self.slow_queries, self.repeated, self.hash_jobs, self.hash_seconds,
+                self.hash_in_flight, self.event_streams)
+
+    def collect(self, app):
+        """Reads the state of the app's password hasher and event hub, if they were started."""
+        hasher = app.extensions.get('password_hasher')
+        if hasher is not None:
+            stats = hasher.stats()
+            self.hash_jobs.set(('completed',), stats['completed'])
+            self.hash_jobs.set(('rejected',), stats['rejected'])
+            self.hash_seconds.set((), stats['seconds'])
+            self.hash_in_flight.set((), stats['in_flight'])
+        hub = app.extensions.get('event_hub')
+        if hub is not None:
+            self.event_streams.set((), hub.subscriber_count())
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        return '\n'.join(metric.render() for metric in self.all()) + '\n'
+
+def blueprint_label():
+    """Returns the blueprint of the current request (app for routes of the app itself)."""
+    if not has_request_context():
+        return 'none'
+    return request.blueprint or 'app'
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Notes when a statement starts. A stack, cursor events can nest."""
+    conn.info.setdefault('y_query_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Adds a finished statement to the request's stats and logs it if it was slow."""
+    started = conn.info.get('y_query_started')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    if not has_app_context():
+        return
+    if has_request_context() and 'sql_stats' in g:
+        g.sql_stats.record(statement, seconds)
+    if seconds * 1000 >= current_app.config['SQL_SLOW_QUERY_MS']:
+        current_app.extensions['metrics'].slow_queries.inc((blueprint_label(),))
+        current_app.logger.warning("Slow query (%.0f ms) in %s: %s", seconds * 1000,
+                                   request.endpoint if has_request_context() else 'background',
+                                   SPACES.sub(' ', statement))
+
+def handle_error(context):
+    """Forgets the start of a statement that failed (after_cursor_execute is not called)."""
+    started = context.connection.info.get('y_query_started') if context.connection else None
+    if started:
+        started.pop()
+
+def start_request():
+    """Gives the request empty stats (g outlives requests when an app context was pushed)."""
+    g.sql_stats = RequestStats()
+    g.request_started = time.perf_counter()
+
+def finish_request(response):
+    '''
+    Records the request's metrics, logs repeated statements and adds the debug headers.
+    P:
+        response: The response about to be returned
+    R:
+        The response.
+    '''
+    stats = g.pop('sql_stats', None)
+    started = g.pop('request_started', None)
+    if stats is None or started is None:
+        return response
+    metrics = current_app.extensions['metrics']
+    label = (blueprint_label(),)
+    metrics.request_seconds.observe(label, time.perf_counter() - started)
+    metrics.request_queries.observe(label, stats.count)
+    metrics.responses.inc((label[0], str(response.status_code)))
+    metrics.db_seconds.inc(label, stats.seconds)
+
+    repeated = stats.repeated(current_app.config['SQL_REPEAT_THRESHOLD'])
+    if repeated:
+        metrics.repeated.inc((label[0], request.endpoint or 'none'))
+        for shape, runs, seconds in repeated:
+            current_app.logger.warning("Possible N+1 in %s: ran %d times (%.1f ms): %s",
+                                       request.endpoint, runs, seconds * 1000, shape)
+
+    if current_app.debug or current_app.config['SQL_DEBUG_HEADERS']:
+        response.headers['X-DB-Query-Count'] = str(stats.count)
+        response.headers['X-DB-Time-Ms'] = f'{stats.seconds * 1000:.1f}'
+        response.headers['X-DB-Max-Repeats'] = str(stats.max_repeats())
+        response.headers['Server-Timing'] = (f'db;dur={stats.seconds * 1000:.1f};'
+                                             f'desc="{stats.count} queries"')
+        for rank, (seconds, statement) in enumerate(sorted(stats.slowest, reverse=True), 1):
+            response.headers[f'X-DB-Slowest-{rank}'] = (f'{seconds * 1000:.1f}ms '
+                                                        f'{fingerprint(statement)[:200]}')
+    return response
+
+def instrument(app, db):
+    '''
+    Attaches the statement and request hooks to the app and its engine.
+    P:
+        app(Flask): The app (with an app context pushed, the engine is made on demand)
+        db(SQLAlchemy): The app's database
+    '''
+    app.extensions['metrics'] = Metrics()
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(db.engine, 'handle_error', handle_error)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+def get_metrics():
+    """Returns the app's metrics."""
+    return current_app.extensions['metrics']
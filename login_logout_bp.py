@@ -2,7 +2,7 @@
 from datetime import (timedelta)
 from flask import request, jsonify, Blueprint
 from flask_jwt_extended import create_access_token, set_access_cookies, unset_access_cookies
-from models import Account
+from models import db, Account
 
 login_logout_bp = Blueprint('login_logout', __name__)
 
@@ -22,6 +22,8 @@ def account_login():
     acct = Account.query.filter_by(username=username).first()
 
     if acct is not None and acct.check_pw(request.json.get('password')):
+        if acct.rehash_pw(request.json.get('password')):
+            db.session.commit()
         acc_token = create_access_token(identity=acct.id, expires_delta=timedelta(minutes=10))
         response = jsonify({"msg": "login is valid for accountID " + str(acct.id)})
         set_access_cookies(response, acc_token)
@@ -0,0 +1,24 @@
+"""This is the driving module for the metrics endpoint of the Facebook imitation app 'Y'.
+Point a Prometheus scrape job at /metrics of every worker (see instrumentation.py)."""
+import hmac
+from flask import current_app, request, Response, Blueprint
+from instrumentation import get_metrics
+
+metrics_bp = Blueprint('metrics', __name__)
+
+@metrics_bp.route('/metrics')
+def get_metrics_text():
+    '''
+    Gets the worker's request, query, password hashing and event stream metrics.
+    When METRICS_TOKEN is set the scraper must send it as a bearer token.
+    R:
+        The metrics in the Prometheus text format, or 401 without the token.
+    '''
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                         f'Bearer {token}'):
+        return Response("Metrics token required.", 401)
+
+    metrics = get_metrics()
+    metrics.collect(current_app)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,380 @@
+"""This is the module for versioned schema migrations of the Facebook imitation app 'Y'.
+Migrations are run with the Flask CLI (see commands.py):
+    flask db upgrade [--to VERSION]
+    flask db downgrade --to VERSION
+    flask db current
+Every migration only uses SQLAlchemy Core constructs so it runs against both MySQL and SQLite."""
+import sqlalchemy as sa
+from app import db
+from image_store import get_store
+import search
+
+VERSION_TABLE = 'schema_version'
+
+class Migration:
+    """A single schema version step."""
+
+    def __init__(self, version, description, upgrade, downgrade):
+        """Constructor for Migration."""
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.downgrade = downgrade
+
+#Helpers
+def reflect(conn, table_name):
+    """Returns the table as it currently exists in the database."""
+    return sa.Table(table_name, sa.MetaData(), autoload_with=conn)
+
+def has_column(conn, table_name, column_name):
+    """Returns True if the table already has the column."""
+    return column_name in [col['name'] for col in sa.inspect(conn).get_columns(table_name)]
+
+def has_index(conn, table_name, index_name):
+    """Returns True if the table already has an index of that name."""
+    return index_name in [index['name'] for index in sa.inspect(conn).get_indexes(table_name)]
+
+def add_column(conn, table_name, column):
+    '''
+    Adds a column to an existing table if it is not there yet.
+    P:
+        conn(Connection): Connection the migration is running on
+        table_name(string): Table to be altered
+        column(Column): Unbound sa.Column describing the new column
+    '''
+    if has_column(conn, table_name, column.name):
+        return
+    column_type = column.type.compile(dialect=conn.dialect)
+    ddl = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}"
+    if column.server_default is not None:
+        ddl += f" DEFAULT {column.server_default.arg}"
+    if not column.nullable:
+        ddl += " NOT NULL"
+    conn.execute(sa.text(ddl))
+
+def drop_column(conn, table_name, column_name):
+    """Drops a column from a table if it exists."""
+    if has_column(conn, table_name, column_name):
+        conn.execute(sa.text(f"ALTER TABLE {table_name} DROP COLUMN {column_name}"))
+
+def create_index(conn, table_name, index_name, columns, unique=False):
+    '''
+    Creates an index if it is not there yet.
+    P:
+        conn(Connection): Connection the migration is running on
+        table_name(string): Table to be indexed
+        index_name(string): Name of the index
+        columns(list): Column names in index order
+        unique(bool): True for a unique index
+    '''
+    if has_index(conn, table_name, index_name):
+        return
+    table = reflect(conn, table_name)
+    sa.Index(index_name, *[table.c[col] for col in columns], unique=unique).create(conn)
+
+def drop_index(conn, table_name, index_name):
+    """Drops an index if it exists."""
+    if not has_index(conn, table_name, index_name):
+        return
+    table = reflect(conn, table_name)
+    for index in table.indexes:
+        if index.name == index_name:
+            index.drop(conn)
+
+def set_nullable(conn, table_name, column_name, nullable):
+    '''
+    Changes whether a column accepts NULL.
+    MySQL alters the column in place, SQLite has to copy the table into a new one.
+    '''
+    table = reflect(conn, table_name)
+    if conn.dialect.name != 'sqlite':
+        column_type = table.c[column_name].type.compile(dialect=conn.dialect)
+        null = "NULL" if nullable else "NOT NULL"
+        conn.execute(sa.text(f"ALTER TABLE {table_name} MODIFY {column_name} {column_type} {null}"))
+        return
+
+    tmp_name = f"_{table_name}_rebuild"
+    rebuilt = table.to_metadata(sa.MetaData(), name=tmp_name)
+    rebuilt.c[column_name].nullable = nullable
+    indexes = list(rebuilt.indexes)
+    rebuilt.indexes.clear()
+    rebuilt.create(conn)
+    columns = ", ".join(col.name for col in table.c)
+    conn.execute(sa.text(f"INSERT INTO {tmp_name} ({columns}) SELECT {columns} FROM {table_name}"))
+    table.drop(conn)
+    conn.execute(sa.text(f"ALTER TABLE {tmp_name} RENAME TO {table_name}"))
+    for index in indexes:
+        create_index(conn, table_name, index.name, [col.name for col in index.columns], index.unique)
+
+#Migrations
+def upgrade_0001(conn):
+    """Adds the denormalized like and reply counters to Post and fills them in."""
+    add_column(conn, 'post', sa.Column('like_count', sa.Integer, nullable=False, server_default='0'))
+    add_column(conn, 'post', sa.Column('reply_count', sa.Integer, nullable=False, server_default='0'))
+
+    post, reply, reaction = reflect(conn, 'post'), reflect(conn, 'reply'), reflect(conn, 'reaction')
+    likes = (sa.select(sa.func.count(reaction.c.id))
+             .where(reaction.c.responding_to == post.c.id, reaction.c.deleted_at == None)
+             .scalar_subquery())
+    replies = (sa.select(sa.func.count(reply.c.id))
+               .where(reply.c.responding_to == post.c.id, reply.c.deleted_at == None)
+               .scalar_subquery())
+    conn.execute(sa.update(post).values(like_count=likes, reply_count=replies))
+
+def downgrade_0001(conn):
+    """Removes the Post counters."""
+    drop_column(conn, 'post', 'like_count')
+    drop_column(conn, 'post', 'reply_count')
+
+#(table, index name, columns, unique) for the indexes behind the hot queries.
+INDEXES_0002 = [
+    ('relationship', 'ix_relationship_pair', ['first_acc_id', 'second_acc_id', 'deleted_at'], False),
+    ('relationship', 'ix_relationship_inverse', ['second_acc_id', 'deleted_at'], False),
+    ('post', 'ix_post_timeline', ['posted_on_id', 'deleted_at', 'id'], False),
+    ('reaction', 'ix_reaction_post_poster', ['responding_to', 'poster_id'], False),
+    ('reply', 'ix_reply_post', ['responding_to'], False),
+    ('account', 'ux_account_username', ['username'], True)
+]
+
+def upgrade_0002(conn):
+    """Adds the production index set."""
+    account = reflect(conn, 'account')
+    duplicate = conn.execute(sa.select(account.c.username).group_by(account.c.username)
+                             .having(sa.func.count() > 1).limit(1)).first()
+    if duplicate is not None:
+        raise RuntimeError(f"Username '{duplicate.username}' is used by more than one account. "
+                           "Resolve the duplicates before adding the unique username index.")
+
+    for table_name, index_name, columns, unique in INDEXES_0002:
+        create_index(conn, table_name, index_name, columns, unique)
+
+def downgrade_0002(conn):
+    """Removes the production index set."""
+    for table_name, index_name, _, _ in INDEXES_0002:
+        drop_index(conn, table_name, index_name)
+
+def upgrade_0003(conn):
+    '''
+    Lets Img rows keep their bytes in the image store.
+    Existing bytes stay in the table until 'flask images migrate' moves them.
+    '''
+    add_column(conn, 'img', sa.Column('content_hash', sa.String(64), nullable=True))
+    add_column(conn, 'img', sa.Column('size', sa.Integer, nullable=True))
+    create_index(conn, 'img', 'ix_img_content_hash', ['content_hash'])
+    set_nullable(conn, 'img', 'img', True)
+
+def downgrade_0003(conn):
+    """Copies stored images back into the table and removes the image store columns."""
+    img = reflect(conn, 'img')
+    store = get_store()
+    moved = conn.execute(sa.select(img.c.id, img.c.content_hash)
+                         .where(img.c.img == None, img.c.content_hash != None)).all()
+    for row in moved:
+        conn.execute(sa.update(img).where(img.c.id == row.id)
+                     .values(img=store.read(row.content_hash)))
+
+    set_nullable(conn, 'img', 'img', False)
+    drop_index(conn, 'img', 'ix_img_content_hash')
+    drop_column(conn, 'img', 'content_hash')
+    drop_column(conn, 'img', 'size')
+
+def upgrade_0004(conn):
+    """Adds the table of resized image derivatives."""
+    sa.Table('img_variant', sa.MetaData(),
+             sa.Column('id', sa.Integer, primary_key=True),
+             sa.Column('source_hash', sa.String(64), nullable=False),
+             sa.Column('variant', sa.String(16), nullable=False),
+             sa.Column('content_hash', sa.String(64), nullable=False),
+             sa.Column('mimetype', sa.Text, nullable=False),
+             sa.Column('size', sa.Integer, nullable=False),
+             sa.UniqueConstraint('source_hash', 'variant', name='ux_img_variant_source')
+             ).create(conn, checkfirst=True)
+
+def downgrade_0004(conn):
+    """Removes the derivative table (the derivative files are left in the store)."""
+    reflect(conn, 'img_variant').drop(conn)
+
+def upgrade_0005(conn):
+    """Adds the news feed table."""
+    metadata = sa.MetaData()
+    #The referenced tables have to be in the same MetaData for the foreign keys.
+    sa.Table('account', metadata, autoload_with=conn)
+    sa.Table('post', metadata, autoload_with=conn)
+    sa.Table('feed_entry', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('owner_id', sa.Integer, sa.ForeignKey('account.id'), nullable=True),
+             sa.Column('post_id', sa.Integer, sa.ForeignKey('post.id'), nullable=False),
+             sa.Column('poster_id', sa.Integer, sa.ForeignKey('account.id'), nullable=False),
+             sa.UniqueConstraint('owner_id', 'post_id', name='ux_feed_entry_owner_post'),
+             sa.Index('ix_feed_entry_poster', 'poster_id', 'post_id')
+             ).create(conn, checkfirst=True)
+
+def downgrade_0005(conn):
+    """Removes the news feed table."""
+    reflect(conn, 'feed_entry').drop(conn)
+
+def upgrade_0006(conn):
+    """Adds Post.updated_at for timeline change polling and fills it from the other timestamps."""
+    add_column(conn, 'post', sa.Column('updated_at', sa.DateTime))
+    post = reflect(conn, 'post')
+    conn.execute(sa.update(post).values(
+        updated_at=sa.func.coalesce(post.c.deleted_at, post.c.edited_at, post.c.created_at)))
+    create_index(conn, 'post', 'ix_post_changes', ['posted_on_id', 'updated_at'])
+
+def downgrade_0006(conn):
+    """Removes Post.updated_at."""
+    drop_index(conn, 'post', 'ix_post_changes')
+    drop_column(conn, 'post', 'updated_at')
+
+#Indexes the purge job finds expired soft deleted rows and unused images with.
+INDEXES_0007 = [
+    ('post', 'ix_post_deleted', ['deleted_at']),
+    ('post', 'ix_post_image', ['associated_image_id']),
+    ('account', 'ix_account_profile_image', ['profile_image_id']),
+    ('account', 'ix_account_cover_image', ['cover_image_id']),
+    ('reply', 'ix_reply_deleted', ['deleted_at']),
+    ('reaction', 'ix_reaction_deleted', ['deleted_at']),
+    ('relationship', 'ix_relationship_deleted', ['deleted_at']),
+    ('img', 'ix_img_deleted', ['deleted_at'])
+]
+
+def upgrade_0007(conn):
+    """Adds the indexes of the purge job."""
+    for table_name, index_name, columns in INDEXES_0007:
+        create_index(conn, table_name, index_name, columns)
+
+def downgrade_0007(conn):
+    """Removes the indexes of the purge job."""
+    for table_name, index_name, _ in INDEXES_0007:
+        drop_index(conn, table_name, index_name)
+
+def upgrade_0008(conn):
+    """Adds the full-text search indexes of posts and accounts (see search.py)."""
+    search.create_index(conn, 'post')
+    search.create_index(conn, 'account')
+
+def downgrade_0008(conn):
+    """Removes the full-text search indexes."""
+    search.drop_indexes(conn)
+
+def upgrade_0009(conn):
+    """Adds the friend suggestion table, filled by 'flask suggestions rebuild'."""
+    metadata = sa.MetaData()
+    sa.Table('account', metadata, autoload_with=conn)
+    sa.Table('friend_suggestion', metadata,
+             sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+             sa.Column('account_id', sa.Integer, sa.ForeignKey('account.id'), nullable=False),
+             sa.Column('candidate_id', sa.Integer, sa.ForeignKey('account.id'), nullable=False),
+             sa.Column('mutual_count', sa.Integer, nullable=False),
+             sa.UniqueConstraint('account_id', 'candidate_id', name='ux_friend_suggestion_pair'),
+             sa.Index('ix_friend_suggestion_rank', 'account_id', 'mutual_count', 'candidate_id')
+             ).create(conn, checkfirst=True)
+
+def downgrade_0009(conn):
+    """Removes the friend suggestion table."""
+    reflect(conn, 'friend_suggestion').drop(conn)
+
+def upgrade_0010(conn):
+    """Adds the denormalized post counter to Account and fills it in."""
+    add_column(conn, 'account', sa.Column('post_count', sa.Integer, nullable=False,
+                                          server_default='0'))
+    account, post = reflect(conn, 'account'), reflect(conn, 'post')
+    posts = (sa.select(sa.func.count(post.c.id))
+             .where(post.c.posted_on_id == account.c.id, post.c.deleted_at == None)
+             .scalar_subquery())
+    conn.execute(sa.update(account).values(post_count=posts))
+
+def downgrade_0010(conn):
+    """Removes the Account post counter."""
+    drop_column(conn, 'account', 'post_count')
+
+MIGRATIONS = [
+    Migration(1, "Post like and reply counters", upgrade_0001, downgrade_0001),
+    Migration(2, "Production index set", upgrade_0002, downgrade_0002),
+    Migration(3, "Image store columns on Img", upgrade_0003, downgrade_0003),
+    Migration(4, "Image derivatives", upgrade_0004, downgrade_0004),
+    Migration(5, "News feed", upgrade_0005, downgrade_0005),
+    Migration(6, "Post change tracking", upgrade_0006, downgrade_0006),
+    Migration(7, "Purge indexes", upgrade_0007, downgrade_0007),
+    Migration(8, "Full-text search", upgrade_0008, downgrade_0008),
+    Migration(9, "Friend suggestions", upgrade_0009, downgrade_0009),
+    Migration(10, "Account post counter", upgrade_0010, downgrade_0010)
+]
+
+HEAD = MIGRATIONS[-1].version
+
+#Version bookkeeping
+def version_table():
+    """Returns the table that stores the current schema version."""
+    return sa.Table(VERSION_TABLE, sa.MetaData(), sa.Column('version', sa.Integer, nullable=False))
+
+def current_version(conn):
+    '''
+    Gets the schema version of the database.
+    R:
+        None if the database has no tables yet,
+        0 if it predates the migrations, otherwise the last applied version.
+    '''
+    tables = sa.inspect(conn).get_table_names()
+    if VERSION_TABLE not in tables:
+        return 0 if 'account' in tables else None
+    return conn.execute(sa.select(version_table().c.version)).scalar() or 0
+
+def set_version(conn, version):
+    """Records the schema version of the database."""
+    table = version_table()
+    table.create(conn, checkfirst=True)
+    conn.execute(sa.delete(table))
+    conn.execute(sa.insert(table).values(version=version))
+
+def upgrade(target=None, echo=print):
+    '''
+    Upgrades the database to the target version.
+    An empty database is created from the models and stamped with the latest version.
+    P:
+        target(int): Version to upgrade to (None for the latest)
+        echo(function): Called with a line of progress for each step
+    R:
+        The version the database is at afterwards.
+    '''
+    target = HEAD if target is None else target
+    with db.engine.connect() as conn:
+        version = current_version(conn)
+
+    if version is None:
+        db.create_all()
+        with db.engine.begin() as conn:
+            set_version(conn, HEAD)
+        echo(f"Created a new database at version {HEAD}.")
+        return HEAD
+
+    for migration in MIGRATIONS:
+        if version < migration.version <= target:
+            #One transaction per step so a failure leaves the last good version recorded.
+            with db.engine.begin() as conn:
+                migration.upgrade(conn)
+                set_version(conn, migration.version)
+            version = migration.version
+            echo(f"Upgraded to {migration.version}: {migration.description}")
+    return version
+
+def downgrade(target, echo=print):
+    '''
+    Downgrades the database to the target version.
+    P:
+        target(int): Version to downgrade to (0 is the schema before any migration)
+        echo(function): Called with a line of progress for each step
+    R:
+        The version the database is at afterwards.
+    '''
+    with db.engine.connect() as conn:
+        version = current_version(conn) or 0
+
+    for migration in reversed(MIGRATIONS):
+        if target < migration.version <= version:
+            with db.engine.begin() as conn:
+                migration.downgrade(conn)
+                set_version(conn, migration.version - 1)
+            version = migration.version - 1
+            echo(f"Downgraded to {version}: removed {migration.description}")
+    return version
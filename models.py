@@ -2,10 +2,18 @@
 import random
 import string
 from datetime import datetime
-from app import db, bcrypt
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import noload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db
+from image_store import get_store
+from password_hashing import get_hasher
 
 class Account(db.Model):
     """Model for Account"""
+    __table_args__ = (db.Index('ux_account_username', 'username', unique=True),
+                      db.Index('ix_account_profile_image', 'profile_image_id'),
+                      db.Index('ix_account_cover_image', 'cover_image_id'))
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(32))
     password_hash = db.Column(db.String(128))
@@ -17,6 +25,8 @@ class Account(db.Model):
     is_public = db.Column(db.Boolean, default=False)
     friend_code = db.Column(db.String(8), unique=True)
     deleted_at = db.Column(db.DateTime)
+    #Live posts on the account's timeline, kept with every post made or deleted.
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def check_pw(self, password):
         '''
@@ -26,7 +36,7 @@ class Account(db.Model):
         R:
             Boolean of evaluation
         '''
-        return bcrypt.check_password_hash(self.password_hash, password)
+        return get_hasher().check(password, self.password_hash)
 
     def to_dict(self):
         '''
@@ -70,47 +80,167 @@ class Account(db.Model):
             return False
 
         #Password was correct so change the PW to the new PW
-        self.password_hash = bcrypt.generate_password_hash(new_pw).decode('utf-8')
+        self.password_hash = get_hasher().hash(new_pw)
+        return True
+
+    def rehash_pw(self, password):
+        '''
+        Rehashes the password if the bcrypt cost setting has changed since it was hashed.
+        Only call after check_pw has passed with the same password.
+        P:
+            password(string): The account's password in plaintext
+        R:
+            True if password_hash was changed (caller commits).
+        '''
+        if not get_hasher().needs_rehash(self.password_hash):
+            return False
+        self.password_hash = get_hasher().hash(password)
         return True
 
     def __init__(self, username, password_unhashed, first, last, bio, public = False):
         """Constructor for Account."""
         self.username = username
-        self.password_hash = bcrypt.generate_password_hash(password_unhashed).decode('utf-8')
+        self.password_hash = get_hasher().hash(password_unhashed)
         self.first_name = first
         self.last_name = last
         self.bio = bio
         self.is_public = public
+        #Uniqueness is left to the friend_code constraint, see Account.insert_all.
+        self.friend_code = Account.new_friend_code()
+
+    @staticmethod
+    def change_post_counts(changes):
+        '''
+        Adds to the post_count of accounts with one UPDATE per distinct change. Does not commit,
+            so the counts change in the same transaction as the posts.
+        P:
+            changes(dict): Account.id -> posts added (negative for posts deleted)
+        '''
+        by_change = {}
+        for acc_id, change in changes.items():
+            if change:
+                by_change.setdefault(change, []).append(acc_id)
+        for change, acc_ids in by_change.items():
+            db.session.execute(db.update(Account).where(Account.id.in_(acc_ids))
+                               .values(post_count=Account.post_count + change)
+                               .execution_options(synchronize_session=False))
 
-        while True:
-            code = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(8))
-            if Account.query.filter_by(friend_code=code).first() is None:
-                self.friend_code = code
+    @staticmethod
+    def recount_posts():
+        '''
+        Recomputes post_count of every Account from the Post table.
+        Used to repair the counters if they have drifted.
+        R:
+            Number of accounts updated.
+        '''
+        posts = (db.select(db.func.count(Post.id))
+                 .where(Post.posted_on_id == Account.id, Post.deleted_at == None)
+                 .scalar_subquery())
+        result = db.session.execute(db.update(Account).values(post_count=posts)
+                                    .execution_options(synchronize_session=False))
+        db.session.commit()
+        return result.rowcount
+
+    @staticmethod
+    def new_friend_code():
+        """Returns a random 8 character friend code (36^8 possibilities, so collisions are rare)."""
+        return ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(8))
+
+    @staticmethod
+    def insert_all(accounts, retries=5):
+        '''
+        Inserts new Accounts and commits, relying on the unique constraint instead of looking
+            each friend code up first. If a code is taken the batch is rolled back to a
+            savepoint and retried with fresh codes.
+        P:
+            accounts(list): New Accounts to insert
+            retries(int): Attempts before giving up
+        R:
+            Raises the IntegrityError if it was not a friend code collision or retries ran out.
+        '''
+        for attempt in range(retries):
+            try:
+                with db.session.begin_nested():
+                    db.session.add_all(accounts)
                 break
+            except IntegrityError as error:
+                if 'friend_code' not in str(error.orig) or attempt == retries - 1:
+                    raise
+                codes = set()
+                for account in accounts:
+                    account.friend_code = Account.new_friend_code()
+                    #Also keep the batch itself free of repeats.
+                    while account.friend_code in codes:
+                        account.friend_code = Account.new_friend_code()
+                    codes.add(account.friend_code)
+        db.session.commit()
 
 class Post(db.Model):
     """Model for Post"""
+    __table_args__ = (db.Index('ix_post_timeline', 'posted_on_id', 'deleted_at', 'id'),
+                      db.Index('ix_post_changes', 'posted_on_id', 'updated_at'),
+                      db.Index('ix_post_deleted', 'deleted_at'),
+                      db.Index('ix_post_image', 'associated_image_id'))
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     poster_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
     posted_on_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
     text_content = db.Column(db.String(400)) #We are limiting charcter count to 400 characters.
     shared_post_id = db.Column(db.Integer, nullable=True)
     associated_image_id = db.Column(db.Integer, nullable=True)
-    replies = db.relationship('Reply', backref='post', lazy='joined')
-    reactions = db.relationship('Reaction', backref='post', lazy='joined')
+    #Not eagerly loaded, read paths pick a strategy with Post.loading / Post.load_latest_replies.
+    replies = db.relationship('Reply', backref='post', lazy='select')
+    reactions = db.relationship('Reaction', backref='post', lazy='select')
+    #Maintained by pst_rep_rea_bp so pages never have to count the rows themselves.
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     created_at = db.Column(db.DateTime)
     edited_at = db.Column(db.DateTime)
     deleted_at = db.Column(db.DateTime)
+    #Bumped on every edit, delete and counter change so timelines can be polled for changes.
+    updated_at = db.Column(db.DateTime)
 
-    def process(self, caller_acc_id, caller_friends = None):
+    @staticmethod
+    def process_batch(posts, caller_acc_id, caller_friends = None, caller_reactions = None):
         '''
-        Processes a post for timeline/home_page
+        Processes a list of posts for timeline/home_page.
+        All shared posts are fetched with a single query instead of one per post.
         P:
+            posts(list): Posts to be processed
             caller_acc_id(int): Account.id of the account that is rendering the page
             caller_friends(list): List of Account.ids for caller's friends
+            caller_reactions(dict): Post.id to Reaction.id of the caller's active reactions.
+                When given the posts' reaction rows are not looked at.
+        R:
+            List of dictionaries in the form of Post.to_processed_dict, in the order given.
+        '''
+        shared_ids = {pst.shared_post_id for pst in posts
+                      if pst.shared_post_id is not None and pst.shared_post_id != 0}
+
+        shared_posts = {}
+        if shared_ids:
+            #Only the columns the front end shows, so no replies/reactions get joined in.
+            rows = db.session.query(Post.id, Post.poster_id, Post.posted_on_id, Post.text_content,
+                                    Post.associated_image_id, Post.created_at
+                                    ).filter(Post.id.in_(shared_ids)).all()
+            shared_posts = {row.id: row for row in rows}
+
+        caller_friends = None if caller_friends is None else set(caller_friends)
+
+        return [pst.to_processed_dict(caller_acc_id, caller_friends,
+                                      shared_posts.get(pst.shared_post_id), caller_reactions)
+                for pst in posts]
+
+    def to_processed_dict(self, caller_acc_id, caller_friends, targ_pst, caller_reactions = None):
+        '''
+        Builds the processed dictionary of a post once its shared post has been fetched.
+        P:
+            caller_acc_id(int): Account.id of the account that is rendering the page
+            caller_friends(list or set): Account.ids for caller's friends (None skips the check)
+            targ_pst(Post or row): The shared post (None if there is not one)
+            caller_reactions(dict): Post.id to Reaction.id of the caller's active reactions
+                (None to check the post's reaction rows instead)
         R:
-            Dictionary of the post object using camelCase 
-                for the front end with shared posts and reactions processed.
+            Dictionary of the post object using camelCase for the front end.
         '''
         user_reacted = False
         sp_txt = ""
@@ -118,12 +248,14 @@ class Post(db.Model):
         sp_on = None
         sp_created_at = None
 
-        for react in self.reactions:
-            if react.poster_id == caller_acc_id:
-                user_reacted = True
+        if caller_reactions is not None:
+            user_reacted = self.id in caller_reactions
+        else:
+            for react in self.reactions:
+                if react.poster_id == caller_acc_id:
+                    user_reacted = True
 
-        if self.shared_post_id is not None and self.shared_post_id != 0:
-            targ_pst = Post.query.filter_by(id=self.shared_post_id).first()
+        if targ_pst is not None:
             #Determines if the post can be viewed by the caller.
             if (self.poster_id == caller_acc_id or targ_pst.poster_id == caller_acc_id
                 or (targ_pst.id is not None and
@@ -145,6 +277,8 @@ class Post(db.Model):
             'createdAt' : self.created_at,
             'editedAt' : self.edited_at,
             'userReacted' : user_reacted,
+            'likeCount' : self.like_count,
+            'replyCount' : self.reply_count,
             'sharedPostTxt' : sp_txt,
             'sharedPostImgId' : sp_img_id,
             'sharedPostAccId' : sp_on,
@@ -153,6 +287,26 @@ class Post(db.Model):
 
         return dict_form
 
+    def to_dict(self):
+        '''
+        Converts the Post to a dictionary of plain values for JSON responses.
+        R:
+            Dictionary of the Post object using camelCase (dates in ISO 8601)
+        '''
+        dict_form = {
+            'id' : self.id,
+            'posterID' : self.poster_id,
+            'postedOnID' : self.posted_on_id,
+            'textContent' : self.text_content,
+            'sharedPostID' : self.shared_post_id,
+            'associatedImageID' : self.associated_image_id,
+            'likeCount' : self.like_count,
+            'replyCount' : self.reply_count,
+            'createdAt' : self.created_at.isoformat() if self.created_at else None,
+            'editedAt' : self.edited_at.isoformat() if self.edited_at else None
+        }
+        return dict_form
+
     def __init__(self, p_id, text, target, shared_post_id=None, image_id=None):
         """Constructor for Post."""
         self.poster_id = p_id
@@ -160,11 +314,98 @@ class Post(db.Model):
         self.text_content = text
         self.shared_post_id = shared_post_id
         self.associated_image_id = image_id
+        self.like_count = 0
+        self.reply_count = 0
         self.created_at = datetime.now()
         self.edited_at = None
+        self.updated_at = self.created_at
+
+    @staticmethod
+    def loading(replies='none', reactions='none'):
+        '''
+        Builds the loader options for a Post query.
+        P:
+            replies(string): 'none' to never load Post.replies or
+                'selectin' to load all of them for every post with one extra query.
+            reactions(string): Same as replies for Post.reactions.
+        R:
+            List of options to be passed to Query.options.
+        '''
+        options = []
+        for relation, strategy in ((Post.replies, replies), (Post.reactions, reactions)):
+            if strategy == 'selectin':
+                options.append(selectinload(relation))
+            elif strategy == 'none':
+                options.append(noload(relation))
+            else:
+                raise ValueError(f"Unknown loading strategy '{strategy}'.")
+        return options
+
+    @staticmethod
+    def load_latest_replies(posts, limit):
+        '''
+        Fills in Post.replies with only the newest non-deleted replies of each post.
+        Uses a single windowed query for all of the posts.
+        P:
+            posts(list): Posts whose replies should be loaded (query them with replies='none')
+            limit(int): Maximum number of replies kept per post
+        '''
+        by_post = {post.id: [] for post in posts}
+        if by_post:
+            ranked = (db.select(Reply.id, db.func.row_number().over(
+                          partition_by=Reply.responding_to, order_by=Reply.id.desc()
+                      ).label('rank'))
+                      .where(Reply.responding_to.in_(by_post), Reply.deleted_at == None)
+                      .subquery())
+            latest = (Reply.query.join(ranked, Reply.id == ranked.c.id)
+                      .filter(ranked.c.rank <= limit).order_by(Reply.id).all())
+            for reply in latest:
+                by_post[reply.responding_to].append(reply)
+
+        for post in posts:
+            set_committed_value(post, 'replies', by_post[post.id])
+
+    @staticmethod
+    def cascade_delete(post_ids, deleted_at):
+        '''
+        Soft deletes the live replies and reactions of deleted posts with one UPDATE per table.
+        Does not commit, so the cascade is part of the transaction that deletes the posts.
+        P:
+            post_ids(iterable): Post.ids being deleted
+            deleted_at(datetime): Time stamped on the posts
+        '''
+        post_ids = list(post_ids)
+        if not post_ids:
+            return
+        for model in (Reply, Reaction):
+            db.session.execute(db.update(model)
+                               .where(model.responding_to.in_(post_ids), model.deleted_at == None)
+                               .values(deleted_at=deleted_at)
+                               .execution_options(synchronize_session=False))
+
+    @staticmethod
+    def recount_all():
+        '''
+        Recomputes like_count and reply_count of every Post from the Reaction and Reply tables.
+        Used to repair the counters if they have drifted.
+        R:
+            Number of posts updated.
+        '''
+        likes = (db.select(db.func.count(Reaction.id))
+                 .where(Reaction.responding_to == Post.id, Reaction.deleted_at == None)
+                 .scalar_subquery())
+        replies = (db.select(db.func.count(Reply.id))
+                   .where(Reply.responding_to == Post.id, Reply.deleted_at == None)
+                   .scalar_subquery())
+        result = db.session.execute(db.update(Post).values(like_count=likes, reply_count=replies)
+                                    .execution_options(synchronize_session=False))
+        db.session.commit()
+        return result.rowcount
 
 class Reply(db.Model):
     """Model for Reply"""
+    __table_args__ = (db.Index('ix_reply_post', 'responding_to'),
+                      db.Index('ix_reply_deleted', 'deleted_at'))
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     responding_to = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     poster_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
@@ -181,8 +422,26 @@ class Reply(db.Model):
         self.created_at = datetime.now()
         self.edited_at = None
 
+    def to_dict(self):
+        '''
+        Converts the Reply to a dictionary of plain values for JSON responses.
+        R:
+            Dictionary of the Reply object using camelCase (dates in ISO 8601)
+        '''
+        dict_form = {
+            'id' : self.id,
+            'respondingTo' : self.responding_to,
+            'posterID' : self.poster_id,
+            'textContent' : self.text_content,
+            'createdAt' : self.created_at.isoformat() if self.created_at else None,
+            'editedAt' : self.edited_at.isoformat() if self.edited_at else None
+        }
+        return dict_form
+
 class Reaction(db.Model):
     """Model for Reaction."""
+    __table_args__ = (db.Index('ix_reaction_post_poster', 'responding_to', 'poster_id'),
+                      db.Index('ix_reaction_deleted', 'deleted_at'))
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     responding_to = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
     poster_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
@@ -197,6 +456,9 @@ class Reaction(db.Model):
 
 class Relationship(db.Model):
     """Model for Relationship"""
+    __table_args__ = (db.Index('ix_relationship_pair', 'first_acc_id', 'second_acc_id', 'deleted_at'),
+                      db.Index('ix_relationship_inverse', 'second_acc_id', 'deleted_at'),
+                      db.Index('ix_relationship_deleted', 'deleted_at'))
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     first_acc_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
     second_acc_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
@@ -220,15 +482,97 @@ class Relationship(db.Model):
         return inverse
 
 class Img(db.Model):
-    """Model for Img."""
+    """Model for Img. The bytes live in the image store (see image_store.py)."""
+    __table_args__ = (db.Index('ix_img_deleted', 'deleted_at'),)
     id = db.Column(db.Integer, primary_key=True)
-    img = db.Column(db.LargeBinary, nullable=False)
+    #Legacy in-table bytes, only set on rows not yet moved out by 'flask images migrate'.
+    img = db.deferred(db.Column(db.LargeBinary, nullable=True))
+    content_hash = db.Column(db.String(64), nullable=True, index=True)
+    size = db.Column(db.Integer, nullable=True)
     name = db.Column(db.Text, nullable=False)
     mimetype = db.Column(db.Text, nullable=False)
     deleted_at = db.Column(db.DateTime)
 
-    def __init__(self, img, name, mimetype):
+    @staticmethod
+    def create(data, name, mimetype):
+        '''
+        Saves image bytes to the image store and makes the Img row for them.
+        P:
+            data(bytes): The image
+            name(string): Secure file name of the upload
+            mimetype(string): Mimetype of the upload
+        R:
+            The new Img (not yet added to the session).
+        '''
+        content_hash = get_store().save(data)
+        return Img(name, mimetype, content_hash, len(data))
+
+    def read(self):
+        """Returns the bytes of the image wherever they are stored."""
+        if self.content_hash is None:
+            return self.img
+        return get_store().read(self.content_hash)
+
+    def __init__(self, name, mimetype, content_hash, size):
         """Constructor for Img"""
-        self.img = img
         self.name = name
         self.mimetype = mimetype
+        self.content_hash = content_hash
+        self.size = size
+
+class ImgVariant(db.Model):
+    """Model for ImgVariant, a resized copy of an image kept in the image store."""
+    __table_args__ = (db.UniqueConstraint('source_hash', 'variant', name='ux_img_variant_source'),)
+    id = db.Column(db.Integer, primary_key=True)
+    source_hash = db.Column(db.String(64), nullable=False)
+    variant = db.Column(db.String(16), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=False)
+    mimetype = db.Column(db.Text, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, source_hash, variant, content_hash, mimetype, size):
+        """Constructor for ImgVariant"""
+        self.source_hash = source_hash
+        self.variant = variant
+        self.content_hash = content_hash
+        self.mimetype = mimetype
+        self.size = size
+
+class FeedEntry(db.Model):
+    '''
+    Model for FeedEntry, a Post copied into an account's news feed when it is made.
+    Posts by accounts with too many friends get one entry with no owner instead,
+        and are pulled in by their friends when they read their feed.
+    '''
+    __table_args__ = (db.UniqueConstraint('owner_id', 'post_id', name='ux_feed_entry_owner_post'),
+                      db.Index('ix_feed_entry_poster', 'poster_id', 'post_id'))
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), nullable=False)
+    poster_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+
+    def __init__(self, owner_id, post_id, poster_id):
+        """Constructor for FeedEntry."""
+        self.owner_id = owner_id
+        self.post_id = post_id
+        self.poster_id = poster_id
+
+class FriendSuggestion(db.Model):
+    '''
+    Model for FriendSuggestion, an account someone is not friends with that shares
+        mutual_count friends with them. Kept in both directions, see suggestions.py.
+    '''
+    __table_args__ = (db.UniqueConstraint('account_id', 'candidate_id',
+                                          name='ux_friend_suggestion_pair'),
+                      db.Index('ix_friend_suggestion_rank', 'account_id', 'mutual_count',
+                               'candidate_id'))
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    candidate_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    mutual_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __init__(self, account_id, candidate_id, mutual_count):
+        """Constructor for FriendSuggestion."""
+        self.account_id = account_id
+        self.candidate_id = candidate_id
+        self.mutual_count = mutual_count
@@ -1,8 +1,13 @@
 """This is the main driving module for page rendering in the Facebook imitation app 'Y'."""
-from flask import abort, request, render_template, redirect, url_for, Blueprint
-from flask_jwt_extended import (get_jwt_identity, jwt_required)
-from models import (db, Post, Relationship, Account)
+import heapq
+from flask import (abort, current_app, request, render_template, redirect, url_for,
+                   make_response, Blueprint)
+from flask_jwt_extended import (current_user, jwt_required)
+from models import (db, Post, Reaction, Account)
 from pst_rep_rea_bp import can_make_content
+from social_graph import get_graph
+from reaction_buffer import get_reaction_buffer
+from suggestions import get_suggestions
 
 pages_bp = Blueprint('pages', __name__)
 
@@ -22,185 +27,253 @@ def register_page():
     """ Alias for /signup, renders the signup page."""
     return render_template('signup.html')
 
-@pages_bp.route('/profile')
-@jwt_required()
-def home_page():
-    """Renders the profile page with data for the current user."""
-    acc = Account.query.filter_by(id=get_jwt_identity()).first()
-
-    #Gets all the accounts that are friends with the user.
-    raw_friends = db.session.query(Account).join( Relationship, (Relationship.first_acc_id==acc.id)
-                                                 & (Relationship.second_acc_id == Account.id)
-                                                 & (Relationship.confirmed_relation == True)
-                                                 & (Relationship.is_friend_relation == True)
-                                                 & (Relationship.deleted_at == None)).all()
-    raw_postable = db.session.query(Account).join( Relationship, (Relationship.first_acc_id==acc.id)
-                                                  & (Relationship.second_acc_id == Account.id)
-                                                  & (Relationship.confirmed_relation == True)
-                                                  & (Relationship.is_friend_relation == True)).all()
-
+def get_timeline_page(acc_id, before=None):
+    '''
+    Gets a single page of an account's timeline using keyset pagination on Post.id.
+    P:
+        acc_id(int): Account.id of the timeline owner.
+        before(int): Cursor from the previous page; only posts with a lower id are returned.
+            None for the first page.
+    R:
+        Tuple of (list of Posts newest first, cursor for the next page or None if this is the last).
+    '''
+    page_size = current_app.config['TIMELINE_PAGE_SIZE']
+    reply_limit = current_app.config['TIMELINE_REPLY_LIMIT']
+
+    #Reactions are never needed here, the counts live on Post.like_count.
+    query = Post.query.options(*Post.loading(replies='selectin' if reply_limit == 0 else 'none'))
+    query = query.filter_by(posted_on_id=acc_id, deleted_at=None)
+    if before is not None:
+        query = query.filter(Post.id < before)
+    #One extra row tells us if there is another page without a COUNT.
+    page = query.order_by(Post.id.desc()).limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = page[-1].id
+
+    if reply_limit > 0:
+        Post.load_latest_replies(page, reply_limit)
+    return page, next_cursor
+
+def get_accounts(acc_ids):
+    '''
+    Gets the Accounts with the given ids in one query.
+    P:
+        acc_ids(iterable): Account.ids (usually a set from the social graph cache)
+    R:
+        List of Accounts.
+    '''
+    if not acc_ids:
+        return []
+    return Account.query.filter(Account.id.in_(acc_ids)).all()
+
+#Friends page list -> SocialEdges set it shows.
+CONNECTION_CATEGORIES = {
+    'friends': 'friends',
+    'pending': 'pending_in',
+    'sent': 'pending_out',
+    'blocked': 'blocked'
+}
+
+def get_connection_pages(edges, cursors):
+    '''
+    Gets a page of each of the requested lists of an account's connections with one query,
+        using keyset pagination on Account.id.
+    P:
+        edges(SocialEdges): The account's relationships from the social graph cache
+        cursors(dict): Key of CONNECTION_CATEGORIES -> cursor from the previous page of that
+            list (None for the first page); only accounts with a higher id are returned
+    R:
+        Dictionary of the same keys to (list of Account dictionaries ordered by id,
+            cursor for the next page or None if this is the last).
+    '''
+    page_size = current_app.config['FRIENDS_PAGE_SIZE']
+    page_ids = {}
+    for category, after in cursors.items():
+        ids = getattr(edges, CONNECTION_CATEGORIES[category])
+        #One extra id tells us if there is another page.
+        page_ids[category] = heapq.nsmallest(page_size + 1, ids if after is None
+                                             else (acc_id for acc_id in ids if acc_id > after))
+
+    accounts = {acc.id: acc.to_dict()
+                for acc in get_accounts({acc_id for ids in page_ids.values() for acc_id in ids})}
+    pages = {}
+    for category, ids in page_ids.items():
+        next_cursor = ids[page_size - 1] if len(ids) > page_size else None
+        pages[category] = ([accounts[acc_id] for acc_id in ids[:page_size] if acc_id in accounts],
+                           next_cursor)
+    return pages
+
+def get_friends_and_postable(acc):
+    '''
+    Gets an account's current friends and the name and profile image lookup used by
+        profile.html for the account and every account that has been friends with it.
+    P:
+        acc(Account): The timeline owner.
+    R:
+        Tuple of (list of friend Account dictionaries,
+            dictionary in the form of Account.to_post_data for all of those accounts).
+    '''
+    edges = get_graph().get(acc.id)
     friends = []
     postable = {}
     postable.update(acc.to_post_data())
-
-    for friend in raw_friends:
-        friends.append(friend.to_dict())
-
-    for user in raw_postable:
+    for user in get_accounts(edges.ever_friends):
         postable.update(user.to_post_data())
+        if user.id in edges.friends:
+            friends.append(user.to_dict())
+    return friends, postable
+
+def process_timeline(raw_timeline, caller_acc_id, caller_friends = None):
+    '''
+    Processes a page of Posts for profile.html.
+    P:
+        raw_timeline(list): Posts to be rendered.
+        caller_acc_id(int): Account.id of the account that is rendering the page
+        caller_friends(list): List of Account.ids for caller's friends (None on the caller's own page)
+    R:
+        Dictionary with the template fields timeline, likedPosts, userReactions and numLikes.
+    '''
+    post_ids = [post.id for post in raw_timeline]
+
+    #Only the caller's own reactions are needed, the totals come from Post.like_count.
+    user_reactions = {}
+    if post_ids:
+        rows = db.session.query(Reaction.responding_to, Reaction.id).filter(
+            Reaction.responding_to.in_(post_ids), Reaction.poster_id == caller_acc_id,
+            Reaction.deleted_at == None).all()
+        user_reactions = {row.responding_to: row.id for row in rows}
+    num_likes = {post.id: post.like_count for post in raw_timeline}
+
+    #The caller's likes still waiting in the write-behind buffer (0 stands in for the id).
+    buffer = get_reaction_buffer()
+    if buffer is not None:
+        for post_id, liked in buffer.pending_for(caller_acc_id, post_ids).items():
+            if liked and post_id not in user_reactions:
+                user_reactions[post_id] = 0
+                num_likes[post_id] += 1
+            elif not liked and post_id in user_reactions:
+                del user_reactions[post_id]
+                num_likes[post_id] -= 1
+    liked_posts = list(user_reactions)
+
+    processed_timeline = Post.process_batch(raw_timeline, caller_acc_id, caller_friends,
+                                            user_reactions)
+    for processed in processed_timeline:
+        processed['likeCount'] = num_likes[processed['id']]
+
+    return {'timeline': processed_timeline, 'likedPosts': liked_posts,
+            'userReactions': user_reactions, 'numLikes': num_likes}
+
+@pages_bp.route('/profile')
+@jwt_required()
+def home_page():
+    """Renders the profile page with data for the current user."""
+    acc = current_user
+    friends, postable = get_friends_and_postable(acc)
 
-    raw_timeline = Post.query.filter_by(posted_on_id=get_jwt_identity(),
-                                    deleted_at=None).order_by(Post.id.desc()).all()
-    processed_timeline = []
-    for pst in raw_timeline:
-        processed_timeline.append(pst.process(get_jwt_identity()))
-
-    liked_posts = []
-    liked_reactions = []
-    for post in raw_timeline:
-        for reaction in post.reactions:
-            if reaction.poster_id == get_jwt_identity():
-                if reaction.deleted_at is None:
-                    liked_posts.append(post.id)
-                    liked_reactions.append(reaction.id)
-
-    user_reactions = {liked_posts[i]: liked_reactions[i] for i in range(len(liked_posts))}
-
-    posts = []
-    num_likes = []
-    for post in raw_timeline:
-        posts.append(post.id)
-        count_likes = 0
-        for reaction in post.reactions:
-            if reaction.deleted_at is None:
-                count_likes = count_likes+1
-        num_likes.append(count_likes)
-
-    num_likes = {posts[i]: num_likes[i] for i in range(len(posts))}
+    raw_timeline, next_cursor = get_timeline_page(acc.id, request.args.get('before', type=int))
 
     return render_template('profile.html', account = acc.to_dict(), friends = friends,
-                           timeline = processed_timeline, postable=postable,
-                           pageOwner=get_jwt_identity(), user = acc,
-                           likedPosts = liked_posts, userReactions=user_reactions,
-                           numLikes=num_likes)
+                           postable=postable, pageOwner=acc.id, user = acc,
+                           nextCursor=next_cursor, postCount=acc.post_count,
+                           morePath=url_for('pages.timeline_more', acc_id=acc.id),
+                           **process_timeline(raw_timeline, acc.id))
 
 @pages_bp.route('/timeline/<int:acc_id>')
 @jwt_required()
 def timeline(acc_id):
     """Renders the profile page with data for a different user."""
-    if acc_id == get_jwt_identity():
-        return redirect(url_for('homePage'))
+    my_acc = current_user
+    if acc_id == my_acc.id:
+        return redirect(url_for('pages.home_page'))
 
-    permission = can_make_content(acc_id, get_jwt_identity())
+    permission = can_make_content(acc_id, my_acc.id)
     if permission == 2:
         abort(401, description="Profile is private.")
     elif permission == 3:
         abort(401, description="You are not friends.")
 
-    my_acc = Account.query.filter_by(id=get_jwt_identity()).first()
-    target_acc = Account.query.filter_by(id=acc_id).first()
-
-    # Gets all the accounts that are friends with the caller.
-    all_my_friends = db.session.query(Account).join( Relationship,
-                                            (Relationship.first_acc_id == get_jwt_identity())
-                                            & (Relationship.second_acc_id == Account.id)
-                                            & (Relationship.confirmed_relation == True)
-                                            & (Relationship.is_friend_relation == True)).all()
-    all_my_friends_ids = [account.id for account in all_my_friends]
-
-    # Gets all the accounts that are friends with the user.
-    raw_t_friends = db.session.query(Account).join( Relationship,
-                                            (Relationship.first_acc_id == acc_id)
-                                            & (Relationship.second_acc_id == Account.id)
-                                            & (Relationship.confirmed_relation == True)
-                                            & (Relationship.is_friend_relation == True)
-                                            & (Relationship.deleted_at == None)).all()
-    raw_t_postable = db.session.query(Account).join( Relationship,
-                                            (Relationship.first_acc_id == acc_id)
-                                            & (Relationship.second_acc_id == Account.id)
-                                            & (Relationship.confirmed_relation == True)
-                                            & (Relationship.is_friend_relation == True)).all()
-
-    targ_friends = []
-    postable = {}
-    postable.update(target_acc.to_post_data())
-
-    for friend in raw_t_friends:
-        targ_friends.append(friend.to_dict())
-
-    for user in raw_t_postable:
-        postable.update(user.to_post_data())
-
-    raw_timeline = Post.query.filter_by(posted_on_id=acc_id,
-                                    deleted_at=None).order_by(Post.id.desc()).all()
-    processed_timeline = []
-    for pst in raw_timeline:
-        processed_timeline.append(pst.process(my_acc.id, all_my_friends_ids))
-
-    liked_posts = []
-    liked_reactions = []
-    for post in raw_timeline:
-        for reaction in post.reactions:
-            if reaction.poster_id == get_jwt_identity():
-                if reaction.deleted_at is None:
-                    liked_posts.append(post.id)
-                    liked_reactions.append(reaction.id)
-
-    user_reactions = {liked_posts[i]: liked_reactions[i]
-                      for i in range(len(liked_posts))}
-
-    posts = []
-    num_likes = []
-    for post in raw_timeline:
-        posts.append(post.id)
-        count_likes = 0
-        for reaction in post.reactions:
-            if reaction.deleted_at is None:
-                count_likes = count_likes+1
-        num_likes.append(count_likes)
-
-    num_likes = {posts[i]: num_likes[i] for i in range(len(posts))}
+    target_acc = db.session.get(Account, acc_id)
+    targ_friends, postable = get_friends_and_postable(target_acc)
 
+    raw_timeline, next_cursor = get_timeline_page(acc_id, request.args.get('before', type=int))
 
     return render_template('profile.html', account = target_acc.to_dict(),
-                           friends = targ_friends, timeline = processed_timeline,
-                           postable=postable, pageOwner=acc_id, user=my_acc,
-                           userReactions=user_reactions, likedPosts=liked_posts,
-                           numLikes=num_likes)
+                           friends = targ_friends, postable=postable,
+                           pageOwner=acc_id, user=my_acc,
+                           nextCursor=next_cursor, postCount=target_acc.post_count,
+                           morePath=url_for('pages.timeline_more', acc_id=acc_id),
+                           **process_timeline(raw_timeline, my_acc.id,
+                                              get_graph().get(my_acc.id).ever_friends))
+
+@pages_bp.route('/timeline/<int:acc_id>/more')
+@jwt_required()
+def timeline_more(acc_id):
+    '''
+    Renders the next page of posts for a timeline (the caller's own included).
+    Request args are expected to have before(int): the cursor handed out with the previous page.
+    R:
+        The rendered posts with the cursor for the following page in the X-Next-Cursor header
+            (empty if there are no more posts).
+    '''
+    before = request.args.get('before', type=int)
+    if before is None:
+        abort(400, description="A cursor is required.")
+
+    my_acc = current_user
+    if acc_id == my_acc.id:
+        target_acc = my_acc
+        caller_friends = None
+    else:
+        permission = can_make_content(acc_id, my_acc.id)
+        if permission == 2:
+            abort(401, description="Profile is private.")
+        elif permission == 3:
+            abort(401, description="You are not friends.")
+        target_acc = db.session.get(Account, acc_id)
+        caller_friends = get_graph().get(my_acc.id).ever_friends
+
+    raw_timeline, next_cursor = get_timeline_page(acc_id, before)
+
+    response = make_response(render_template('timeline_posts.html',
+                                             account = target_acc.to_dict(),
+                                             postable=get_friends_and_postable(target_acc)[1],
+                                             pageOwner=acc_id, user=my_acc,
+                                             **process_timeline(raw_timeline, my_acc.id,
+                                                                caller_friends)))
+    response.headers['X-Next-Cursor'] = '' if next_cursor is None else str(next_cursor)
+    return response
 
 @pages_bp.route('/friends')
 @jwt_required()
 def friend_page():
-    """Renders the friends page for the current user."""
-    acc = Account.query.filter_by(id=get_jwt_identity()).first()
-
-    # friends = db.session.query(Account).join( Relationship, (Relationship.first_acc_id == acc.id) & (Relationship.second_acc_id == Account.id) & (Relationship.confirmed_relation == True) & (Relationship.is_friend_relation == True) & (Relationship.deleted_at == None)).all()
-    # pending = db.session.query(Account).join( Relationship, (Relationship.first_acc_id == Account.id) & (Relationship.second_acc_id == acc.id) & (Relationship.confirmed_relation == False) & (Relationship.is_friend_relation == True) & (Relationship.deleted_at == None)).all()
-    # blocked = db.session.query(Account).join( Relationship, (Relationship.first_acc_id == acc.id) & (Relationship.second_acc_id == Account.id) & (Relationship.is_friend_relation == False) & (Relationship.deleted_at == None)).all()
-
-    friends = db.session.query(Account).join( Relationship, (Relationship.first_acc_id == acc.id)
-                                        & (Relationship.second_acc_id == Account.id)
-                                        & (Relationship.confirmed_relation == True)
-                                        & (Relationship.is_friend_relation == True)
-                                        & (Relationship.deleted_at == None)).all()
-    pending = db.session.query(Account).join( Relationship,
-                                        (Relationship.first_acc_id == Account.id)
-                                        & (Relationship.second_acc_id == acc.id)
-                                        & (Relationship.confirmed_relation == False)
-                                        & (Relationship.is_friend_relation == True)
-                                        & (Relationship.deleted_at == None)).all()
-    blocked = db.session.query(Account).join( Relationship, (Relationship.first_acc_id == acc.id)
-                                        & (Relationship.second_acc_id == Account.id)
-                                        & (Relationship.is_friend_relation == False)
-                                        & (Relationship.deleted_at == None)).all()
-    friends_processed = [fren.to_dict() for fren in friends]
-    pending_processed = [pend.to_dict() for pend in pending]
-    blocked_processed = [blck.to_dict() for blck in blocked]
+    '''
+    Renders the friends page for the current user, a page of each list at a time.
+    Request args may have friendsAfter, pendingAfter and blockedAfter(int): the cursors
+        handed out with the previous page of that list.
+    '''
+    acc = current_user
+
+    edges = get_graph().get(acc.id)
+    pages = get_connection_pages(edges, {
+        'friends': request.args.get('friendsAfter', type=int),
+        'pending': request.args.get('pendingAfter', type=int),
+        'blocked': request.args.get('blockedAfter', type=int)
+    })
 
     return render_template('friends.html', account = acc.to_dict(),
-                           friends = friends_processed,
-                           pending = pending_processed,
-                           blocked = blocked_processed)
+                           friends = pages['friends'][0],
+                           pending = pages['pending'][0],
+                           blocked = pages['blocked'][0],
+                           counts = edges.counts(),
+                           cursors = {category: page[1] for category, page in pages.items()},
+                           suggestions = [dict(other.to_dict(), mutualFriends=mutual_count)
+                                          for other, mutual_count in get_suggestions(
+                                              acc.id, edges,
+                                              current_app.config['SUGGESTIONS_LIMIT'])])
 
 @pages_bp.route('/signup')
 def sign_up_page():
@@ -211,6 +284,4 @@ def sign_up_page():
 @jwt_required()
 def settings_page():
     """Renders settings page for current user."""
-    user_acc_id = get_jwt_identity()
-    acc = Account.query.filter_by(id=user_acc_id).first()
-    return render_template('settings.html', account = acc.to_dict())
+    return render_template('settings.html', account = current_user.to_dict())
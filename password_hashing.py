@@ -0,0 +1,109 @@
+"""This is the module for password hashing in the Facebook imitation app 'Y'.
+bcrypt runs on a bounded process pool so login storms do not pin the request threads.
+The module imports nothing from the app so the pool's worker processes stay light."""
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+import bcrypt
+from flask import current_app
+
+class HashingBusyError(Exception):
+    """Raised when too many hash jobs are already waiting for the pool."""
+
+#Run inside the pool's worker processes.
+def _hash(password, rounds):
+    """Hashes a password with the given bcrypt cost."""
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check(password, password_hash):
+    """Compares a password to a bcrypt hash."""
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+    except ValueError:
+        #Not a bcrypt hash
+        return False
+
+class PasswordHasher:
+    """Hashes and checks passwords on a process pool with a bounded queue."""
+
+    def __init__(self, workers, max_queue, rounds):
+        '''
+        Constructor for PasswordHasher.
+        P:
+            workers(int): Worker processes (0 runs bcrypt inline in the calling thread)
+            max_queue(int): Jobs allowed to be running or waiting before HashingBusyError
+            rounds(int): bcrypt cost for new hashes
+        '''
+        self.rounds = rounds
+        self.max_queue = max_queue
+        self._pool = None
+        if workers > 0:
+            #spawn, since forking a threaded server process is unsafe.
+            self._pool = ProcessPoolExecutor(max_workers=workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        self._lock = Lock()
+        self._in_flight = 0
+        self._peak = 0
+        self._completed = 0
+        self._rejected = 0
+        self._seconds = 0.0
+
+    def hash(self, password):
+        """Returns the bcrypt hash of a password at the configured cost."""
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, password, password_hash):
+        """Returns True if the password matches the hash."""
+        if password is None or password_hash is None:
+            return False
+        return self._run(_check, password, password_hash)
+
+    def needs_rehash(self, password_hash):
+        """Returns True if the hash was made with a different cost than the configured one."""
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (AttributeError, IndexError, ValueError):
+            return True
+
+    def stats(self):
+        '''
+        Gets the pool's counters.
+        R:
+            Dictionary of in_flight (running or queued now), peak_in_flight, completed,
+                rejected and seconds (total time callers waited on bcrypt).
+        '''
+        with self._lock:
+            return {'in_flight': self._in_flight, 'peak_in_flight': self._peak,
+                    'completed': self._completed, 'rejected': self._rejected,
+                    'seconds': self._seconds}
+
+    def _run(self, func, *args):
+        """Runs a job on the pool (or inline), keeping the queue bounded and the counters."""
+        with self._lock:
+            if self._in_flight >= self.max_queue:
+                self._rejected += 1
+                raise HashingBusyError("Too many password checks are waiting.")
+            self._in_flight += 1
+            self._peak = max(self._peak, self._in_flight)
+
+        started = time.perf_counter()
+        try:
+            if self._pool is None:
+                return func(*args)
+            return self._pool.submit(func, *args).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+                self._seconds += time.perf_counter() - started
+
+def get_hasher():
+    """Returns the app's password hasher, creating it on first use."""
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is None:
+        hasher = PasswordHasher(current_app.config['PASSWORD_HASH_WORKERS'],
+                                current_app.config['PASSWORD_HASH_MAX_QUEUE'],
+                                current_app.config['BCRYPT_LOG_ROUNDS'])
+        current_app.extensions['password_hasher'] = hasher
+    return hasher
@@ -3,7 +3,13 @@ from datetime import datetime
 from flask import request, jsonify, Blueprint
 from flask_jwt_extended import (get_jwt_identity, jwt_required)
 from werkzeug.utils import secure_filename
-from models import (db, Post, Reaction, Reply, Account, Img, Relationship)
+from models import (db, Post, Reaction, Reply, Img, Account)
+from social_graph import get_graph
+from image_derivatives import queue_variants
+from feed import fan_out_post
+from event_hub import publish
+from reaction_buffer import get_reaction_buffer
+from current_account import get_summary, get_summaries
 
 pst_rep_rea_bp = Blueprint('pst_rep_rea', __name__)
 
@@ -32,28 +38,47 @@ def can_make_content(target_acc_id, poster_id):
         2 if the target account has gone private.
         3 if the target account is not friends with the poster.
     '''
-    if int(target_acc_id) == poster_id:
-        return 1
-
-    target_acc = Account.query.filter_by(id = target_acc_id).first()
-
-    if target_acc is not None:
-        if not target_acc.is_public:
-            return 2
-
-        rel = Relationship.query.filter_by(first_acc_id = target_acc.id,
-                                           second_acc_id = poster_id, deleted_at = None,
-                                           is_friend_relation = True).first()
-        if rel is not None:
-            return 1
-    #Not the same account, and Poster is not friend with target account.
-    return 3
-
-def soft_delete_objects(listing) -> None:
-    """"Soft deletes the listing of objects passed."""
-    for item in listing:
-        item.deleted_at = datetime.now()
-    db.session.commit()
+    target_acc_id = int(target_acc_id)
+    return content_permissions([target_acc_id], poster_id)[target_acc_id]
+
+def content_permissions(target_acc_ids, poster_id):
+    '''
+    can_make_content for several timelines, looking their accounts up together.
+    P:
+        target_acc_ids(iterable): Account.ids of the timelines
+        poster_id(int): Account id of the one who wants to post.
+    R:
+        Dictionary of Account.id to the result of can_make_content.
+    '''
+    target_acc_ids = {int(target_acc_id) for target_acc_id in target_acc_ids}
+    targets = get_summaries(target_acc_ids - {poster_id})
+    permissions = {}
+    for target_acc_id in target_acc_ids:
+        target_acc = targets.get(target_acc_id)
+        if target_acc_id == poster_id:
+            permissions[target_acc_id] = 1
+        elif target_acc is None or target_acc.deleted:
+            permissions[target_acc_id] = 3
+        elif not target_acc.is_public:
+            permissions[target_acc_id] = 2
+        else:
+            #Any live friend relation from the target to the poster (confirmed or requested).
+            edges = get_graph().get(target_acc_id)
+            related = poster_id in edges.friends or poster_id in edges.pending_out
+            permissions[target_acc_id] = 1 if related else 3
+    return permissions
+
+def can_remove_content(containing_post, content_poster_id, acc_id):
+    '''
+    Determines if an account may delete a post, reply or reaction.
+    P:
+        containing_post(Post): The post itself, or the post the reply or reaction is on
+        content_poster_id(int): Account.id of the one who made the post, reply or reaction
+        acc_id(int): Account.id of the one who wants to delete it
+    R:
+        True for its creator and for the owner of the timeline it is on.
+    '''
+    return acc_id in (containing_post.posted_on_id, content_poster_id)
 
 @pst_rep_rea_bp.route('/api/post', methods=['POST'])
 @jwt_required()
@@ -70,12 +95,11 @@ def make_post():
         or request.form.get('postedOnID') is None):
         return  make_error(400, "Invalid request recieved.")
 
-    target_account = Account.query.filter_by(id = request.form.get('postedOnID'),
-                                             deleted_at = None).first()
+    target_account = get_summary(request.form.get('postedOnID'))
     if target_account is None:
         return make_error(400, "Can't find that person to post on.")
 
-    permission = can_make_content(request.form.get('postedOnID'), get_jwt_identity())
+    permission = can_make_content(target_account.id, get_jwt_identity())
 
     if permission == 2:
         return make_error(400, "You do not have permission to post right now.")
@@ -96,11 +120,12 @@ def make_post():
         if len(image) < 60000:
 
             mimetype = pic.mimetype
-            img = Img(img=image, mimetype=mimetype, name=filename)
+            img = Img.create(image, filename, mimetype)
 
             # Store the image object
             db.session.add(img)
             db.session.commit()
+            queue_variants(img)
 
             # Get the image id
             img_id = img.id
@@ -114,7 +139,11 @@ def make_post():
         return make_error(400, "Only one image may be uploaded at a time.")
 
     db.session.add(new_post)
+    db.session.flush()
+    fan_out_post(new_post)
+    Account.change_post_counts({target_account.id: 1})
     db.session.commit()
+    publish([target_account.id], 'timelinePost', get_jwt_identity(), postId=new_post.id)
 
     return "OK", 200 #returning "OK"
 
@@ -136,6 +165,7 @@ def edit_post(post_id):
 
     target_post.text_content = request.form.get('textContent')
     target_post.edited_at = datetime.now()
+    target_post.updated_at = target_post.edited_at
     db.session.commit()
 
     return "OK", 200 #returning "OK"
@@ -150,12 +180,15 @@ def delete_post(post_id):
     if target_post is None:
         return make_error(400, "Unable to find the post to delete.") #Request made was bad
 
-    if (target_post.posted_on_id == get_jwt_identity()
-        or target_post.poster_id == get_jwt_identity()):
-        #DEL
-        soft_delete_objects(target_post.replies)
-        soft_delete_objects(target_post.reactions)
+    if can_remove_content(target_post, target_post.poster_id, get_jwt_identity()):
+        #The post, its replies and its reactions are deleted together in one transaction.
+        if target_post.deleted_at is None:
+            Account.change_post_counts({target_post.posted_on_id: -1})
+        target_post.like_count = 0
+        target_post.reply_count = 0
         target_post.deleted_at = datetime.now()
+        target_post.updated_at = target_post.deleted_at
+        Post.cascade_delete([target_post.id], target_post.deleted_at)
         db.session.commit()
         return "Done", 200
 
@@ -180,8 +213,7 @@ def make_reply():
     if target_post is None:
         return make_error(400, "The post you are trying to respond to has been deleted.")
 
-    target_account = Account.query.filter_by(id = target_post.posted_on_id,
-                                             deleted_at = None).first()
+    target_account = get_summary(target_post.posted_on_id)
     if target_account is None:
         return make_error(400, "The post you are trying to respond to has been deleted.")
 
@@ -194,7 +226,11 @@ def make_reply():
     new_reply = Reply(request.form.get('respTo'),
                       get_jwt_identity(), request.form.get('textContent'))
     db.session.add(new_reply)
+    target_post.reply_count = Post.reply_count + 1
+    target_post.updated_at = new_reply.created_at
     db.session.commit()
+    publish([target_post.poster_id, target_post.posted_on_id], 'reply', get_jwt_identity(),
+            postId=target_post.id, replyId=new_reply.id)
     return "Okay", 200
 
 @pst_rep_rea_bp.route('/api/reply/<int:reply_id>', methods=['DELETE'])
@@ -210,10 +246,11 @@ def delete_reply(reply_id):
 
     containing_post = Post.query.filter_by(id=target.responding_to).first()
 
-    if (containing_post.posted_on_id == get_jwt_identity()
-        or target.poster_id == get_jwt_identity()):
+    if can_remove_content(containing_post, target.poster_id, get_jwt_identity()):
 
         target.deleted_at = datetime.now()
+        containing_post.reply_count = Post.reply_count - 1
+        containing_post.updated_at = target.deleted_at
         db.session.commit()
         return "Done", 200
 
@@ -229,48 +266,72 @@ def make_reaction():
     Request is expected to have following form fields:
         reactionType(int): Type of reaction (for now just 1)
         respTo(int): Post.id of the post the reaction is linked to.
+    With REACTION_WRITE_BEHIND on the like is only buffered (see reaction_buffer).
     '''
     if (request.form.get('reactionType') is None
         or request.form.get('respTo') is None):
         return make_error(400, "Invalid request recieved.")
 
+    buffer = get_reaction_buffer()
+    if buffer is not None:
+        if request.form.get('respTo', type=int) is None:
+            return make_error(400, "Invalid request recieved.")
+        buffer.toggle(request.form.get('respTo', type=int), get_jwt_identity(), True)
+        return "OK", 200
+
     target_post = Post.query.filter_by(id = request.form.get('respTo'),
                                        deleted_at = None).first()
     if target_post is None:
         return make_error(400, "The post you are trying to react to has been deleted.")
 
-    for reaction in target_post.reactions:
-        if (reaction.poster_id == get_jwt_identity()
-            and reaction.deleted_at is not None):
+    past_reactions = Reaction.query.filter_by(responding_to = target_post.id,
+                                              poster_id = get_jwt_identity()).all()
 
-            reaction.deleted_at = None
-            db.session.commit()
+    #Already liked, nothing to count again.
+    if any(reaction.deleted_at is None for reaction in past_reactions):
+        return "OK", 200
 
-            return "OK", 200
+    if past_reactions:
+        past_reactions[0].deleted_at = None
+    else:
+        new_reaction = Reaction(res_to=target_post.id, poster_id=get_jwt_identity())
+        db.session.add(new_reaction)
 
-    new_reaction = Reaction(res_to=request.form.get('respTo'),
-                            poster_id=get_jwt_identity())
-    db.session.add(new_reaction)
+    target_post.like_count = Post.like_count + 1
+    target_post.updated_at = datetime.now()
     db.session.commit()
+    publish([target_post.poster_id], 'like', get_jwt_identity(), postId=target_post.id)
 
     return "OK", 200
 
 @pst_rep_rea_bp.route('/api/reaction/<int:reaction_id>', methods=['DELETE'])
 @jwt_required()
 def delete_reaction(reaction_id):
-    """Deletes reaction if caller is the creator."""
+    '''
+    Deletes reaction if caller is the creator.
+    With REACTION_WRITE_BEHIND on, a request whose form has respTo(int) buffers an unlike of
+        the caller's own reaction on that post instead (the id may be 0 for an unwritten like).
+    '''
     requester_id = get_jwt_identity()
 
+    buffer = get_reaction_buffer()
+    if buffer is not None and request.form.get('respTo', type=int) is not None:
+        buffer.toggle(request.form.get('respTo', type=int), requester_id, False)
+        return "Done", 200
+
     target = Reaction.query.filter_by(id=reaction_id).first()
     if target is None:
         return make_error(400) #Request made was bad
 
     containing_post = Post.query.filter_by(id=target.responding_to).first()
 
-    if requester_id in (containing_post.posted_on_id, target.poster_id):
+    if can_remove_content(containing_post, target.poster_id, requester_id):
 
-        target.deleted_at = datetime.now()
-        db.session.commit()
+        if target.deleted_at is None:
+            target.deleted_at = datetime.now()
+            containing_post.like_count = Post.like_count - 1
+            containing_post.updated_at = target.deleted_at
+            db.session.commit()
         return "Done", 200
 
     return make_error(401)
@@ -0,0 +1,184 @@
+"""This is the module for purging soft deleted rows in the Facebook imitation app 'Y'.
+Deleting a post, reply, reaction, relationship or image only stamps deleted_at, so the rows
+would stay in every index forever. 'flask purge' (meant to be run by cron) removes the rows that
+were deleted more than PURGE_RETENTION_DAYS ago for good, PURGE_BATCH_SIZE rows per transaction
+with a PURGE_PAUSE second pause between transactions, so it never holds locks for long.
+Removed friendships are kept: social_graph builds ever_friends from them, which decides whose
+    names show on old posts.
+Img rows are never deleted by the app itself. One run stamps the images no Account or Post uses
+    any more, a run after the retention window removes them if they are still unused (uploads
+    are committed before the post or account that uses them, so an image can look unused for
+    a moment). Their bytes and derivatives leave the image store once no Img row has the same
+    content hash."""
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import exists, or_
+from models import db, Account, Post, Reply, Reaction, Relationship, Img, ImgVariant, FeedEntry
+from image_store import get_store
+from db_retry import run_transaction
+
+#Rows that point at a purged row and go with it: model -> [(dependent model, its column)].
+DEPENDENTS = {
+    Post: [(FeedEntry, FeedEntry.post_id), (Reply, Reply.responding_to),
+           (Reaction, Reaction.responding_to)]
+}
+
+def image_unused():
+    """Returns the condition of an Img no Account or Post points at."""
+    return ~or_(exists().where(Account.profile_image_id == Img.id),
+                exists().where(Account.cover_image_id == Img.id),
+                exists().where(Post.associated_image_id == Img.id))
+
+def purge_batch(model, condition, batch_size):
+    '''
+    Deletes one batch of rows, and the rows that depend on them, in one transaction.
+    P:
+        model(Model): Table to purge
+        condition: Which of its rows to delete
+        batch_size(int): Most rows deleted
+    R:
+        Number of rows deleted.
+    '''
+    ids = [row.id for row in db.session.query(model.id).filter(condition)
+           .order_by(model.id).limit(batch_size)]
+    if ids:
+        for dependent, column in DEPENDENTS.get(model, ()):
+            db.session.execute(db.delete(dependent).where(column.in_(ids))
+                               .execution_options(synchronize_session=False))
+        db.session.execute(db.delete(model).where(model.id.in_(ids))
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+    return len(ids)
+
+def purge_images_batch(cutoff, batch_size):
+    '''
+    Deletes one batch of unused Img rows marked before the cutoff, then the files and
+        derivatives of content no Img has any more.
+    R:
+        Number of Img rows deleted.
+    '''
+    rows = (db.session.query(Img.id, Img.content_hash)
+            .filter(Img.deleted_at < cutoff, image_unused())
+            .order_by(Img.id).limit(batch_size).all())
+    if not rows:
+        return 0
+    db.session.execute(db.delete(Img).where(Img.id.in_([row.id for row in rows]))
+                       .execution_options(synchronize_session=False))
+
+    hashes = {row.content_hash for row in rows if row.content_hash is not None}
+    #The same bytes uploaded twice share one file, it stays while another Img has it.
+    hashes -= {row.content_hash for row in
+               db.session.query(Img.content_hash).filter(Img.content_hash.in_(hashes))}
+    files = set(hashes)
+    if hashes:
+        files.update(row.content_hash for row in db.session.query(ImgVariant.content_hash)
+                     .filter(ImgVariant.source_hash.in_(hashes)))
+        db.session.execute(db.delete(ImgVariant).where(ImgVariant.source_hash.in_(hashes))
+                           .execution_options(synchronize_session=False))
+        #A derivative can come out byte for byte the same as another image or derivative.
+        files -= {row.content_hash for row in
+                  db.session.query(Img.content_hash).filter(Img.content_hash.in_(files))}
+        files -= {row.content_hash for row in db.session.query(ImgVariant.content_hash)
+                  .filter(ImgVariant.content_hash.in_(files))}
+    db.session.commit()
+
+    #Files go after their rows are committed: a crash leaves a stray file, never a broken Img.
+    store = get_store()
+    for content_hash in files:
+        store.delete(content_hash)
+    return len(rows)
+
+def mark_images_batch(now, after_id, batch_size):
+    '''
+    Stamps the unused images among the next batch of unmarked ones.
+    P:
+        now(datetime): Time stamped on them
+        after_id(int): Img.id the previous batch ended at
+    R:
+        (Img.id this batch ended at or None when there are no more, number marked).
+    '''
+    ids = [row.id for row in db.session.query(Img.id)
+           .filter(Img.deleted_at == None, Img.id > after_id).order_by(Img.id).limit(batch_size)]
+    if not ids:
+        return None, 0
+    result = db.session.execute(db.update(Img).where(Img.id.in_(ids), image_unused())
+                                .values(deleted_at=now)
+                                .execution_options(synchronize_session=False))
+    db.session.commit()
+    return ids[-1], result.rowcount
+
+def restore_images():
+    '''
+    Clears deleted_at of marked images that got used after all.
+    R:
+        Number of images restored.
+    '''
+    result = db.session.execute(db.update(Img).where(Img.deleted_at != None, ~image_unused())
+                                .values(deleted_at=None)
+                                .execution_options(synchronize_session=False))
+    db.session.commit()
+    return result.rowcount
+
+def in_batches(work, batch_size, pause, *args):
+    '''
+    Runs a batch job until a batch comes back short, pausing between batches.
+    P:
+        work(function): Does one batch in one transaction and returns its row count,
+            called with args and then batch_size
+        batch_size(int): Rows per batch
+        pause(float): Seconds to sleep between batches
+    R:
+        Total rows.
+    '''
+    total = 0
+    while True:
+        count = run_transaction(work, *args, batch_size)
+        total += count
+        if count < batch_size:
+            return total
+        time.sleep(pause)
+
+def purge(retention_days=None, batch_size=None, pause=None, echo=print):
+    '''
+    Removes the rows soft deleted before the retention window, see the module docstring.
+    P:
+        retention_days(float): Days deleted rows are kept (default PURGE_RETENTION_DAYS)
+        batch_size(int): Rows per transaction (default PURGE_BATCH_SIZE)
+        pause(float): Seconds between transactions (default PURGE_PAUSE)
+        echo(function): Called with a line of progress for each table
+    R:
+        Dictionary of rows removed per table.
+    '''
+    config = current_app.config
+    retention_days = config['PURGE_RETENTION_DAYS'] if retention_days is None else retention_days
+    batch_size = config['PURGE_BATCH_SIZE'] if batch_size is None else batch_size
+    pause = config['PURGE_PAUSE'] if pause is None else pause
+    now = datetime.now()
+    cutoff = now - timedelta(days=retention_days)
+    removed = {}
+
+    #Posts first, their replies, reactions and feed entries go in the same transactions.
+    for name, model, condition in (
+            ('posts', Post, Post.deleted_at < cutoff),
+            ('replies', Reply, Reply.deleted_at < cutoff),
+            ('reactions', Reaction, Reaction.deleted_at < cutoff),
+            ('relationships', Relationship,
+             (Relationship.deleted_at < cutoff) & or_(Relationship.is_friend_relation == False,
+                                                      Relationship.confirmed_relation == False))):
+        removed[name] = in_batches(purge_batch, batch_size, pause, model, condition)
+        echo(f"Purged {removed[name]} {name}.")
+
+    removed['images'] = in_batches(purge_images_batch, batch_size, pause, cutoff)
+    restored = run_transaction(restore_images)
+    #Images of the posts purged above are only marked now and go on a run after the window.
+    marked = 0
+    after_id = 0
+    while after_id is not None:
+        after_id, count = run_transaction(mark_images_batch, now, after_id, batch_size)
+        marked += count
+        if after_id is not None:
+            time.sleep(pause)
+    echo(f"Purged {removed['images']} images, marked {marked} newly unused ones "
+         f"({restored} marked ones were in use again).")
+    return removed
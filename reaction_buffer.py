@@ -0,0 +1,180 @@
+"""This is the module for the write-behind like buffer of the Facebook imitation app 'Y'.
+With REACTION_WRITE_BEHIND on, like and unlike clicks only record the caller's latest choice
+per post in memory and return. A background thread writes the net changes in one transaction
+every REACTION_FLUSH_INTERVAL seconds, or sooner once REACTION_FLUSH_SIZE choices are waiting,
+so a like followed by an unlike never reaches the database.
+
+Durability: a click is acknowledged before it is written. Choices still in the buffer when the
+process dies are lost (at most one interval's worth); a normal shutdown flushes them. Each
+worker process has its own buffer, so if one user's clicks are spread over several workers
+their order between workers is not kept. Leave the setting off (the default) for the old
+synchronous writes."""
+import atexit
+from datetime import datetime
+from threading import Condition, Thread
+from flask import current_app
+from models import db, Post, Reaction
+from event_hub import publish
+from db_retry import run_transaction
+
+class ReactionBuffer:
+    """Latest like state per (post, account) waiting to be written, flushed by a daemon thread."""
+
+    def __init__(self, app, interval, max_pending):
+        '''
+        Constructor for ReactionBuffer.
+        P:
+            app(Flask): The app the flush thread runs in
+            interval(float): Seconds between flushes
+            max_pending(int): Waiting choices that trigger an early flush
+        '''
+        self.app = app
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}   #Post.id -> {Account.id: True for like, False for unlike}
+        self._size = 0
+        self._ready = Condition()
+        self._thread = None
+
+    def toggle(self, post_id, acc_id, liked):
+        '''
+        Records a like or unlike. Replaces any earlier choice of the account on the post.
+        P:
+            post_id(int): Post.id being liked (checked when flushed)
+            acc_id(int): Account.id of the caller
+            liked(bool): True for like, False for unlike
+        '''
+        with self._ready:
+            choices = self._pending.setdefault(post_id, {})
+            if acc_id not in choices:
+                self._size += 1
+            choices[acc_id] = liked
+            if self._size >= self.max_pending:
+                self._ready.notify()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name='reaction-flush', daemon=True)
+                self._thread.start()
+
+    def pending_for(self, acc_id, post_ids):
+        '''
+        Gets an account's unwritten choices so pages show the caller's own clicks right away.
+        P:
+            acc_id(int): Account.id of the caller
+            post_ids(iterable): Post.ids on the page
+        R:
+            Dictionary of Post.id to True (like) or False (unlike).
+        '''
+        with self._ready:
+            return {post_id: self._pending[post_id][acc_id] for post_id in post_ids
+                    if acc_id in self._pending.get(post_id, ())}
+
+    def flush(self):
+        '''
+        Writes every waiting choice in one transaction. Needs an app context.
+        If the write fails the choices go back in the buffer (behind newer ones) and it raises.
+        R:
+            Number of likes added or removed.
+        '''
+        with self._ready:
+            pending, self._pending, self._size = self._pending, {}, 0
+        if not pending:
+            return 0
+        try:
+            return run_transaction(write_choices, pending)
+        except Exception:
+            db.session.rollback()
+            with self._ready:
+                for post_id, choices in pending.items():
+                    current = self._pending.setdefault(post_id, {})
+                    for acc_id, liked in choices.items():
+                        if acc_id not in current:
+                            current[acc_id] = liked
+                            self._size += 1
+            raise
+
+    def _run(self):
+        """Flushes every interval, or when the buffer fills, forever."""
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self._size >= self.max_pending, self.interval)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as error:
+                    self.app.logger.warning("Could not flush reactions: %s", error)
+
+    def flush_at_exit(self):
+        """Flushes what is left when the process shuts down normally."""
+        with self.app.app_context():
+            self.flush()
+
+def write_choices(pending):
+    '''
+    Applies like choices to the Reaction table and Post counters, then commits and publishes
+        like events. Choices on missing or deleted posts and choices that match the stored state
+        are dropped.
+    P:
+        pending(dict): Post.id -> {Account.id: liked}
+    R:
+        Number of likes added or removed.
+    '''
+    now = datetime.now()
+    live = {row.id: row.poster_id for row in
+            db.session.query(Post.id, Post.poster_id).filter(Post.id.in_(list(pending)),
+                                                             Post.deleted_at == None)}
+    if not live:
+        return 0
+    acc_ids = {acc_id for post_id in live for acc_id in pending[post_id]}
+    past = {}
+    for reaction in Reaction.query.filter(Reaction.responding_to.in_(list(live)),
+                                          Reaction.poster_id.in_(acc_ids)):
+        past.setdefault((reaction.responding_to, reaction.poster_id), []).append(reaction)
+
+    deltas = {}
+    new_likes = []
+    changed = 0
+    for post_id in live:
+        for acc_id, liked in pending[post_id].items():
+            reactions = past.get((post_id, acc_id), [])
+            active = [reaction for reaction in reactions if reaction.deleted_at is None]
+            if liked and not active:
+                if reactions:
+                    reactions[0].deleted_at = None
+                else:
+                    db.session.add(Reaction(res_to=post_id, poster_id=acc_id))
+                deltas[post_id] = deltas.get(post_id, 0) + 1
+                new_likes.append((post_id, acc_id))
+                changed += 1
+            elif not liked and active:
+                for reaction in active:
+                    reaction.deleted_at = now
+                deltas[post_id] = deltas.get(post_id, 0) - 1
+                changed += 1
+
+    #One UPDATE per distinct change size instead of one per post.
+    by_delta = {}
+    for post_id, delta in deltas.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(post_id)
+    for delta, post_ids in by_delta.items():
+        db.session.execute(db.update(Post).where(Post.id.in_(post_ids))
+                           .values(like_count=Post.like_count + delta, updated_at=now)
+                           .execution_options(synchronize_session=False))
+    db.session.commit()
+
+    for post_id, acc_id in new_likes:
+        publish([live[post_id]], 'like', acc_id, postId=post_id)
+    return changed
+
+def get_reaction_buffer():
+    """Returns the app's reaction buffer, or None when REACTION_WRITE_BEHIND is off."""
+    if not current_app.config['REACTION_WRITE_BEHIND']:
+        return None
+    buffer = current_app.extensions.get('reaction_buffer')
+    if buffer is None:
+        buffer = ReactionBuffer(current_app._get_current_object(),
+                                current_app.config['REACTION_FLUSH_INTERVAL'],
+                                current_app.config['REACTION_FLUSH_SIZE'])
+        current_app.extensions['reaction_buffer'] = buffer
+        atexit.register(buffer.flush_at_exit)
+    return buffer
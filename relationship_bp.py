@@ -3,6 +3,9 @@ from datetime import datetime
 from flask import (request, jsonify, Blueprint)
 from flask_jwt_extended import (get_jwt_identity, jwt_required)
 from models import (db, Relationship, Account)
+from social_graph import get_graph
+from event_hub import publish
+from suggestions import friend_added, friend_removed
 
 relationship_bp = Blueprint('relationship', __name__)
 
@@ -53,7 +56,10 @@ def send_friend_request():
         if pending_inverse.is_friend_relation:
             pending_inverse.confirmed_relation = True
             db.session.add(pending_inverse.make_inverse())
+            friend_added(get_jwt_identity(), target_account.id)
             db.session.commit()
+            get_graph().invalidate(get_jwt_identity(), target_account.id)
+            publish([target_account.id], 'friendAccepted', get_jwt_identity())
             return "OK", 200
         err = jsonify({'message':
                        "The user you are trying to friend has blocked you."})
@@ -64,6 +70,8 @@ def send_friend_request():
     new_relationship = Relationship(get_jwt_identity(), target_account.id)
     db.session.add(new_relationship)
     db.session.commit()
+    get_graph().invalidate(get_jwt_identity(), target_account.id)
+    publish([target_account.id], 'friendRequest', get_jwt_identity())
 
     return "OK", 200
 
@@ -105,6 +113,7 @@ def decline_friend_request():
 
     target_relationship.deleted_at = datetime.now()
     db.session.commit()
+    get_graph().invalidate(get_jwt_identity(), target_account.id)
 
     return "OK", 200
 
@@ -144,7 +153,10 @@ def remove_friend():
 
     target_relationship.deleted_at = datetime.now()
     target_relationship_inv.deleted_at = datetime.now()
+    if target_relationship.is_friend_relation and target_relationship.confirmed_relation:
+        friend_removed(get_jwt_identity(), target_account.id)
     db.session.commit()
+    get_graph().invalidate(get_jwt_identity(), target_account.id)
 
     return "OK", 200
 
@@ -180,10 +192,21 @@ def block_user():
     friend_req = Relationship.query.filter_by(second_acc_id = get_jwt_identity(),
                                             first_acc_id = target_account.id,
                                             deleted_at = None).first()
-    friend_req.deleted_at = datetime.now()
+    if friend_req is not None:
+        friend_req.deleted_at = datetime.now()
+        #Blocking a friend ends the friendship both ways.
+        if friend_req.is_friend_relation and friend_req.confirmed_relation:
+            own_side = Relationship.query.filter_by(first_acc_id = get_jwt_identity(),
+                                                    second_acc_id = target_account.id,
+                                                    is_friend_relation = True,
+                                                    deleted_at = None).first()
+            if own_side is not None:
+                own_side.deleted_at = friend_req.deleted_at
+            friend_removed(get_jwt_identity(), target_account.id)
 
     db.session.add(block_relationship)
     db.session.commit()
+    get_graph().invalidate(get_jwt_identity(), target_account.id)
 
     return "OK", 200
 
@@ -220,4 +243,5 @@ def unblock_user():
     if target_block is not None:
         target_block.deleted_at = datetime.now()
         db.session.commit()
+        get_graph().invalidate(get_jwt_identity(), target_account.id)
     return "OK", 200
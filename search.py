@@ -0,0 +1,274 @@
+"""This is the module for full-text search over posts and people in the Facebook imitation app 'Y'.
+The database keeps the inverted index, so a search never scans Post or Account:
+    SQLite uses FTS5 tables (post_fts, account_fts) kept up to date by triggers.
+    MySQL uses FULLTEXT indexes, which InnoDB keeps up to date itself.
+Either way the index changes in the same transaction as the row, whether it was written by
+pst_rep_rea_bp, batch_bp, account_bp or the purge job. Deleted posts and accounts leave the
+SQLite index; on MySQL they stay indexed and are filtered out by the queries.
+Queries are cut into words and every word must match as the start of a word, so results show
+up while a name is being typed. MySQL ignores words shorter than innodb_ft_min_token_size (3).
+SEARCH_BACKEND picks the backend, it defaults to the dialect of the database."""
+import re
+import sqlalchemy as sa
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import aliased
+from models import db, Account, Post
+
+WORD = re.compile(r'\w+')
+MAX_WORDS = 8
+
+#Dialect -> table -> statements that add its index. Each is safe to run again.
+SCHEMA = {
+    'sqlite': {
+        'post': [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5(text_content, content='post',"
+            " content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+            #Only live posts are indexed, so each trigger removes and adds the old and new rows
+            #that were or are live (removing a row that is not in the index corrupts it).
+            "CREATE TRIGGER IF NOT EXISTS post_fts_insert AFTER INSERT ON post"
+            " WHEN new.deleted_at IS NULL BEGIN"
+            " INSERT INTO post_fts(rowid, text_content) VALUES (new.id, new.text_content); END",
+            "CREATE TRIGGER IF NOT EXISTS post_fts_delete AFTER DELETE ON post"
+            " WHEN old.deleted_at IS NULL BEGIN"
+            " INSERT INTO post_fts(post_fts, rowid, text_content)"
+            " VALUES ('delete', old.id, old.text_content); END",
+            "CREATE TRIGGER IF NOT EXISTS post_fts_update AFTER UPDATE OF text_content, deleted_at"
+            " ON post BEGIN"
+            " INSERT INTO post_fts(post_fts, rowid, text_content)"
+            " SELECT 'delete', old.id, old.text_content WHERE old.deleted_at IS NULL;"
+            " INSERT INTO post_fts(rowid, text_content)"
+            " SELECT new.id, new.text_content WHERE new.deleted_at IS NULL; END",
+            "INSERT INTO post_fts(post_fts) VALUES ('delete-all')",
+            "INSERT INTO post_fts(rowid, text_content)"
+            " SELECT id, text_content FROM post WHERE deleted_at IS NULL"
+        ],
+        'account': [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS account_fts USING fts5(first_name, last_name,"
+            " username, content='account', content_rowid='id',"
+            " tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+            "CREATE TRIGGER IF NOT EXISTS account_fts_insert AFTER INSERT ON account"
+            " WHEN new.deleted_at IS NULL BEGIN"
+            " INSERT INTO account_fts(rowid, first_name, last_name, username)"
+            " VALUES (new.id, new.first_name, new.last_name, new.username); END",
+            "CREATE TRIGGER IF NOT EXISTS account_fts_delete AFTER DELETE ON account"
+            " WHEN old.deleted_at IS NULL BEGIN"
+            " INSERT INTO account_fts(account_fts, rowid, first_name, last_name, username)"
+            " VALUES ('delete', old.id, old.first_name, old.last_name, old.username); END",
+            "CREATE TRIGGER IF NOT EXISTS account_fts_update AFTER UPDATE OF first_name,"
+            " last_name, username, deleted_at ON account BEGIN"
+            " INSERT INTO account_fts(account_fts, rowid, first_name, last_name, username)"
+            " SELECT 'delete', old.id, old.first_name, old.last_name, old.username"
+            " WHERE old.deleted_at IS NULL;"
+            " INSERT INTO account_fts(rowid, first_name, last_name, username)"
+            " SELECT new.id, new.first_name, new.last_name, new.username"
+            " WHERE new.deleted_at IS NULL; END",
+            "INSERT INTO account_fts(account_fts) VALUES ('delete-all')",
+            "INSERT INTO account_fts(rowid, first_name, last_name, username)"
+            " SELECT id, first_name, last_name, username FROM account WHERE deleted_at IS NULL"
+        ]
+    },
+    'mysql': {
+        'post': ["ALTER TABLE post ADD FULLTEXT INDEX ft_post_text (text_content)"],
+        'account': ["ALTER TABLE account ADD FULLTEXT INDEX "
+                    "ft_account_name (first_name, last_name, username)"]
+    }
+}
+
+#Dialect -> statements that remove every search index.
+DROP_SCHEMA = {
+    'sqlite': ["DROP TRIGGER IF EXISTS post_fts_insert", "DROP TRIGGER IF EXISTS post_fts_delete",
+               "DROP TRIGGER IF EXISTS post_fts_update", "DROP TABLE IF EXISTS post_fts",
+               "DROP TRIGGER IF EXISTS account_fts_insert",
+               "DROP TRIGGER IF EXISTS account_fts_delete",
+               "DROP TRIGGER IF EXISTS account_fts_update", "DROP TABLE IF EXISTS account_fts"],
+    'mysql': ["ALTER TABLE post DROP INDEX ft_post_text",
+              "ALTER TABLE account DROP INDEX ft_account_name"]
+}
+
+def create_index(conn, table_name):
+    '''
+    Adds the search index of a table and fills it from the rows already there.
+    Databases without a backend are left as they are.
+    P:
+        conn(Connection): Connection in a transaction
+        table_name(string): post or account
+    '''
+    if conn.dialect.name == 'mysql' and has_fulltext(conn, table_name):
+        return
+    for statement in SCHEMA.get(conn.dialect.name, {}).get(table_name, ()):
+        conn.execute(sa.text(statement))
+
+def has_fulltext(conn, table_name):
+    """Returns True if the MySQL table already has its FULLTEXT index."""
+    return any(index.get('dialect_options', {}).get('mysql_prefix') == 'FULLTEXT'
+               for index in sa.inspect(conn).get_indexes(table_name))
+
+def drop_indexes(conn):
+    """Removes every search index."""
+    for statement in DROP_SCHEMA.get(conn.dialect.name, ()):
+        conn.execute(sa.text(statement))
+
+#Tables made by create_all get their index too.
+event.listen(Post.__table__, 'after_create',
+             lambda target, conn, **kwargs: create_index(conn, 'post'))
+event.listen(Account.__table__, 'after_create',
+             lambda target, conn, **kwargs: create_index(conn, 'account'))
+
+def query_words(text):
+    """Returns the words of a search, lower cased (at most MAX_WORDS)."""
+    return WORD.findall((text or '').lower())[:MAX_WORDS]
+
+class SearchBackend:
+    '''
+    Interface every search backend implements. Each returns a subquery of the matching ids
+        with a score column, higher is more relevant.
+    '''
+
+    def match_posts(self, words):
+        """Subquery of (id, score) of the live posts whose text has every word."""
+        raise NotImplementedError
+
+    def match_accounts(self, words):
+        """Subquery of (id, score) of the accounts whose name or username has every word."""
+        raise NotImplementedError
+
+class SQLiteSearch(SearchBackend):
+    """FTS5 backend, ranks with bm25 (weighting names above usernames)."""
+
+    @staticmethod
+    def expression(words):
+        """Quotes every word so FTS5 syntax in a search is matched as text, prefixes included."""
+        return ' '.join(f'"{word}"*' for word in words)
+
+    def match(self, table_name, words, *weights):
+        fts = sa.table(table_name, sa.column('rowid'))
+        rank = sa.func.bm25(sa.literal_column(table_name), *weights)
+        return (sa.select(fts.c.rowid.label('id'), (-rank).label('score'))
+                .where(sa.literal_column(table_name).op('MATCH')(self.expression(words)))
+                .subquery())
+
+    def match_posts(self, words):
+        return self.match('post_fts', words)
+
+    def match_accounts(self, words):
+        return self.match('account_fts', words, 2.0, 2.0, 1.0)
+
+class MySQLSearch(SearchBackend):
+    """FULLTEXT backend in boolean mode, ranks with MATCH ... AGAINST relevance."""
+
+    @staticmethod
+    def expression(words):
+        """Requires every word, as a prefix."""
+        return ' '.join(f'+{word}*' for word in words)
+
+    def match_posts(self, words):
+        score = mysql.match(Post.text_content, against=self.expression(words)).in_boolean_mode()
+        return sa.select(Post.id, score.label('score')).where(score).subquery()
+
+    def match_accounts(self, words):
+        score = mysql.match(Account.first_name, Account.last_name, Account.username,
+                            against=self.expression(words)).in_boolean_mode()
+        return sa.select(Account.id, score.label('score')).where(score).subquery()
+
+#SEARCH_BACKEND name -> factory taking the app config.
+BACKENDS = {
+    'sqlite': lambda config: SQLiteSearch(),
+    'mysql': lambda config: MySQLSearch()
+}
+
+def get_search():
+    """Returns the search backend configured for the current app, creating it on first use."""
+    backend = current_app.extensions.get('search')
+    if backend is None:
+        name = current_app.config['SEARCH_BACKEND'] or db.engine.dialect.name
+        if name not in BACKENDS:
+            raise RuntimeError(f"Unknown SEARCH_BACKEND '{name}'.")
+        backend = BACKENDS[name](current_app.config)
+        current_app.extensions['search'] = backend
+    return backend
+
+def page_bounds(offset):
+    '''
+    Works out the rows of a page of results.
+    R:
+        (offset, rows to fetch), rows is 0 past SEARCH_MAX_RESULTS.
+    '''
+    offset = max(0, offset or 0)
+    page_size = current_app.config['SEARCH_PAGE_SIZE']
+    return offset, max(0, min(page_size, current_app.config['SEARCH_MAX_RESULTS'] - offset))
+
+def paginate(query, offset):
+    '''
+    Fetches a page of ranked results. Ranks shift as rows are written, so pages are cut by
+        offset instead of keyset, and no deeper than SEARCH_MAX_RESULTS.
+    P:
+        query(Select): The ordered results
+        offset(int): Cursor from the previous page (None for the first page)
+    R:
+        Tuple of (list of rows, cursor for the next page or None if this is the last).
+    '''
+    offset, rows = page_bounds(offset)
+    if rows == 0:
+        return [], None
+    #One extra row tells us if there is another page without a COUNT.
+    page = db.session.execute(query.offset(offset).limit(rows + 1)).all()
+    next_cursor = None
+    if len(page) > rows:
+        page = page[:rows]
+        if offset + rows < current_app.config['SEARCH_MAX_RESULTS']:
+            next_cursor = offset + rows
+    return page, next_cursor
+
+def search_posts(text, caller_id, edges, offset=None):
+    '''
+    Finds the posts the caller can read, most relevant first. A post can be read on the
+        caller's own timeline and on the timelines can_make_content lets the caller use:
+        public accounts that are friends with the caller or sent the caller a request.
+    P:
+        text(string): What was searched for
+        caller_id(int): Account.id of the caller
+        edges(SocialEdges): The caller's relationships
+        offset(int): Cursor from the previous page (None for the first page)
+    R:
+        Tuple of (list of Posts, cursor for the next page or None if this is the last).
+    '''
+    words = query_words(text)
+    if not words:
+        return [], None
+    matches = get_search().match_posts(words)
+    owner = aliased(Account)
+    query = (sa.select(Post).join(matches, matches.c.id == Post.id)
+             .join(owner, owner.id == Post.posted_on_id)
+             .where(Post.deleted_at == None, owner.deleted_at == None,
+                    sa.or_(Post.posted_on_id == caller_id,
+                           sa.and_(owner.is_public == True,
+                                   Post.posted_on_id.in_(edges.friends | edges.pending_in))))
+             .order_by(matches.c.score.desc(), Post.id.desc()))
+    page, next_cursor = paginate(query, offset)
+    return [row[0] for row in page], next_cursor
+
+def search_accounts(text, caller_id, edges, offset=None):
+    '''
+    Finds the live accounts the caller may see, most relevant first: public accounts, the
+        caller and the accounts the caller is connected to.
+    P:
+        text(string): What was searched for
+        caller_id(int): Account.id of the caller
+        edges(SocialEdges): The caller's relationships
+        offset(int): Cursor from the previous page (None for the first page)
+    R:
+        Tuple of (list of Accounts, cursor for the next page or None if this is the last).
+    '''
+    words = query_words(text)
+    if not words:
+        return [], None
+    connected = edges.friends | edges.pending_in | edges.pending_out | {caller_id}
+    matches = get_search().match_accounts(words)
+    query = (sa.select(Account).join(matches, matches.c.id == Account.id)
+             .where(Account.deleted_at == None,
+                    sa.or_(Account.is_public == True, Account.id.in_(connected)))
+             .order_by(matches.c.score.desc(), Account.id))
+    page, next_cursor = paginate(query, offset)
+    return [row[0] for row in page], next_cursor
@@ -0,0 +1,68 @@
+"""This is the driving module for searching posts and people in the Facebook imitation app 'Y'.
+Results come ranked by relevance from the full-text index (see search.py) and only hold what
+the caller could already see on the timelines and friend pages."""
+from flask import request, Blueprint
+from flask_jwt_extended import (get_jwt_identity, jwt_required)
+from current_account import get_summaries
+from search import query_words, search_posts, search_accounts
+from serialization import api_response
+from social_graph import get_graph
+
+search_bp = Blueprint('search', __name__)
+
+def missing_query():
+    """Returns the 400 response for a search without any words, or None if it has some."""
+    if not query_words(request.args.get('q')):
+        return api_response({'message': "Enter something to search for."}, 400)
+    return None
+
+@search_bp.route('/api/search/posts')
+@jwt_required()
+def find_posts():
+    '''
+    Searches the text of the posts the caller can read.
+    Request args: q(string) the search, cursor(int) the cursor handed out with the previous page.
+    R:
+        JSON (or MessagePack) with posts (Post.to_dict, most relevant first), postable (names
+            and profile images of their posters and timeline owners, as in timeline_payload)
+            and nextCursor. 400 without any words to search for.
+    '''
+    missing = missing_query()
+    if missing is not None:
+        return missing
+    caller_id = get_jwt_identity()
+    posts, next_cursor = search_posts(request.args.get('q'), caller_id,
+                                      get_graph().get(caller_id),
+                                      request.args.get('cursor', type=int))
+
+    postable = {}
+    for summary in get_summaries({post.poster_id for post in posts}
+                                 | {post.posted_on_id for post in posts}).values():
+        postable.update(summary.to_post_data())
+    return api_response({'posts': [post.to_dict() for post in posts],
+                         'postable': {str(key): value for key, value in postable.items()},
+                         'nextCursor': next_cursor})
+
+@search_bp.route('/api/search/people')
+@jwt_required()
+def find_people():
+    '''
+    Searches the names and usernames of public accounts and the caller's connections.
+    Request args: q(string) the search, cursor(int) the cursor handed out with the previous page.
+    R:
+        JSON (or MessagePack) with accounts (id, fName, lName, profileImageID and isPublic,
+            most relevant first) and nextCursor. 400 without any words to search for.
+    '''
+    missing = missing_query()
+    if missing is not None:
+        return missing
+    caller_id = get_jwt_identity()
+    accounts, next_cursor = search_accounts(request.args.get('q'), caller_id,
+                                            get_graph().get(caller_id),
+                                            request.args.get('cursor', type=int))
+    #Friend codes are left out, they are what lets someone send a friend request.
+    return api_response({'accounts': [{'id': acc.id, 'fName': acc.first_name,
+                                       'lName': acc.last_name,
+                                       'profileImageID': acc.profile_image_id,
+                                       'isPublic': acc.is_public} for acc in accounts],
+                         'nextCursor': next_cursor})
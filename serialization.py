@@ -0,0 +1,73 @@
+"""This is the response encoding module for the JSON APIs of the Facebook imitation app 'Y'.
+orjson replaces the standard library encoder when it is installed, and API endpoints answer
+with MessagePack instead of JSON when the client asks for it with the Accept header and msgpack
+is installed."""
+from datetime import date
+from flask import current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+def encode_default(value):
+    '''
+    Encodes the values the encoders do not support on their own.
+    P:
+        value: The value that could not be encoded
+    R:
+        Dates and datetimes in ISO 8601, raises TypeError for anything else.
+    '''
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes with orjson, falling back to Flask's default without it."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        #orjson does not sort keys, which also lets dictionaries keyed by ids of mixed type through.
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=encode_default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+def accepted_mimetypes():
+    """Returns the response types the API can produce, JSON first so it wins ties."""
+    if msgpack is None:
+        return [JSON_MIMETYPE]
+    return [JSON_MIMETYPE, *MSGPACK_MIMETYPES]
+
+def api_response(payload, status=200):
+    '''
+    Encodes an API payload in the format the request's Accept header prefers.
+    P:
+        payload(dict): Plain values; dates are sent in ISO 8601
+        status(int): HTTP status of the response
+    R:
+        The response, JSON unless MessagePack was preferred.
+    '''
+    mimetype = request.accept_mimetypes.best_match(accepted_mimetypes(), default=JSON_MIMETYPE)
+    if mimetype in MSGPACK_MIMETYPES:
+        body = msgpack.packb(payload, default=encode_default)
+    else:
+        body = current_app.json.dumps(payload)
+    response = current_app.response_class(body, status=status, mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
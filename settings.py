@@ -1,7 +1,38 @@
 """Settings file for app. Expects .env file for private storage of: SQLALCHEMY_DATABASE_URI
-SQLALCHEMY_SESSION_TIMEOUT
+SQLALCHEMY_SESSION_TIMEOUT (seconds a request waits for a free pooled connection)
 MAX_CONTENT_LENGTH
-SECRET_KEY"""
+SECRET_KEY
+Optional tuning variables fall back to the defaults below when unset:
+TIMELINE_PAGE_SIZE
+TIMELINE_REPLY_LIMIT (newest replies shown per post, 0 shows them all)
+TIMELINE_WATERMARK_LAG (seconds change polls look back for rows committed late, see api_bp.make_watermark)
+FRIENDS_PAGE_SIZE (accounts per page of the friend, request and block lists)
+SUGGESTIONS_LIMIT (people shown under 'people you may know')
+SEARCH_BACKEND ('sqlite' or 'mysql', defaults to the database's dialect)
+SEARCH_PAGE_SIZE, SEARCH_MAX_RESULTS (results per page, results a search can page through)
+IMAGE_STORE_BACKEND, IMAGE_STORE_PATH (defaults to the instance folder's images directory)
+IMAGE_CACHE_MAX_AGE (seconds browsers may reuse an image without asking)
+IMAGE_WORKERS, IMAGE_VARIANT_QUALITY (threads, 0 resizes inline; WebP quality for resized images)
+SOCIAL_GRAPH_CACHE_SIZE, SOCIAL_GRAPH_CACHE_TTL (ids held by the friend cache, seconds an entry lives)
+BCRYPT_LOG_ROUNDS (cost of new hashes, older ones are rehashed on login)
+PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE (bcrypt processes, 0 runs inline; jobs allowed to wait)
+FEED_FANOUT_LIMIT (posters with more friends are pulled into feeds on read instead)
+EVENT_HUB_BACKEND, EVENT_HUB_PATH ('memory' or 'sqlite' to share events between worker processes)
+EVENT_BUFFER_SIZE, EVENT_HISTORY_SIZE (events a stream may lag by, events kept per account to resume)
+EVENT_HEARTBEAT (seconds between keep-alives on idle event streams)
+REACTION_WRITE_BEHIND (1 buffers likes in memory, see reaction_buffer.py for the durability trade-off)
+REACTION_FLUSH_INTERVAL, REACTION_FLUSH_SIZE (seconds between like flushes, waiting likes that flush early)
+BATCH_MAX_OPERATIONS (operations accepted by one /api/batch request)
+SQL_SLOW_QUERY_MS, SQL_REPEAT_THRESHOLD (statements logged as slow, runs of one statement logged as N+1)
+SQL_DEBUG_HEADERS (1 sends per request query headers outside debug mode too)
+METRICS_TOKEN (bearer token /metrics asks for, open when unset)
+DB_POOL_SIZE, DB_MAX_OVERFLOW (connections kept open, extra ones opened under load; not for SQLite)
+DB_POOL_RECYCLE (seconds before a connection is replaced, keep below the server's wait_timeout)
+DB_POOL_PRE_PING (1 tests connections on checkout so dropped ones are replaced, not failed)
+DB_RETRY_ATTEMPTS, DB_RETRY_BACKOFF (tries of work hit by a dropped connection, first pause in seconds)
+ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL (account summaries kept for permission checks, seconds; 0 turns it off)
+PURGE_RETENTION_DAYS (days soft deleted rows are kept before 'flask purge' removes them)
+PURGE_BATCH_SIZE, PURGE_PAUSE (rows the purge removes per transaction, seconds it waits between them)"""
 from os import environ
 
 from dotenv import load_dotenv
@@ -10,6 +41,56 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URI = environ.get("SQLALCHEMY_DATABASE_URI")
 SQLALCHEMY_SESSION_TIMEOUT = int(environ.get("SQLALCHEMY_SESSION_TIMEOUT"))
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_pre_ping": environ.get("DB_POOL_PRE_PING", "1") == "1",
+    "pool_recycle": int(environ.get("DB_POOL_RECYCLE", 280))
+}
+#SQLite picks its own pool, sizing it only applies to server databases.
+if not SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+    SQLALCHEMY_ENGINE_OPTIONS.update({
+        "pool_size": int(environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(environ.get("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": SQLALCHEMY_SESSION_TIMEOUT
+    })
 JWT_SECRET_KEY = 'Temp Holding Key'
 JWT_TOKEN_LOCATION = ["cookies"]
 JWT_COOKIE_CSRF_PROTECT = False
+TIMELINE_PAGE_SIZE = int(environ.get("TIMELINE_PAGE_SIZE", 20))
+TIMELINE_REPLY_LIMIT = int(environ.get("TIMELINE_REPLY_LIMIT", 0))
+TIMELINE_WATERMARK_LAG = float(environ.get("TIMELINE_WATERMARK_LAG", 10))
+FRIENDS_PAGE_SIZE = int(environ.get("FRIENDS_PAGE_SIZE", 50))
+SUGGESTIONS_LIMIT = int(environ.get("SUGGESTIONS_LIMIT", 20))
+SEARCH_BACKEND = environ.get("SEARCH_BACKEND")
+SEARCH_PAGE_SIZE = int(environ.get("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_RESULTS = int(environ.get("SEARCH_MAX_RESULTS", 500))
+IMAGE_STORE_BACKEND = environ.get("IMAGE_STORE_BACKEND", "local")
+IMAGE_STORE_PATH = environ.get("IMAGE_STORE_PATH")
+IMAGE_CACHE_MAX_AGE = int(environ.get("IMAGE_CACHE_MAX_AGE", 31536000))
+IMAGE_WORKERS = int(environ.get("IMAGE_WORKERS", 2))
+IMAGE_VARIANT_QUALITY = int(environ.get("IMAGE_VARIANT_QUALITY", 80))
+SOCIAL_GRAPH_CACHE_SIZE = int(environ.get("SOCIAL_GRAPH_CACHE_SIZE", 500000))
+SOCIAL_GRAPH_CACHE_TTL = int(environ.get("SOCIAL_GRAPH_CACHE_TTL", 60))
+BCRYPT_LOG_ROUNDS = int(environ.get("BCRYPT_LOG_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_MAX_QUEUE = int(environ.get("PASSWORD_HASH_MAX_QUEUE", 64))
+FEED_FANOUT_LIMIT = int(environ.get("FEED_FANOUT_LIMIT", 500))
+EVENT_HUB_BACKEND = environ.get("EVENT_HUB_BACKEND", "memory")
+EVENT_HUB_PATH = environ.get("EVENT_HUB_PATH")
+EVENT_BUFFER_SIZE = int(environ.get("EVENT_BUFFER_SIZE", 100))
+EVENT_HISTORY_SIZE = int(environ.get("EVENT_HISTORY_SIZE", 50))
+EVENT_HEARTBEAT = int(environ.get("EVENT_HEARTBEAT", 15))
+REACTION_WRITE_BEHIND = environ.get("REACTION_WRITE_BEHIND", "0") == "1"
+REACTION_FLUSH_INTERVAL = float(environ.get("REACTION_FLUSH_INTERVAL", 1.0))
+REACTION_FLUSH_SIZE = int(environ.get("REACTION_FLUSH_SIZE", 500))
+BATCH_MAX_OPERATIONS = int(environ.get("BATCH_MAX_OPERATIONS", 500))
+SQL_SLOW_QUERY_MS = float(environ.get("SQL_SLOW_QUERY_MS", 250))
+SQL_REPEAT_THRESHOLD = int(environ.get("SQL_REPEAT_THRESHOLD", 5))
+SQL_DEBUG_HEADERS = environ.get("SQL_DEBUG_HEADERS", "0") == "1"
+METRICS_TOKEN = environ.get("METRICS_TOKEN")
+DB_RETRY_ATTEMPTS = int(environ.get("DB_RETRY_ATTEMPTS", 3))
+DB_RETRY_BACKOFF = float(environ.get("DB_RETRY_BACKOFF", 0.05))
+ACCOUNT_CACHE_SIZE = int(environ.get("ACCOUNT_CACHE_SIZE", 100000))
+ACCOUNT_CACHE_TTL = int(environ.get("ACCOUNT_CACHE_TTL", 5))
+PURGE_RETENTION_DAYS = float(environ.get("PURGE_RETENTION_DAYS", 30))
+PURGE_BATCH_SIZE = int(environ.get("PURGE_BATCH_SIZE", 1000))
+PURGE_PAUSE = float(environ.get("PURGE_PAUSE", 0.1))
@@ -0,0 +1,140 @@
+"""This is the module for the in-process social graph cache of the Facebook imitation app 'Y'.
+Each cached account holds the id sets of its relationships so permission checks and friend
+lists are set lookups. relationship_bp invalidates both accounts of every change it commits.
+Entries also expire after SOCIAL_GRAPH_CACHE_TTL seconds, which bounds how stale another
+worker process can be."""
+import time
+from collections import OrderedDict
+from threading import Lock
+from flask import current_app
+from sqlalchemy import or_
+from models import db, Relationship
+
+class SocialEdges:
+    """The relationship id sets of one account."""
+
+    def __init__(self, acc_id):
+        """Constructor for SocialEdges."""
+        self.acc_id = acc_id
+        self.friends = set()        #Confirmed friends
+        self.ever_friends = set()   #Confirmed friends including removed ones (for old posts)
+        self.pending_in = set()     #Sent this account a friend request
+        self.pending_out = set()    #This account sent them a friend request
+        self.blocked = set()        #Blocked by this account
+        self.loaded_at = time.monotonic()
+
+    def weight(self):
+        """Number of ids held, used for the cache's memory bound."""
+        return 1 + (len(self.friends) + len(self.ever_friends) + len(self.pending_in)
+                    + len(self.pending_out) + len(self.blocked))
+
+    def counts(self):
+        """Returns the number of friends, requests received, requests sent and blocked accounts."""
+        return {'friends': len(self.friends), 'pending': len(self.pending_in),
+                'sent': len(self.pending_out), 'blocked': len(self.blocked)}
+
+    @staticmethod
+    def load(acc_id):
+        '''
+        Builds the id sets of an account from the Relationship table with one query.
+        P:
+            acc_id(int): Account.id to load
+        R:
+            SocialEdges of the account.
+        '''
+        edges = SocialEdges(acc_id)
+        rows = db.session.query(Relationship.first_acc_id, Relationship.second_acc_id,
+                                Relationship.confirmed_relation, Relationship.is_friend_relation,
+                                Relationship.deleted_at
+                                ).filter(or_(Relationship.first_acc_id == acc_id,
+                                             Relationship.second_acc_id == acc_id)).all()
+        for row in rows:
+            outgoing = row.first_acc_id == acc_id
+            other = row.second_acc_id if outgoing else row.first_acc_id
+            if not outgoing:
+                if row.deleted_at is None and row.is_friend_relation and not row.confirmed_relation:
+                    edges.pending_in.add(other)
+                continue
+
+            if row.is_friend_relation and row.confirmed_relation:
+                edges.ever_friends.add(other)
+            if row.deleted_at is not None:
+                continue
+            if not row.is_friend_relation:
+                edges.blocked.add(other)
+            elif row.confirmed_relation:
+                edges.friends.add(other)
+            else:
+                edges.pending_out.add(other)
+        return edges
+
+class SocialGraphCache:
+    """LRU cache of SocialEdges bounded by the total number of ids it holds."""
+
+    def __init__(self, max_ids, ttl):
+        """Constructor for SocialGraphCache."""
+        self.max_ids = max_ids
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        #Bumped by every invalidation so a load that raced one is not cached.
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(self, acc_id):
+        '''
+        Gets the relationship id sets of an account, loading them on a miss.
+        P:
+            acc_id(int): Account.id
+        R:
+            SocialEdges of the account (treat as read only).
+        '''
+        acc_id = int(acc_id)
+        with self._lock:
+            edges = self._entries.get(acc_id)
+            if edges is not None and time.monotonic() - edges.loaded_at < self.ttl:
+                self._entries.move_to_end(acc_id)
+                return edges
+            generation = self._generation
+
+        edges = SocialEdges.load(acc_id)
+        with self._lock:
+            if generation != self._generation:
+                return edges
+            self._remove(acc_id)
+            self._entries[acc_id] = edges
+            self._size += edges.weight()
+            #Evict least recently used accounts, but always keep the one just loaded.
+            while self._size > self.max_ids and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.weight()
+        return edges
+
+    def invalidate(self, *acc_ids):
+        """Drops the cached sets of the accounts so their next lookup reloads them."""
+        with self._lock:
+            self._generation += 1
+            for acc_id in acc_ids:
+                self._remove(int(acc_id))
+
+    def clear(self):
+        """Drops every cached account."""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, acc_id):
+        """Removes an entry, the caller holds the lock."""
+        edges = self._entries.pop(acc_id, None)
+        if edges is not None:
+            self._size -= edges.weight()
+
+def get_graph():
+    """Returns the app's social graph cache, creating it on first use."""
+    graph = current_app.extensions.get('social_graph')
+    if graph is None:
+        graph = SocialGraphCache(current_app.config['SOCIAL_GRAPH_CACHE_SIZE'],
+                                 current_app.config['SOCIAL_GRAPH_CACHE_TTL'])
+        current_app.extensions['social_graph'] = graph
+    return graph
@@ -0,0 +1,198 @@
+"""This is the module for 'people you may know' in the Facebook imitation app 'Y'.
+FriendSuggestion holds, for every account, each account it is not friends with that shares at
+least one friend with it and how many friends they share. relationship_bp keeps the counts
+current in the transaction that confirms or removes a friendship (friend_added, friend_removed),
+which touches one row per friend of the two accounts. Showing suggestions is one read of the
+top rows of ix_friend_suggestion_rank instead of a two-hop join over Relationship.
+Blocks, pending requests and deleted accounts change far more often than the counts, so they
+are filtered out when suggestions are read instead of being kept in the table.
+'flask suggestions rebuild' recomputes every count from Relationship, for a new table or after
+friendships were written around relationship_bp (benchmarks.generate, manual fixes). The table
+holds a row per friend-of-friend pair, so it grows with the square of the busiest accounts'
+friend counts."""
+from sqlalchemy import exists, or_
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import aliased
+from models import db, Account, FriendSuggestion, Relationship
+from db_retry import run_transaction
+
+def is_friendship(relation):
+    """Returns the condition of a live confirmed friend Relationship (of an alias)."""
+    return ((relation.confirmed_relation == True) & (relation.is_friend_relation == True)
+            & (relation.deleted_at == None))
+
+def friend_ids(acc_id):
+    '''
+    Gets an account's friends from the Relationship table, including changes in the session
+        not committed yet (the social graph cache is only invalidated after the commit).
+    R:
+        Set of Account.ids.
+    '''
+    return {row.second_acc_id for row in db.session.query(Relationship.second_acc_id)
+            .filter(Relationship.first_acc_id == acc_id, is_friendship(Relationship))}
+
+def upsert(rows):
+    '''
+    Adds to the mutual_count of pairs, making the rows that do not exist yet.
+    P:
+        rows(list): Dictionaries of account_id, candidate_id and mutual_count to add
+    '''
+    if not rows:
+        return
+    table = FriendSuggestion.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'mysql':
+        statement = mysql.insert(table)
+        statement = statement.on_duplicate_key_update(
+            mutual_count=table.c.mutual_count + statement.inserted.mutual_count)
+    else:
+        statement = (postgresql if dialect == 'postgresql' else sqlite).insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=['account_id', 'candidate_id'],
+            set_={'mutual_count': table.c.mutual_count + statement.excluded.mutual_count})
+    db.session.execute(statement, rows)
+
+def change_mutual(acc_id, other_ids, delta):
+    '''
+    Changes the mutual count between an account and each of other accounts, both ways.
+    P:
+        acc_id(int): Account.id
+        other_ids(set): Account.ids that gained or lost a mutual friend with it
+        delta(int): 1 or -1
+    '''
+    if not other_ids:
+        return
+    if delta > 0:
+        upsert([{'account_id': acc_id, 'candidate_id': other_id, 'mutual_count': delta}
+                for other_id in other_ids]
+               + [{'account_id': other_id, 'candidate_id': acc_id, 'mutual_count': delta}
+                  for other_id in other_ids])
+        return
+
+    pairs = or_((FriendSuggestion.account_id == acc_id)
+                & FriendSuggestion.candidate_id.in_(other_ids),
+                FriendSuggestion.account_id.in_(other_ids)
+                & (FriendSuggestion.candidate_id == acc_id))
+    db.session.execute(db.update(FriendSuggestion).where(pairs)
+                       .values(mutual_count=FriendSuggestion.mutual_count + delta)
+                       .execution_options(synchronize_session=False))
+    db.session.execute(db.delete(FriendSuggestion)
+                       .where(pairs, FriendSuggestion.mutual_count <= 0)
+                       .execution_options(synchronize_session=False))
+
+def forget_pair(first_id, second_id):
+    """Removes the suggestion rows between two accounts."""
+    db.session.execute(db.delete(FriendSuggestion).where(
+        or_((FriendSuggestion.account_id == first_id)
+            & (FriendSuggestion.candidate_id == second_id),
+            (FriendSuggestion.account_id == second_id)
+            & (FriendSuggestion.candidate_id == first_id)))
+                       .execution_options(synchronize_session=False))
+
+def friend_added(first_id, second_id):
+    '''
+    Updates the counts for a new friendship. Call before committing it.
+    P:
+        first_id(int), second_id(int): Account.ids of the new friends
+    '''
+    first_friends = friend_ids(first_id) - {second_id}
+    second_friends = friend_ids(second_id) - {first_id}
+    #Each one's other friends now share a friend with the other one, unless they are friends.
+    change_mutual(second_id, first_friends - second_friends, 1)
+    change_mutual(first_id, second_friends - first_friends, 1)
+    forget_pair(first_id, second_id)
+
+def friend_removed(first_id, second_id):
+    '''
+    Updates the counts for a removed friendship. Call before committing it.
+    P:
+        first_id(int), second_id(int): Account.ids of the former friends
+    '''
+    first_friends = friend_ids(first_id) - {second_id}
+    second_friends = friend_ids(second_id) - {first_id}
+    change_mutual(second_id, first_friends - second_friends, -1)
+    change_mutual(first_id, second_friends - first_friends, -1)
+    #The two can be suggested to each other again if they still share friends.
+    mutual = len(first_friends & second_friends)
+    forget_pair(first_id, second_id)
+    if mutual:
+        upsert([{'account_id': first_id, 'candidate_id': second_id, 'mutual_count': mutual},
+                {'account_id': second_id, 'candidate_id': first_id, 'mutual_count': mutual}])
+
+def get_suggestions(acc_id, edges, limit):
+    '''
+    Gets the accounts an account may know, most mutual friends first.
+    P:
+        acc_id(int): Account.id
+        edges(SocialEdges): The account's relationships
+        limit(int): Most suggestions returned
+    R:
+        List of (Account, mutual friend count).
+    '''
+    excluded = edges.friends | edges.pending_in | edges.pending_out | edges.blocked
+    blocked_by = aliased(Relationship)
+    query = (db.session.query(Account, FriendSuggestion.mutual_count)
+             .join(FriendSuggestion, FriendSuggestion.candidate_id == Account.id)
+             .filter(FriendSuggestion.account_id == acc_id, Account.deleted_at == None,
+                     ~exists().where(blocked_by.first_acc_id == Account.id,
+                                     blocked_by.second_acc_id == acc_id,
+                                     blocked_by.is_friend_relation == False,
+                                     blocked_by.deleted_at == None)))
+    if excluded:
+        query = query.filter(FriendSuggestion.candidate_id.not_in(excluded))
+    return (query.order_by(FriendSuggestion.mutual_count.desc(), FriendSuggestion.candidate_id)
+            .limit(limit).all())
+
+def rebuild_batch(after_id, batch_size):
+    '''
+    Recomputes the suggestions of the next batch of accounts in one transaction.
+    P:
+        after_id(int): Account.id the previous batch ended at
+        batch_size(int): Accounts per batch
+    R:
+        (Account.id this batch ended at or None when there are no more, rows written).
+    '''
+    acc_ids = [row.id for row in db.session.query(Account.id).filter(Account.id > after_id)
+               .order_by(Account.id).limit(batch_size)]
+    if not acc_ids:
+        return None, 0
+    db.session.execute(db.delete(FriendSuggestion)
+                       .where(FriendSuggestion.account_id.in_(acc_ids))
+                       .execution_options(synchronize_session=False))
+
+    #account -> friend -> friend's friend, counted per pair, leaving out existing friends.
+    to_friend = aliased(Relationship)
+    to_candidate = aliased(Relationship)
+    already = aliased(Relationship)
+    pairs = (db.select(to_friend.first_acc_id, to_candidate.second_acc_id, db.func.count())
+             .join(to_candidate, to_candidate.first_acc_id == to_friend.second_acc_id)
+             .where(to_friend.first_acc_id.in_(acc_ids), is_friendship(to_friend),
+                    is_friendship(to_candidate),
+                    to_candidate.second_acc_id != to_friend.first_acc_id,
+                    ~exists().where(already.first_acc_id == to_friend.first_acc_id,
+                                    already.second_acc_id == to_candidate.second_acc_id,
+                                    is_friendship(already)))
+             .group_by(to_friend.first_acc_id, to_candidate.second_acc_id))
+    result = db.session.execute(db.insert(FriendSuggestion).from_select(
+        ['account_id', 'candidate_id', 'mutual_count'], pairs))
+    db.session.commit()
+    return acc_ids[-1], max(result.rowcount, 0)
+
+def rebuild(batch_size=500, echo=print):
+    '''
+    Recomputes every account's suggestions from the Relationship table, one batch of
+        accounts per transaction. Safe to stop and re-run.
+    P:
+        batch_size(int): Accounts per transaction
+        echo(function): Called with a line of progress per batch
+    R:
+        Number of suggestion rows written.
+    '''
+    written = 0
+    after_id = 0
+    while True:
+        after_id, count = run_transaction(rebuild_batch, after_id, batch_size)
+        if after_id is None:
+            return written
+        written += count
+        echo(f"Rebuilt suggestions up to account {after_id} ({written} rows)...")